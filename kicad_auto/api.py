@@ -0,0 +1,343 @@
+"""Python API
+
+The operations of the command line tools as functions, so other Python
+code can run them without starting a new interpreter for each one.
+The options are passed using the *Options objects, the defaults are the
+same used by the command line tools.
+
+The GUI operations run KiCad in a virtual X server, like the tools.
+The plot operations use the pcbnew module and share the loaded boards:
+
+    from kicad_auto import api
+    api.plot('board.kicad_pcb', 'out', file_format='zip_gerbers')
+    api.plot('board.kicad_pcb', 'out', ['F.Cu', 'B.Cu'], file_format='pdf')
+"""
+import copy
+import os
+
+from contextlib import contextmanager
+
+from kicad_auto import file_util
+from kicad_auto import eeschema_ui
+from kicad_auto import pcbnew_ui
+from kicad_auto import step_export
+from kicad_auto.kicad_config import (init_config_dir, config_env, copy_lib_table)
+from kicad_auto.kicad_pcb import load_layers
+from kicad_auto.misc import (REC_W,REC_H)
+from kicad_auto.ui_automation import (
+    PopenContext,
+    xdotool,
+    recorded_xvfb
+)
+
+from kicad_auto import log
+logger = log.get_logger(__name__)
+
+# Return error codes
+# Negative values are ERC/DRC errors
+BATCH_FAILED=eeschema_ui.BATCH_FAILED
+ACTION_FAILED=4
+
+# Localized GTK dialog names (select a filename, print)
+_dialog_names = None
+
+
+class SessionOptions(object):
+    """Options for the virtual X session"""
+    def __init__(self, record=False, rec_width=REC_W, rec_height=REC_H):
+        # Record the session, the video goes to the output dir
+        self.record = record
+        self.rec_width = rec_width
+        self.rec_height = rec_height
+
+
+class EeschemaOptions(SessionOptions):
+    def __init__(self, commands=None, file_format='pdf', all_pages=False, incremental=False,
+                 warnings_as_errors=False, bom_format='csv', **kwargs):
+        super(EeschemaOptions, self).__init__(**kwargs)
+        # Commands for the batch command
+        self.commands = commands or []
+        self.file_format = file_format
+        self.all_pages = all_pages
+        self.incremental = incremental
+        self.warnings_as_errors = warnings_as_errors
+        # The GUI BoM is always CSV
+        self.bom_format = bom_format
+
+
+class PcbnewOptions(SessionOptions):
+    def __init__(self, drc=False, drc_output='drc_result.rpt', ignore_unconnected=False, print_jobs=None,
+                 step=False, step_output='board.step', save=False, **kwargs):
+        super(PcbnewOptions, self).__init__(**kwargs)
+        self.drc = drc
+        self.drc_output = drc_output
+        self.ignore_unconnected = ignore_unconnected
+        # List of (output name, list of layer names)
+        self.print_jobs = print_jobs or []
+        self.step = step
+        self.step_output = step_output
+        self.save = save
+
+
+def english_env(env):
+    """Environment for a KiCad process using english, needed to find the
+       windows. Our environment isn't changed, the GTK dialog names are
+       solved using our locale."""
+    global _dialog_names
+    if _dialog_names is None:
+       _dialog_names = pcbnew_ui.gtk_dialog_names()
+    env = dict(env)
+    env['LANG'] = 'C.UTF-8'
+    return env
+
+
+def eeschema_do(sch_file, output_dir, command, options=None):
+    """Runs an eeschema command (export, run_erc, netlist, bom_xml or batch).
+       Returns the exit code."""
+    options = options or EeschemaOptions()
+    output_dir = os.path.abspath(output_dir)+'/'
+    file_util.mkdir_p(output_dir)
+
+    # Use a private KiCad configuration
+    cfg_dir = init_config_dir()
+    eeschema_ui.create_config(cfg_dir, options.file_format)
+    copy_lib_table(cfg_dir, 'sym-lib-table')
+
+    output_file_no_ext = os.path.join(output_dir, os.path.splitext(os.path.basename(sch_file))[0])
+    with recorded_xvfb(output_dir if options.record else None, command+'_eeschema_screencast.ogv',
+                       width=options.rec_width, height=options.rec_height, colordepth=24):
+         with PopenContext(['eeschema', sch_file], close_fds=True, env=english_env(config_env(cfg_dir)),
+                           stderr=open(os.devnull, 'wb'), stdout=open(os.devnull, 'wb')) as eeschema_proc:
+              eeschema_ui.eeschema_skip_errors()
+              if command == 'batch':
+                 ret = eeschema_ui.eeschema_run_batch(options.commands, options, sch_file, output_dir,
+                                                      output_file_no_ext, eeschema_proc.pid)
+              else:
+                 ret = eeschema_ui.eeschema_run_command(command, options, sch_file, output_dir, output_file_no_ext,
+                                                        eeschema_proc.pid)
+              eeschema_proc.terminate()
+    return ret
+
+
+def erc_precheck(sch_file, output_dir, options=None):
+    """Runs the fast ERC pre-check (no GUI), the report is stored in a .erc
+       file, like the one from eeschema. Returns the errors and warnings.
+       Raises ValueError if the schematic is malformed."""
+    from kicad_auto import erc_check
+
+    options = options or EeschemaOptions()
+    output_dir = os.path.abspath(output_dir)
+    file_util.mkdir_p(output_dir)
+    messages = erc_check.check(sch_file)
+    erc_check.write_report(messages, os.path.join(output_dir, os.path.splitext(os.path.basename(sch_file))[0]+'.erc'))
+    return erc_check.count(messages, options.warnings_as_errors)
+
+
+def netlist(sch_file, output_dir):
+    """Creates the netlist without eeschema, returns the name of the .net file.
+       Raises ValueError if the schematic is malformed."""
+    from kicad_auto import sch_netlist
+
+    output_dir = os.path.abspath(output_dir)
+    file_util.mkdir_p(output_dir)
+    net_file = os.path.join(output_dir, os.path.splitext(os.path.basename(sch_file))[0]+'.net')
+    sch_netlist.netlist(sch_file, net_file)
+    return net_file
+
+
+def bom(sch_file, output_dir, file_format='csv', group_fields=None, fields=None, include_dnp=False):
+    """Creates the grouped BoM without eeschema, returns the name of the file.
+       Raises ValueError if the schematic is malformed."""
+    from kicad_auto import sch_bom
+
+    output_dir = os.path.abspath(output_dir)
+    file_util.mkdir_p(output_dir)
+    output_file = os.path.join(output_dir, os.path.splitext(os.path.basename(sch_file))[0]+'.'+file_format)
+    sch_bom.bom(sch_file, output_file, file_format, group_fields or sch_bom.GROUP_FIELDS, fields or (),
+                include_dnp)
+    return output_file
+
+
+@contextmanager
+def pcbnew_session(pcb_file, output_dir, options, video_name, used_layers=None):
+    """Runs pcbnew with a private configuration, yields the config file and the process"""
+    file_util.mkdir_p(output_dir)
+
+    # Use a private KiCad configuration
+    cfg_dir = init_config_dir()
+    config_file = os.path.join(cfg_dir, 'pcbnew')
+    pcbnew_ui.create_config(config_file, drc=options.drc, used_layers=used_layers)
+    copy_lib_table(cfg_dir, 'fp-lib-table')
+
+    xvfb_kwargs = { 'width': options.rec_width, 'height': options.rec_height, 'colordepth': 24, }
+    with recorded_xvfb(output_dir if options.record else None, video_name, **xvfb_kwargs):
+        with PopenContext(['pcbnew', pcb_file], stderr=open(os.devnull, 'wb'), close_fds=True,
+                          env=english_env(config_env(cfg_dir))) as pcbnew_proc:
+            pcbnew_ui.wait_pcbnew_start()
+            yield config_file, pcbnew_proc
+            pcbnew_proc.terminate()
+
+
+def _solve_print_jobs(pcb_file, print_jobs):
+    """Converts the layer names to the PlotLayer_N values.
+       Returns the jobs and the layer lists of the Print dialog.
+       Raises ValueError for unknown layers."""
+    if not print_jobs:
+       return [], None
+    layer_ids, layer_names = load_layers(pcb_file)
+    return ([(output_name, pcbnew_ui.get_used_layers(layers, layer_ids)) for output_name, layers in print_jobs],
+            pcbnew_ui.print_dialog_lists(layer_ids))
+
+
+def _do_drc(drc_output_file, ignore_unconnected):
+    if os.path.exists(drc_output_file):
+       os.remove(drc_output_file)
+    pcbnew_ui.run_drc_commands(drc_output_file)
+    pcbnew_ui.close_drc()
+
+    drc_result = pcbnew_ui.parse_drc(drc_output_file)
+    logger.debug(drc_result);
+    errors = drc_result['drc_errors']
+    if not ignore_unconnected:
+       errors += drc_result['unconnected_pads']
+    if errors == 0:
+       logger.info('No DRC errors');
+       return 0
+    logger.error('Found {} DRC errors and {} unconnected pads'.format(
+         drc_result['drc_errors'],
+         drc_result['unconnected_pads']))
+    return -errors
+
+
+def pcbnew_do(pcb_file, output_dir, options=None, video_name='pcbnew_do_screencast.ogv'):
+    """Runs the DRC, print jobs, STEP export and save, in this order, loading
+       the PCB only once. The layers of each print job are selected in the
+       Print dialog. Returns the exit code.
+       Raises ValueError for unknown layers."""
+    options = options or PcbnewOptions()
+    output_dir = os.path.abspath(output_dir)
+    print_jobs, lists = _solve_print_jobs(pcb_file, options.print_jobs)
+
+    failed = []
+    drc_ret = 0
+    with pcbnew_session(pcb_file, output_dir, options, video_name,
+                        print_jobs[0][1] if print_jobs else None) as (config_file, pcbnew_proc):
+        if options.drc:
+           try:
+               drc_ret = _do_drc(os.path.join(output_dir, options.drc_output), options.ignore_unconnected)
+           except RuntimeError as e:
+               logger.error('DRC failed: '+str(e))
+               failed.append('drc')
+               xdotool(['key', 'Escape', 'Escape'])
+
+        for output_name, used_layers in print_jobs:
+            print_output_file = os.path.join(output_dir, output_name)
+            if os.path.exists(print_output_file):
+               os.remove(print_output_file)
+            logger.info('Printing '+output_name)
+            try:
+                # pcbnew reads the config only at start-up, the layers are selected in the dialog
+                pcbnew_ui.print_layers_commands(print_output_file, pcbnew_proc.pid, *_dialog_names,
+                                                used_layers=used_layers, lists=lists)
+            except RuntimeError as e:
+                logger.error('Printing %s failed: %s', output_name, str(e))
+                failed.append(output_name)
+                xdotool(['key', 'Escape', 'Escape', 'Escape'])
+
+        if options.step:
+           step_file = os.path.join(output_dir, options.step_output)
+           try:
+               pcbnew_ui.export_step_commands(step_file)
+           except RuntimeError as e:
+               logger.error('STEP export failed: '+str(e))
+               failed.append('step')
+               xdotool(['key', 'Escape', 'Escape'])
+
+        if options.save:
+           try:
+               pcbnew_ui.save_pcb(pcb_file, pcbnew_proc.pid)
+           except RuntimeError as e:
+               logger.error('Saving the PCB failed: '+str(e))
+               failed.append('save')
+
+    if failed:
+       logger.error('Failed actions: '+', '.join(failed))
+       return ACTION_FAILED
+    return drc_ret
+
+
+def run_drc(pcb_file, output_dir, options=None):
+    """Runs the DRC, returns the parsed report (see pcbnew_ui.parse_drc)"""
+    # Don't change the caller's options
+    options = copy.copy(options) if options else PcbnewOptions()
+    options.drc = True
+    drc_output_file = os.path.join(os.path.abspath(output_dir), options.drc_output)
+    if os.path.exists(drc_output_file):
+       os.remove(drc_output_file)
+    with pcbnew_session(pcb_file, output_dir, options, 'pcbnew_run_drc_screencast.ogv') as (config_file, pcbnew_proc):
+        pcbnew_ui.run_drc_commands(drc_output_file)
+        if options.save:
+           pcbnew_ui.close_drc()
+           pcbnew_ui.save_pcb(pcb_file, pcbnew_proc.pid)
+    return pcbnew_ui.parse_drc(drc_output_file)
+
+
+def drc_precheck(pcb_file, output_dir, options=None, rules=None):
+    """Runs the fast DRC pre-check (no GUI), the report uses the same format
+       as run_drc. Returns the parsed report (see pcbnew_ui.parse_drc).
+       Raises ValueError if the PCB is malformed."""
+    # Needs NumPy
+    from kicad_auto import drc_check
+
+    options = options or PcbnewOptions()
+    output_dir = os.path.abspath(output_dir)
+    file_util.mkdir_p(output_dir)
+    drc_output_file = os.path.join(output_dir, options.drc_output)
+    errors = drc_check.check(pcb_file, rules)
+    drc_check.write_report(pcb_file, errors, drc_output_file)
+    return pcbnew_ui.parse_drc(drc_output_file)
+
+
+def print_layers(pcb_file, output_dir, layers, output_name='printed.pdf', options=None):
+    """Prints the layers to a PDF, returns the name of the file.
+       Raises ValueError for unknown layers."""
+    options = options or PcbnewOptions()
+    used_layers = _solve_print_jobs(pcb_file, [(output_name, layers)])[0][0][1]
+    print_output_file = os.path.join(os.path.abspath(output_dir), output_name)
+    if os.path.exists(print_output_file):
+       os.remove(print_output_file)
+    with pcbnew_session(pcb_file, output_dir, options, 'pcbnew_print_layers_screencast.ogv',
+                        used_layers) as (config_file, pcbnew_proc):
+        pcbnew_ui.print_layers_commands(print_output_file, pcbnew_proc.pid, *_dialog_names)
+    return print_output_file
+
+
+def export_step(pcb_file, output_dir, step_output='board.step', origin='board_center', overwrite=True):
+    """Exports the STEP model using kicad2step (no GUI).
+       Returns the exit code.
+       Raises ValueError if the origin can't be computed."""
+    output_dir = os.path.abspath(output_dir)
+    file_util.mkdir_p(output_dir)
+    return step_export.export_step(pcb_file, os.path.join(output_dir, step_output), origin, overwrite)
+
+
+def pcb_layers(pcb_file):
+    """Returns the name -> id and id -> name dicts for the layers of the PCB"""
+    return load_layers(pcb_file)
+
+
+def plot(pcb_file, output_dir, layers=None, file_format='zip_gerbers', jobs=1, zip_level=6, manifest=False):
+    """Plots the layers using the pcbnew module (no GUI).
+       The default layers are the ones enabled in the plot dialog.
+       The board is loaded only once for all the calls.
+       Using `jobs` > 1 the layers are plotted in parallel."""
+    # Needs the KiCad Python module
+    from kicad_auto import pcb_util
+    from kicad_auto import pcb_plot
+
+    pcb = pcb_util.load_pcb(pcb_file)
+    if layers:
+       layers = [pcb_util.Layer.from_name(pcb, layer) for layer in layers]
+    else:
+       layers = pcb.get_plot_enabled_layers()
+    pcb_plot.plot(pcb, file_format, layers, os.path.abspath(output_dir), jobs, zip_level, manifest)
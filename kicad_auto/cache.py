@@ -0,0 +1,201 @@
+"""Output cache
+
+Stores the files generated by a tool, and its exit code, using a hash of
+everything that affects the result as key:
+- The design files (i.e. all the sheets of a schematic)
+- The files KiCad reads to solve the libraries (-cache.lib, lib tables)
+- The tool options
+- The KiCad version
+On a hit the outputs are restored without running KiCad.
+The least recently used entries are removed when the cache exceeds its
+maximum size.
+"""
+import fnmatch
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from kicad_auto import kicad_config
+from kicad_auto import schematic
+
+from kicad_auto import log
+logger = log.get_logger(__name__)
+
+# Default cache dir, used when no --cache_dir is specified
+CACHE_ENV = 'KICAD_AUTO_CACHE'
+# Default maximum size, in MB
+DEFAULT_SIZE = 1024
+ENTRY_FILE = 'entry.json'
+# Solved by kicad_version()
+_kicad_version = None
+
+
+def kicad_version():
+    """A string identifying the installed KiCad"""
+    global _kicad_version
+    if _kicad_version is None:
+       try:
+           # Available when imported from a pcbnew script
+           import pcbnew
+           _kicad_version = pcbnew.GetBuildVersion()
+       except ImportError:
+           # Asking KiCad is too slow, use the binaries
+           ids = []
+           for tool in ('eeschema', 'pcbnew'):
+               path = shutil.which(tool)
+               if path:
+                  st = os.stat(os.path.realpath(path))
+                  ids.append('%s:%d:%d' % (os.path.realpath(path), st.st_size, st.st_mtime))
+           _kicad_version = ' '.join(ids)
+       logger.debug('KiCad version: '+_kicad_version)
+    return _kicad_version
+
+
+def _project_files(design_file, patterns):
+    """Files from the project dir that KiCad reads when loading the design"""
+    dir_name = os.path.dirname(os.path.abspath(design_file))
+    files = []
+    for f in sorted(os.listdir(dir_name)):
+        if any(fnmatch.fnmatch(f, p) for p in patterns):
+           files.append(os.path.join(dir_name, f))
+    return files
+
+
+def library_inputs(sch_file):
+    """The files used to solve the symbols of a schematic"""
+    found = _project_files(sch_file, ('*-cache.lib', '*-rescue.lib', '*.pro', 'sym-lib-table'))
+    found.append(kicad_config.lib_table_file('sym-lib-table'))
+    return found
+
+
+def schematic_inputs(sch_file):
+    """All the files used to load a schematic"""
+    found = [f for f in schematic.sheet_files(sch_file) if os.path.isfile(f)]
+    return found + library_inputs(sch_file)
+
+
+def pcb_inputs(pcb_file):
+    """All the files used to load a PCB"""
+    found = [os.path.abspath(pcb_file)]
+    found.extend(_project_files(pcb_file, ('*.pro', 'fp-lib-table')))
+    found.append(kicad_config.lib_table_file('fp-lib-table'))
+    return found
+
+
+class OutputCache(object):
+    def __init__(self, cache_dir, max_size=DEFAULT_SIZE):
+        self.cache_dir = cache_dir
+        # In bytes
+        self.max_size = max_size*1024*1024
+
+    def key(self, tool, inputs, options):
+        h = hashlib.sha256()
+        h.update(tool.encode())
+        h.update(json.dumps(options, sort_keys=True).encode())
+        h.update(kicad_version().encode())
+        for f in inputs:
+            if f is None or not os.path.isfile(f):
+               # Missing files also count
+               h.update(b'-')
+               continue
+            h.update(os.path.basename(f).encode())
+            with open(f, 'rb') as fi:
+                 for block in iter(lambda: fi.read(1 << 20), b''):
+                     h.update(block)
+        return h.hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def restore(self, key, output_dir):
+        """Copies the cached outputs to output_dir.
+           Returns the exit code, or None if not in the cache."""
+        entry = self._entry_dir(key)
+        try:
+            with open(os.path.join(entry, ENTRY_FILE)) as f:
+                 data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        for name in data['files']:
+            dest = os.path.join(output_dir, name)
+            os.makedirs(os.path.dirname(dest) or '.', exist_ok=True)
+            shutil.copyfile(os.path.join(entry, 'files', name), dest)
+        # Used now, for the LRU
+        os.utime(os.path.join(entry, ENTRY_FILE))
+        logger.info('Restored %d file/s from the cache (%s)', len(data['files']), key[:12])
+        return data['ret']
+
+    def store(self, key, output_dir, patterns, since, ret):
+        """Stores the files matching the patterns, changed after `since`"""
+        files = []
+        for root, dirs, names in os.walk(output_dir):
+            for name in names:
+                rel = os.path.relpath(os.path.join(root, name), output_dir)
+                if (any(fnmatch.fnmatch(rel, p) for p in patterns) and
+                    os.path.getmtime(os.path.join(root, name)) >= since):
+                   files.append(rel)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp_')
+        except OSError as e:
+            logger.warning('Unable to store the outputs in the cache: '+str(e))
+            return
+        try:
+            for name in files:
+                dest = os.path.join(tmp, 'files', name)
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                shutil.copyfile(os.path.join(output_dir, name), dest)
+            with open(os.path.join(tmp, ENTRY_FILE), 'w') as f:
+                 json.dump({'ret': ret, 'files': sorted(files)}, f)
+            entry = self._entry_dir(key)
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            # Fails if another job stored the same entry, is the same
+            os.rename(tmp, entry)
+        except OSError as e:
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not os.path.isdir(self._entry_dir(key)):
+               logger.warning('Unable to store the outputs in the cache: '+str(e))
+            return
+        logger.debug('Stored %d file/s in the cache (%s)', len(files), key[:12])
+        self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries until we fit in max_size"""
+        entries = []
+        total = 0
+        for prefix in os.listdir(self.cache_dir):
+            prefix_dir = os.path.join(self.cache_dir, prefix)
+            if prefix.startswith('.') or not os.path.isdir(prefix_dir):
+               continue
+            for key in os.listdir(prefix_dir):
+                entry = os.path.join(prefix_dir, key)
+                try:
+                    used = os.path.getmtime(os.path.join(entry, ENTRY_FILE))
+                except OSError:
+                    # Incomplete
+                    used = 0
+                size = 0
+                for root, dirs, names in os.walk(entry):
+                    size += sum(os.path.getsize(os.path.join(root, n)) for n in names)
+                entries.append((used, size, entry))
+                total += size
+        for used, size, entry in sorted(entries):
+            if total <= self.max_size:
+               break
+            logger.debug('Removing %s from the cache', os.path.basename(entry)[:12])
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
+def from_args(args):
+    """Returns the cache selected by the command line options, or None"""
+    # Recorded sessions are for debug, don't cache them
+    if not args.cache_dir or getattr(args, 'record', False):
+       return None
+    # Incremental exports plot only the changed pages, the entry would miss the rest
+    if getattr(args, 'incremental', False):
+       logger.debug('Not using the cache for an incremental export')
+       return None
+    return OutputCache(args.cache_dir, args.cache_size)
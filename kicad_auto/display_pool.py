@@ -0,0 +1,122 @@
+"""Virtual X server pool
+
+Keeps a set of warm Xvfb servers and leases them to jobs, so the jobs
+don't pay the X server start-up.
+A leased display is passed to the tools using the KICAD_AUTO_DISPLAY
+environment variable, recorded_xvfb then uses it instead of starting a
+new Xvfb.
+Xvfb resets its state (windows, selections, etc.) when its last client
+disconnects. When a lease ends the display is checked, if a client or a
+top level window is left (i.e. an orphan KiCad) the server is restarted.
+"""
+import os
+import queue
+import threading
+import time
+
+from contextlib import contextmanager
+
+from kicad_auto.misc import (REC_W,REC_H)
+from kicad_auto.ui_automation import (start_xvfb, LEASE_ENV)
+from kicad_auto import x11
+
+from kicad_auto import log
+logger = log.get_logger(__name__)
+
+
+# Time for the server to process the disconnection of the job clients
+CLEAN_TIMEOUT = 1
+CLEAN_DELAY = 0.1
+
+
+class DisplayPool(object):
+    def __init__(self, size, width=REC_W, height=REC_H, colordepth=24):
+        self.size = size
+        self.width = width
+        self.height = height
+        self.colordepth = colordepth
+        self.servers = {}
+        self.free = queue.Queue()
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _start_server(self):
+        proc, display = start_xvfb(self.width, self.height, self.colordepth)
+        with self.lock:
+            self.servers[display] = proc
+        return display
+
+    def _stop_server(self, display):
+        with self.lock:
+            proc = self.servers.pop(display, None)
+        if proc is not None:
+           logger.debug('Stopping virtual X server '+display)
+           proc.terminate()
+           proc.wait()
+
+    def _is_clean(self, display):
+        """Waits for the display to have no clients nor windows left.
+           If this can't be checked the display isn't reused."""
+        end = time.time() + CLEAN_TIMEOUT
+        while True:
+            clean = x11.display_is_clean(display)
+            if clean is not False or time.time() >= end:
+               return bool(clean)
+            time.sleep(CLEAN_DELAY)
+
+    def _reset(self, display):
+        """Returns a clean display, restarting the server if needed"""
+        with self.lock:
+            proc = self.servers.get(display)
+        if proc is not None and proc.poll() is None and self._is_clean(display):
+           return display
+        logger.debug('Virtual X server %s not clean, restarting it', display)
+        self._stop_server(display)
+        return self._start_server()
+
+    def start(self):
+        logger.debug('Starting %d virtual X servers', self.size)
+        for i in range(self.size):
+            self.free.put(self._start_server())
+
+    def close(self):
+        with self.lock:
+            servers = self.servers
+            self.servers = {}
+        for display, proc in servers.items():
+            logger.debug('Stopping virtual X server '+display)
+            proc.terminate()
+            proc.wait()
+
+    @contextmanager
+    def lease(self):
+        """Gets a free display, waiting if all of them are in use"""
+        display = self.free.get()
+        with self.lock:
+            proc = self.servers.get(display)
+        if proc is None or proc.poll() is not None:
+           # The server died, replace it
+           logger.warning('Virtual X server %s is gone, starting a new one', display)
+           with self.lock:
+               self.servers.pop(display, None)
+           display = self._start_server()
+        logger.debug('Leasing display '+display)
+        try:
+            yield display
+        finally:
+            logger.debug('Releasing display '+display)
+            self.free.put(self._reset(display))
+
+
+def lease_env(display, env=None):
+    """Returns a copy of the environment that makes the tools use the leased display"""
+    env = dict(os.environ if env is None else env)
+    env['DISPLAY'] = display
+    env[LEASE_ENV] = display
+    return env
@@ -0,0 +1,414 @@
+"""Fast DRC pre-check
+
+A geometric DRC computed from the .kicad_pcb file, without pcbnew. It is
+much faster than the GUI DRC and can be used to reject a board before
+running it. Checks:
+- Clearance between tracks, vias and pads of different nets, using the
+  clearance of their net classes
+- Minimum track width
+- Minimum annular ring of vias and plated holes
+- Clearance between the copper and the board edges
+
+All the copper items are handled as segments with a radius (a via is a
+zero length segment), so the distance is the segment distance minus both
+radii. Rectangular pads are approximated by the rounded pad that fits
+inside them, so errors at their corners can be missed, but no false
+errors are reported. Zones and the connectivity aren't checked.
+
+The candidate pairs are found using a uniform grid, the distances are
+computed with NumPy for all the pairs at once.
+
+The report uses the format of the pcbnew DRC report, so it can be read
+by pcbnew_ui.parse_drc.
+"""
+import math
+import time
+
+import numpy as np
+
+from kicad_auto import sexp
+from kicad_auto.kicad_pcb import (
+    find,
+    get_number,
+    get_point,
+    get_layer,
+    module_transform,
+    edge_segments,
+    EDGE_SECTIONS,
+    GR_SHAPES,
+)
+
+from kicad_auto import log
+logger = log.get_logger(__name__)
+
+SECTIONS = ('layers', 'setup', 'net', 'net_class', 'segment', 'via', 'module') + GR_SHAPES
+# Item kinds
+TRACK = 0
+VIA = 1
+PAD = 2
+HOLE = 3
+EDGE = 4
+KIND_NAMES = ('Track', 'Via', 'Pad', 'Hole', 'Board edge')
+# Copper layers are 0 (F.Cu) to 31 (B.Cu)
+MAX_COPPER = 32
+# Distances are in mm, smaller differences are rounding errors
+EPSILON = 1e-6
+# Limits for the grid cell size, in mm
+MIN_CELL = 0.5
+MAX_CELL = 5.0
+
+
+class DrcRules(object):
+    """Limits for the checks, the None values are taken from the PCB"""
+    def __init__(self, min_track_width=None, min_annular_ring=None, edge_clearance=None):
+        self.min_track_width = min_track_width
+        self.min_annular_ring = min_annular_ring
+        # None means the clearance of the net class of each item
+        self.edge_clearance = edge_clearance
+
+
+class DrcError(object):
+    def __init__(self, message, items):
+        self.message = message
+        # List of ((x, y), description)
+        self.items = items
+
+
+class _Items(object):
+    """The copper items, stored in lists and converted to arrays"""
+    def __init__(self):
+        self.ax = []
+        self.ay = []
+        self.bx = []
+        self.by = []
+        self.r = []
+        self.net = []
+        self.clearance = []
+        self.layers = []
+        self.kind = []
+        self.desc = []
+
+    def add(self, a, b, r, net, clearance, layers, kind, desc):
+        self.ax.append(a[0])
+        self.ay.append(a[1])
+        self.bx.append(b[0])
+        self.by.append(b[1])
+        self.r.append(r)
+        self.net.append(net)
+        self.clearance.append(clearance)
+        self.layers.append(layers)
+        self.kind.append(kind)
+        self.desc.append(desc)
+
+    def to_arrays(self):
+        for name in ('ax', 'ay', 'bx', 'by', 'r', 'clearance'):
+            setattr(self, name, np.array(getattr(self, name), dtype=np.float64))
+        for name in ('net', 'layers', 'kind'):
+            setattr(self, name, np.array(getattr(self, name), dtype=np.int64))
+
+
+class _Board(object):
+    def __init__(self, pcb_file):
+        # Read all the needed sections in one pass
+        sections = {}
+        for section in sexp.iter_sections(pcb_file, SECTIONS):
+            sections.setdefault(section[0], []).append(section)
+        if 'layers' not in sections:
+           raise sexp.SexpError(pcb_file+' has no layers table')
+        self.layer_ids = {}
+        for layer in sections['layers'][0][1:]:
+            if isinstance(layer, list) and len(layer) >= 2 and layer[0].isdigit() and int(layer[0]) < MAX_COPPER:
+               self.layer_ids[layer[1]] = int(layer[0])
+        self.layer_names = {id: name for name, id in self.layer_ids.items()}
+        self.all_copper = 0
+        for id in self.layer_ids.values():
+            self.all_copper |= 1 << id
+        self.setup = sections.get('setup', [['setup']])[0]
+        # Net code -> name
+        self.nets = {int(n[1]): n[2] if len(n) > 2 else '' for n in sections.get('net', []) if len(n) > 1}
+        # Net name -> clearance
+        self.net_clearance = {}
+        self.default_clearance = get_number(self.setup, 'trace_clearance') or 0
+        for net_class in sections.get('net_class', []):
+            clearance = get_number(net_class, 'clearance')
+            if clearance is None:
+               continue
+            if net_class[1] == 'Default':
+               self.default_clearance = clearance
+            for item in net_class:
+                if isinstance(item, list) and len(item) > 1 and item[0] == 'add_net':
+                   self.net_clearance[item[1]] = clearance
+        self.sections = sections
+
+    def clearance(self, net):
+        return self.net_clearance.get(self.nets.get(net), self.default_clearance)
+
+    def layer_mask(self, names):
+        mask = 0
+        for name in names:
+            if name == '*.Cu':
+               mask |= self.all_copper
+            elif name == 'F&B.Cu':
+               mask |= self.all_copper & (1 | (1 << (MAX_COPPER - 1)))
+            elif name in self.layer_ids:
+               mask |= 1 << self.layer_ids[name]
+        return mask
+
+    def mask_names(self, mask):
+        names = [self.layer_names[id] for id in sorted(self.layer_names) if mask & (1 << id)]
+        return 'all copper layers' if mask == self.all_copper and len(names) > 2 else ', '.join(names)
+
+    def net_name(self, net):
+        return self.nets.get(net) or '<no net>'
+
+
+def _layers_of(section):
+    item = find(section, 'layers')
+    return item[1:] if item is not None else []
+
+
+def _pad_capsule(center, size, angle):
+    """Converts a pad to (start, end, radius), using its angle in degrees"""
+    w, h = size
+    if w >= h:
+       half = (w - h)/2.0
+       r = h/2.0
+       dx, dy = math.cos(math.radians(angle)), -math.sin(math.radians(angle))
+    else:
+       half = (h - w)/2.0
+       r = w/2.0
+       # Local Y axis, rotated clockwise on screen
+       dx, dy = math.sin(math.radians(angle)), math.cos(math.radians(angle))
+    return (center[0] - dx*half, center[1] - dy*half), (center[0] + dx*half, center[1] + dy*half), r
+
+
+def _collect(board, rules, errors):
+    """Creates the copper items, reports the width and annular ring errors"""
+    items = _Items()
+    for seg in board.sections.get('segment', []):
+        a = get_point(seg, 'start')
+        b = get_point(seg, 'end')
+        width = get_number(seg, 'width') or 0
+        net = int(get_number(seg, 'net') or 0)
+        layer = get_layer(seg)
+        mask = board.layer_mask([layer])
+        if not mask:
+           continue
+        desc = 'Track {:.3f} mm on {}, net {}'.format(width, layer, board.net_name(net))
+        if width < rules.min_track_width - EPSILON:
+           errors.append(DrcError('Track too narrow ({:.3f} mm < {:.3f} mm)'.format(width, rules.min_track_width),
+                                  [(a, desc)]))
+        items.add(a, b, width/2.0, net, board.clearance(net), mask, TRACK, desc)
+
+    for via in board.sections.get('via', []):
+        pos = get_point(via, 'at')
+        size = get_number(via, 'size') or 0
+        drill = get_number(via, 'drill') or 0
+        net = int(get_number(via, 'net') or 0)
+        ids = [board.layer_ids[name] for name in _layers_of(via) if name in board.layer_ids]
+        if not ids:
+           continue
+        # Vias cover all the layers between the first and the last
+        mask = 0
+        for id in board.layer_names:
+            if min(ids) <= id <= max(ids):
+               mask |= 1 << id
+        desc = 'Via {:.3f}/{:.3f} mm, net {}'.format(size, drill, board.net_name(net))
+        ring = (size - drill)/2.0
+        if ring < rules.min_annular_ring - EPSILON:
+           errors.append(DrcError('Annular ring too small ({:.3f} mm < {:.3f} mm)'.
+                                  format(ring, rules.min_annular_ring), [(pos, desc)]))
+        items.add(pos, pos, size/2.0, net, board.clearance(net), mask, VIA, desc)
+
+    for module in board.sections.get('module', []):
+        transform = None
+        ref = next((i[2] for i in module if isinstance(i, list) and len(i) > 2 and i[0] == 'fp_text' and
+                    i[1] == 'reference'), module[1])
+        for pad in module:
+            if not isinstance(pad, list) or len(pad) < 4 or pad[0] != 'pad':
+               continue
+            transform = transform or module_transform(module)
+            at = find(pad, 'at')
+            center = transform(float(at[1]), float(at[2]))
+            # The pad angle already includes the module rotation
+            angle = float(at[3]) if len(at) > 3 else 0
+            size = get_point(pad, 'size')
+            drill = find(pad, 'drill')
+            # (drill D) or (drill oval W H), the smallest dimension is used
+            drill_sizes = [float(v) for v in drill[1:] if not isinstance(v, list) and v != 'oval'] if drill else []
+            drill_size = min(drill_sizes) if drill_sizes else 0
+            mask = board.layer_mask(_layers_of(pad))
+            desc_pos = 'Pad {} of {}'.format(pad[1], ref)
+            if pad[2] == 'np_thru_hole':
+               # The hole, without copper
+               if drill_size:
+                  items.add(center, center, drill_size/2.0, -1, 0, board.all_copper, HOLE,
+                            desc_pos+' (NPTH)')
+               continue
+            if not mask:
+               continue
+            net = int(get_number(pad, 'net') or 0)
+            desc = '{} on {}, net {}'.format(desc_pos, board.mask_names(mask), board.net_name(net))
+            if pad[2] == 'thru_hole' and drill_size:
+               ring = (min(size) - drill_size)/2.0
+               if ring < rules.min_annular_ring - EPSILON:
+                  errors.append(DrcError('Annular ring too small ({:.3f} mm < {:.3f} mm)'.
+                                         format(ring, rules.min_annular_ring), [(center, desc)]))
+            a, b, r = _pad_capsule(center, size, angle)
+            items.add(a, b, r, net, board.clearance(net), mask, PAD, desc)
+
+    edge_sections = [s for name in EDGE_SECTIONS for s in board.sections.get(name, [])]
+    for a, b in edge_segments(edge_sections):
+        items.add(a, b, 0, -2, 0, board.all_copper, EDGE, 'Board edge')
+    items.to_arrays()
+    return items
+
+
+def _point_segment_distance(px, py, ax, ay, bx, by):
+    vx = bx - ax
+    vy = by - ay
+    l2 = vx*vx + vy*vy
+    t = ((px - ax)*vx + (py - ay)*vy)/np.where(l2 > 0, l2, 1)
+    t = np.clip(t, 0, 1)
+    return np.hypot(ax + t*vx - px, ay + t*vy - py)
+
+
+def segment_distances(ax, ay, bx, by, cx, cy, dx, dy):
+    """Distances between the segments a-b and c-d (arrays)"""
+    dist = np.minimum(np.minimum(_point_segment_distance(ax, ay, cx, cy, dx, dy),
+                                 _point_segment_distance(bx, by, cx, cy, dx, dy)),
+                      np.minimum(_point_segment_distance(cx, cy, ax, ay, bx, by),
+                                 _point_segment_distance(dx, dy, ax, ay, bx, by)))
+    # Crossing segments
+    o1 = (bx - ax)*(cy - ay) - (by - ay)*(cx - ax)
+    o2 = (bx - ax)*(dy - ay) - (by - ay)*(dx - ax)
+    o3 = (dx - cx)*(ay - cy) - (dy - cy)*(ax - cx)
+    o4 = (dx - cx)*(by - cy) - (dy - cy)*(bx - cx)
+    dist[(o1*o2 < 0) & (o3*o4 < 0)] = 0
+    return dist
+
+
+def candidate_pairs(x0, y0, x1, y1, layers, cell=None):
+    """Pairs of items (i < j) whose boxes share a grid cell in a common layer.
+       Returns two arrays of indices."""
+    if not len(x0):
+       return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    if cell is None:
+       # Most items should use one cell
+       cell = float(np.clip(np.median(np.maximum(x1 - x0, y1 - y0)), MIN_CELL, MAX_CELL))
+    ox = x0.min()
+    oy = y0.min()
+    cx0 = ((x0 - ox)//cell).astype(np.int64)
+    cy0 = ((y0 - oy)//cell).astype(np.int64)
+    cx1 = ((x1 - ox)//cell).astype(np.int64)
+    cy1 = ((y1 - oy)//cell).astype(np.int64)
+    width = int(cx1.max()) + 1
+    height = int(cy1.max()) + 1
+    # One entry for each item in each of its layers
+    item, layer = np.nonzero((layers[:, None] >> np.arange(MAX_COPPER)) & 1)
+    nx = (cx1 - cx0 + 1)[item]
+    ny = (cy1 - cy0 + 1)[item]
+    # One entry for each cell covered by the item
+    counts = nx*ny
+    total = int(counts.sum())
+    starts = np.cumsum(counts) - counts
+    k = np.arange(total, dtype=np.int64) - np.repeat(starts, counts)
+    nx = np.repeat(nx, counts)
+    item = np.repeat(item, counts)
+    layer = np.repeat(layer, counts)
+    key = (layer*height + cy0[item] + k//nx)*width + cx0[item] + k % nx
+    # Group the items of each cell
+    order = np.argsort(key, kind='stable')
+    key = key[order]
+    item = item[order]
+    group_end = np.searchsorted(key, key, side='right')
+    # Each entry is paired with the following ones in its group
+    counts = group_end - np.arange(len(key)) - 1
+    total = int(counts.sum())
+    first = np.repeat(np.arange(len(key)), counts)
+    second = first + 1 + np.arange(total, dtype=np.int64) - np.repeat(np.cumsum(counts) - counts, counts)
+    i = item[first]
+    j = item[second]
+    lo = np.minimum(i, j)
+    hi = np.maximum(i, j)
+    # The same pair can share more than one cell
+    code = np.unique(lo*len(x0) + hi)
+    return code//len(x0), code % len(x0)
+
+
+def _check_clearance(items, rules, errors):
+    if not len(items.r):
+       return
+    # Search radius for the boxes
+    margin = max(items.clearance.max(), rules.edge_clearance or 0)/2.0
+    x0 = np.minimum(items.ax, items.bx) - items.r - margin
+    y0 = np.minimum(items.ay, items.by) - items.r - margin
+    x1 = np.maximum(items.ax, items.bx) + items.r + margin
+    y1 = np.maximum(items.ay, items.by) + items.r + margin
+    i, j = candidate_pairs(x0, y0, x1, y1, items.layers)
+    logger.debug('{} items, {} candidate pairs'.format(len(items.r), len(i)))
+    kind_i = items.kind[i]
+    kind_j = items.kind[j]
+    is_edge = (kind_i == EDGE) | (kind_j == EDGE)
+    is_hole = (kind_i == HOLE) | (kind_j == HOLE)
+    # Items of the same net are connected, holes can be close to the edges
+    keep = ((items.net[i] != items.net[j]) | (items.net[i] == -1)) & ~(is_edge & ((kind_i == kind_j) | is_hole))
+    # Boxes overlap
+    keep &= (x0[i] <= x1[j]) & (x0[j] <= x1[i]) & (y0[i] <= y1[j]) & (y0[j] <= y1[i])
+    i = i[keep]
+    j = j[keep]
+    is_edge = is_edge[keep]
+    required = np.maximum(items.clearance[i], items.clearance[j])
+    if rules.edge_clearance is not None:
+       required[is_edge] = rules.edge_clearance
+    dist = segment_distances(items.ax[i], items.ay[i], items.bx[i], items.by[i],
+                             items.ax[j], items.ay[j], items.bx[j], items.by[j]) - items.r[i] - items.r[j]
+    bad = np.nonzero(dist < required - EPSILON)[0]
+    for n in bad:
+        a = int(i[n])
+        b = int(j[n])
+        if items.kind[a] > items.kind[b]:
+           a, b = b, a
+        errors.append(DrcError('{} too close to {} ({:.3f} mm < {:.3f} mm)'.
+                               format(KIND_NAMES[items.kind[a]], KIND_NAMES[items.kind[b]], max(dist[n], 0),
+                                      required[n]),
+                               [((items.ax[a], items.ay[a]), items.desc[a]),
+                                ((items.ax[b], items.ay[b]), items.desc[b])]))
+
+
+def check(pcb_file, rules=None):
+    """Runs the checks, returns a list of DrcError.
+       Raises ValueError (SexpError) if the file is malformed."""
+    start = time.time()
+    board = _Board(pcb_file)
+    rules = DrcRules(rules.min_track_width, rules.min_annular_ring, rules.edge_clearance) if rules else DrcRules()
+    if rules.min_track_width is None:
+       rules.min_track_width = get_number(board.setup, 'trace_min') or 0
+    if rules.min_annular_ring is None:
+       rules.min_annular_ring = get_number(board.setup, 'via_min_annulus')
+       if rules.min_annular_ring is None:
+          via_min_size = get_number(board.setup, 'via_min_size')
+          via_min_drill = get_number(board.setup, 'via_min_drill')
+          rules.min_annular_ring = (via_min_size - via_min_drill)/2.0 if via_min_size and via_min_drill else 0
+    if rules.edge_clearance is None:
+       rules.edge_clearance = get_number(board.setup, 'copper_edge_clearance')
+    errors = []
+    items = _collect(board, rules, errors)
+    _check_clearance(items, rules, errors)
+    logger.debug('DRC pre-check took {:.3f} s'.format(time.time() - start))
+    return errors
+
+
+def write_report(pcb_file, errors, report_file):
+    """Writes the errors using the format of the pcbnew DRC report"""
+    with open(report_file, 'w') as f:
+         f.write('** Drc report for {} **\n'.format(pcb_file))
+         f.write('** Created on {} **\n'.format(time.strftime('%Y-%m-%d %H:%M:%S')))
+         f.write('** Fast DRC pre-check, zones and connectivity are not checked **\n')
+         f.write('\n** Found {} DRC errors **\n'.format(len(errors)))
+         for error in errors:
+             f.write(error.message+'\n')
+             for (x, y), desc in error.items:
+                 f.write('    @({:.3f} mm, {:.3f} mm): {}\n'.format(x, y, desc))
+         f.write('\n** Found 0 unconnected pads **\n')
+         f.write('\n** End of Report **\n')
@@ -0,0 +1,404 @@
+"""Eeschema UI sequences
+
+Sequences of UI actions for eeschema, used by eeschema_do and the API.
+They assume eeschema is already running in the virtual X server.
+The options are an object with the same attributes eeschema_do uses
+(i.e. api.EeschemaOptions).
+"""
+import json
+import os
+import re
+
+from kicad_auto import cache
+from kicad_auto import file_util
+from kicad_auto.pdf_util import replace_pages
+from kicad_auto.schematic import (load_hierarchy, hash_file)
+from kicad_auto.ui_automation import (
+    xdotool,
+    wait_for_window,
+    clipboard_store
+)
+
+from kicad_auto import log
+logger = log.get_logger(__name__)
+
+# Return error codes
+# Negative values are ERC errors
+BATCH_FAILED=4
+# Plot formats, in the order used by eeschema (index)
+PLOT_FORMATS=['hpgl','---','ps','dxf','pdf','svg']
+
+
+def create_config(cfg_dir, file_format='pdf'):
+    """Creates an eeschema and KiCad common configuration suitable for the automation"""
+    config_file = os.path.join(cfg_dir, 'eeschema')
+    logger.debug('Eeschema config: '+config_file)
+    text_file = open(config_file,"w")
+    text_file.write('RescueNeverShow=1\n')
+    try:
+        # HPGL:0 ??:1 PS:2 DXF:3 PDF:4 SVG:5
+        index=PLOT_FORMATS.index(file_format.lower())
+        logger.debug('Selecting plot format %s (%d)',file_format,index)
+    except (ValueError, AttributeError):
+        index=4
+    text_file.write('PlotFormat=%d\n' % index)
+    text_file.close()
+
+    common_config_file = os.path.join(cfg_dir, 'kicad_common')
+    logger.debug('Kicad common config: '+common_config_file)
+    text_file = open(common_config_file,"w")
+    text_file.write('ShowEnvVarWarningDialog=0\n')
+    text_file.write('Editor=/bin/cat\n')
+    text_file.close()
+
+
+def dismiss_library_error():
+    # The "Error" modal pops up if libraries required by the schematic have
+    # not been found. This can be ignored as all symbols are placed inside the
+    # *-cache.lib file:
+    # There -should- be a way to disable it, but I haven't the magic to drop in the config file yet
+    try:
+        nf_title = 'Error'
+        wait_for_window(nf_title, nf_title, 3)
+
+        logger.info('Dismiss eeschema library warning modal')
+        xdotool(['search', '--onlyvisible', '--name', nf_title, 'windowfocus'])
+        xdotool(['key', 'Escape'])
+    except RuntimeError:
+        pass
+
+
+def dismiss_library_warning():
+    # The "Not Found" window pops up if libraries required by the schematic have
+    # not been found. This can be ignored as all symbols are placed inside the
+    # *-cache.lib file:
+    try:
+        nf_title = 'Not Found'
+        wait_for_window(nf_title, nf_title, 3)
+
+        logger.info('Dismiss eeschema library warning window')
+        xdotool(['search', '--onlyvisible', '--name', nf_title, 'windowfocus'])
+        xdotool(['key', 'Return'])
+    except RuntimeError:
+        pass
+
+def dismiss_newer_version():
+    # The "Not Found" window pops up if libraries required by the schematic have
+    # not been found. This can be ignored as all symbols are placed inside the
+    # *-cache.lib file:
+    try:
+        logger.info('Dismiss schematic version notification')
+        wait_for_window('Newer schematic version notification', 'Info', 3)
+
+        xdotool(['key', 'Return'])
+    except RuntimeError:
+        pass
+
+
+def dismiss_remap_helper():
+    # The "Remap Symbols" windows pop up if the uses the project symbol library
+    # the older list look up method for loading library symbols.
+    # This can be ignored as we're just trying to output data and don't
+    # want to mess with the actual project.
+    try:
+        logger.info('Dismiss schematic symbol remapping')
+        wait_for_window('Remap Symbols', 'Remap', 3)
+
+        xdotool(['key', 'Escape'])
+    except RuntimeError:
+        pass
+
+
+def eeschema_skip_errors():
+    #dismiss_newer_version()
+    #dismiss_remap_helper();
+    #dismiss_library_warning()
+    #dismiss_library_error()
+    return 0
+
+def eeschema_plot_schematic(output_dir, output_file, all_pages, pid):
+    clipboard_store(output_dir)
+
+    wait_for_window('Main eeschema window', 'Eeschema.*\.sch')
+
+    logger.info('Open File->pLot')
+    xdotool(['key', 'alt+f', 'l'])
+
+    wait_for_window('plot', 'Plot')
+
+    logger.info('Paste output directory')
+    xdotool(['key', 'ctrl+v'])
+
+    logger.info('Move to the "plot" button')
+    command_list = ['key', 'Tab', 'Tab', 'Tab', 'Tab', 'Tab', 'Tab', 'Tab',
+                    'Tab', 'Tab', 'Tab', 'Tab', 'Tab', 'Tab', 'Tab', ]
+    if not all_pages:   # all pages is default option
+       command_list.extend(['Tab'])
+    xdotool(command_list)
+
+    logger.info('Plot')
+    xdotool(['key', 'Return'])
+
+    logger.info('Wait for plot file creation')
+    file_util.wait_for_file_created_by_process(pid, output_file)
+
+    logger.info('Closing window')
+    xdotool(['key', 'Escape'])
+
+def eeschema_navigate_to_page(page):
+    """Shows the page using the hierarchy navigator"""
+    wait_for_window('Main eeschema window', 'Eeschema.*\.sch')
+
+    logger.info('Open View->Show Hierarchical Navigator')
+    xdotool(['key', 'alt+v', 'h'])
+
+    wait_for_window('Hierarchy navigator', 'Navigator')
+    logger.info('Select page %d', page)
+    # The tree is fully expanded, the pages are in order
+    xdotool(['key', 'Home'] + ['Down']*(page-1) + ['Return'])
+
+    wait_for_window('Main eeschema window', 'Eeschema.*\.sch')
+
+def eeschema_export_incremental(sch_file, options, output_dir, output_file_no_ext, pid):
+    """Plots only the pages whose sheet changed since the last export.
+       Falls back to a full plot when the hierarchy, the libraries or the
+       options changed."""
+    ext = options.file_format.lower()
+    root_name = os.path.basename(output_file_no_ext)
+    output_file = output_file_no_ext+'.'+ext
+    pages = load_hierarchy(sch_file)
+    if not options.all_pages:
+       # Only the root page is plotted
+       pages = pages[:1]
+    # A multipage PDF, the rest of the formats use one file for each page
+    single_file = options.all_pages and ext == 'pdf'
+    state_file = os.path.join(output_dir, '.'+root_name+'_sheets.json')
+    # The sheets are relative to the schematic, not to the current dir
+    sch_dir = os.path.dirname(os.path.abspath(sch_file))
+    sheet_names = {p.number: os.path.relpath(p.file_name, sch_dir) for p in pages}
+    state = {'format': ext,
+             'all_pages': options.all_pages,
+             'pages': [p.path+':'+sheet_names[p.number] for p in pages],
+             'libs': [hash_file(f) for f in cache.library_inputs(sch_file) if f],
+             'sheets': {sheet_names[p.number]: hash_file(p.file_name) for p in pages}}
+
+    old_state = None
+    if os.path.isfile(state_file):
+       with open(state_file) as f:
+            old_state = json.load(f)
+       # Can't be used if we plot again
+       os.remove(state_file)
+    if single_file:
+       outputs_ok = os.path.isfile(output_file)
+    else:
+       outputs_ok = all(os.path.isfile(os.path.join(output_dir, p.plot_name(root_name)+'.'+ext)) for p in pages)
+    if (old_state is None or not outputs_ok or
+        any(old_state.get(k) != state[k] for k in ('format', 'all_pages', 'pages', 'libs'))):
+       logger.info('Plotting all the pages')
+       if os.path.exists(output_file):
+          os.remove(output_file)
+       eeschema_plot_schematic(output_dir, output_file, options.all_pages, pid)
+    else:
+       changed = [p for p in pages if old_state['sheets'].get(sheet_names[p.number]) !=
+                                      state['sheets'][sheet_names[p.number]]]
+       logger.info('Changed pages: '+(', '.join(p.path for p in changed) or 'none'))
+       if changed and single_file:
+          # The root page is plotted using the same name
+          old_output = output_file+'.old'
+          os.replace(output_file, old_output)
+          page_files = {}
+          done = False
+          try:
+              for p in changed:
+                  page_file = os.path.join(output_dir, p.plot_name(root_name)+'.'+ext)
+                  if os.path.exists(page_file):
+                     os.remove(page_file)
+                  eeschema_navigate_to_page(p.number)
+                  eeschema_plot_schematic(output_dir, page_file, False, pid)
+                  page_files[p.number-1] = page_file
+              replace_pages(old_output, page_files, output_file)
+              done = True
+          finally:
+              for f in page_files.values():
+                  if f != output_file and os.path.isfile(f):
+                     os.remove(f)
+              if done:
+                 os.remove(old_output)
+              else:
+                 os.replace(old_output, output_file)
+       else:
+          for p in changed:
+              page_file = os.path.join(output_dir, p.plot_name(root_name)+'.'+ext)
+              if os.path.exists(page_file):
+                 os.remove(page_file)
+              eeschema_navigate_to_page(p.number)
+              eeschema_plot_schematic(output_dir, page_file, False, pid)
+    with open(state_file, 'w') as f:
+         json.dump(state, f, indent=1)
+
+def eeschema_parse_erc(erc_file, warning_as_error = False):
+    with open(erc_file, 'r') as f:
+        lines = f.read().splitlines()
+        last_line = lines[-1]
+
+    logger.debug('Last line: '+last_line)
+    m = re.search('^ \*\* ERC messages: ([0-9]+) +Errors ([0-9]+) +Warnings ([0-9]+)+$', last_line)
+    messages = m.group(1)
+    errors = m.group(2)
+    warnings = m.group(3)
+
+    if warning_as_error:
+        return int(errors) + int(warnings), 0
+    return int(errors), int(warnings)
+
+def eeschema_run_erc_schematic(erc_file, pid):
+
+    # Do this now since we have to wait for KiCad anyway
+    clipboard_store(erc_file)
+
+    wait_for_window('Main eeschema window', 'Eeschema.*\.sch', 25)
+
+    logger.info('Open Tools->Electrical Rules Checker')
+    xdotool(['key', 'alt+i', 'c'])
+
+    wait_for_window('Electrical Rules Checker dialog', 'Electrical Rules Checker')
+    xdotool(['key', 'Tab', 'Tab', 'Tab', 'Tab', 'space', 'Return' ])
+
+    wait_for_window('ERC File save dialog', 'ERC File')
+    logger.info('Pasting output file')
+    xdotool(['key', 'ctrl+v'])
+    # KiCad adds .erc
+    erc_file = erc_file + '.erc'
+    if os.path.exists(erc_file):
+       os.remove(erc_file)
+
+    logger.info('Run ERC')
+    xdotool(['key', 'Return'])
+
+    logger.info('Wait for ERC file creation')
+    file_util.wait_for_file_created_by_process(pid, erc_file)
+
+    logger.info('Exit ERC')
+    xdotool(['key', 'shift+Tab', 'Return'])
+
+    return erc_file
+
+
+def eeschema_netlist_commands(net_file, pid):
+    # Do this now since we have to wait for KiCad anyway
+    clipboard_store(net_file)
+
+    wait_for_window('Main eeschema window', 'Eeschema.*\.sch')
+
+    logger.info('Open Tools->Generate Netlist File')
+    xdotool(['key', 'alt+t', 'n'])
+
+    wait_for_window('Netlist dialog', 'Netlist')
+    xdotool(['key','Tab','Tab','Return'])
+
+    wait_for_window('Netlist File save dialog', 'Save Netlist File')
+    logger.info('Pasting output file')
+    xdotool(['key', 'ctrl+v'])
+    # KiCad adds .net
+    net_file = net_file + '.net'
+    if os.path.exists(net_file):
+       os.remove(net_file)
+
+    logger.info('Generate Netlist')
+    xdotool(['key', 'Return'])
+
+    logger.info('Wait for Netlist file creation')
+    file_util.wait_for_file_created_by_process(pid, net_file)
+
+    return net_file
+
+
+def eeschema_bom_xml_commands(output_file, pid):
+    wait_for_window('Main eeschema window', 'Eeschema.*\.sch')
+
+    clipboard_store('xsltproc -o "'+output_file + '" "/usr/share/kicad/plugins/bom2grouped_csv.xsl" "%I"');
+
+    logger.info('Open Tools->Generate Bill of Materials')
+    xdotool(['key', 'alt+t', 'm' ])
+
+    wait_for_window('Bill of Material dialog', 'Bill of Material')
+    logger.info('Paste xslt command')
+    xdotool(['key', 'Tab', 'Tab', 'Tab', 'Tab', 'Tab', 'Tab', 'ctrl+v', 'Return']);
+
+    logger.info('Wait for BoM file creation')
+    file_util.wait_for_file_created_by_process(pid, output_file)
+
+    # The dialog stays open, the next batch command needs the main window
+    logger.info('Close the BoM dialog')
+    xdotool(['key', 'Escape'])
+    wait_for_window('Main eeschema window', 'Eeschema.*\.sch')
+
+
+def eeschema_run_command(command, options, sch_file, output_dir, output_file_no_ext, pid):
+    """Run one command in the already running eeschema, returns the exit code"""
+    if command == 'export' and options.incremental:
+       eeschema_export_incremental(sch_file, options, output_dir, output_file_no_ext, pid)
+    elif command == 'export':
+       # Export
+       output_file = output_file_no_ext+'.'+options.file_format.lower()
+       if os.path.exists(output_file):
+          logger.debug('Removing old file')
+          os.remove(output_file)
+       eeschema_plot_schematic(output_dir, output_file, options.all_pages, pid)
+    elif command == 'netlist':
+       # Netlist
+       eeschema_netlist_commands(output_file_no_ext, pid)
+    elif command == 'bom_xml':
+       # BoM XML
+       output_file = output_file_no_ext+'.csv'
+       eeschema_bom_xml_commands(output_file, pid)
+    elif command == 'run_erc':
+       # Run ERC
+       erc_file = eeschema_run_erc_schematic(output_file_no_ext, pid)
+       errors, warnings = eeschema_parse_erc(erc_file, options.warnings_as_errors)
+       if errors > 0:
+          logger.error(str(errors)+' ERC errors detected')
+          return -errors
+       if warnings > 0:
+          logger.warning(str(warnings)+' ERC warnings detected')
+       logger.info('No errors');
+    return 0
+
+def eeschema_run_batch(commands, options, sch_file, output_dir, output_file_no_ext, pid):
+    """Run all the requested commands using the same eeschema instance.
+       A failed command doesn't stop the rest, the worst result is returned."""
+    # Only the first command pays the eeschema start-up
+    wait_for_window('Main eeschema window', 'Eeschema.*\.sch', 25)
+    failed = []
+    erc_ret = 0
+    for command in commands:
+        logger.info('Batch command: '+command)
+        try:
+            ret = eeschema_run_command(command, options, sch_file, output_dir, output_file_no_ext, pid)
+            if ret:
+               erc_ret = ret
+        except RuntimeError as e:
+            logger.error('%s failed: %s', command, str(e))
+            failed.append(command)
+            # Try to get back to the main window for the next command
+            xdotool(['key', 'Escape', 'Escape'])
+    if failed:
+       logger.error('Failed batch commands: '+', '.join(failed))
+       return BATCH_FAILED
+    return erc_ret
+
+def eeschema_outputs(commands, options, output_file_no_ext):
+    """Patterns for the files generated by the commands, relative to the output dir"""
+    name = os.path.basename(output_file_no_ext)
+    patterns = []
+    for command in commands:
+        if command == 'export':
+           # One file for each sheet if not all_pages, all of them start with the name
+           patterns.append(name+'*.'+options.file_format.lower())
+        elif command == 'netlist':
+           patterns.append(name+'.net')
+        elif command == 'bom_xml':
+           patterns.append(name+'.'+options.bom_format)
+        elif command == 'run_erc':
+           patterns.append(name+'.erc')
+    return patterns
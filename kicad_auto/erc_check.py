@@ -0,0 +1,162 @@
+"""Fast ERC pre-check
+
+An electrical rules check computed from the legacy .sch files and the
+-cache.lib, without eeschema. It uses the nets solved by
+sch_connectivity and checks:
+- Unconnected pins without a no-connect flag
+- Conflicts between the pins of a net (i.e. two outputs), using the
+  default eeschema pin conflicts matrix
+- Inputs and power inputs not driven (i.e. power nets without PWR_FLAG)
+- No-connect flags connected to more than one pin
+- Hierarchical labels without sheet pin (and the opposite)
+
+The report uses the format of the eeschema .erc file, ending with the
+` ** ERC messages:` line read by eeschema_ui.eeschema_parse_erc.
+"""
+import time
+
+from kicad_auto.sch_connectivity import Design
+
+from kicad_auto import log
+logger = log.get_logger(__name__)
+
+# Error codes used by eeschema
+ERCE_PIN_NOT_CONNECTED = 2
+ERCE_PIN_NOT_DRIVEN = 3
+ERCE_PIN_TO_PIN_WARNING = 4
+ERCE_PIN_TO_PIN_ERROR = 5
+ERCE_HIERACHICAL_LABEL = 6
+ERCE_NOCONNECT_CONNECTED = 7
+OK = 0
+WAR = 1
+ERR = 2
+# Default pin conflicts matrix
+PIN_ORDER = 'IOBTPUWwCEN'
+PIN_MAP = (
+    # I    O    B    T    P    U    W    w    C    E    N
+    (OK,  OK,  OK,  OK,  OK,  WAR, OK,  OK,  OK,  OK,  ERR),  # Input
+    (OK,  ERR, OK,  WAR, OK,  WAR, OK,  ERR, ERR, ERR, ERR),  # Output
+    (OK,  OK,  OK,  OK,  OK,  WAR, OK,  WAR, OK,  WAR, ERR),  # BiDi
+    (OK,  WAR, OK,  OK,  OK,  WAR, WAR, ERR, WAR, WAR, ERR),  # 3state
+    (OK,  OK,  OK,  OK,  OK,  WAR, OK,  OK,  OK,  OK,  ERR),  # Passive
+    (WAR, WAR, WAR, WAR, WAR, WAR, WAR, WAR, WAR, WAR, ERR),  # Unspecified
+    (OK,  OK,  OK,  WAR, OK,  WAR, OK,  OK,  OK,  OK,  ERR),  # Power input
+    (OK,  ERR, WAR, ERR, OK,  WAR, OK,  ERR, ERR, ERR, ERR),  # Power output
+    (OK,  ERR, OK,  WAR, OK,  WAR, OK,  ERR, OK,  OK,  ERR),  # Open collector
+    (OK,  ERR, WAR, WAR, OK,  WAR, OK,  ERR, OK,  OK,  ERR),  # Open emitter
+    (ERR, ERR, ERR, ERR, ERR, ERR, ERR, ERR, ERR, ERR, ERR),  # Not connected
+)
+# Pins that drive an input
+DRIVERS = set('OBTPUwCE')
+POWER_DRIVERS = set('w')
+
+
+class ErcMessage(object):
+    def __init__(self, code, error, sheet, position, message, detail):
+        self.code = code
+        self.error = error
+        # SheetInstance
+        self.sheet = sheet
+        # In mils
+        self.position = position
+        self.message = message
+        self.detail = detail
+
+
+def _conflict(a, b):
+    if a not in PIN_ORDER or b not in PIN_ORDER:
+       return OK
+    return PIN_MAP[PIN_ORDER.index(a)][PIN_ORDER.index(b)]
+
+
+def _check_net(net, messages):
+    pins = net.pins
+    if not pins:
+       return
+    if len(pins) == 1:
+       pin = pins[0]
+       if not net.no_connects and pin.type != 'N':
+          messages.append(ErcMessage(ERCE_PIN_NOT_CONNECTED, True, pin.sheet, pin.position,
+                                     'Pin not connected (and no connect symbol found on this pin)',
+                                     pin.describe()+' is unconnected.'))
+       return
+    if net.no_connects:
+       sheet, x, y = net.no_connects[0]
+       messages.append(ErcMessage(ERCE_NOCONNECT_CONNECTED, False, sheet, (x, y),
+                                  'A no connect symbol is connected to more than 1 pin',
+                                  'No connect symbol connected to {} pins (net {}).'.format(len(pins), net.name)))
+    # One pin of each type
+    by_type = {}
+    for pin in pins:
+        by_type.setdefault(pin.type, []).append(pin)
+    types = sorted(by_type, key=lambda t: PIN_ORDER.find(t))
+    for n, a in enumerate(types):
+        for b in types[n:]:
+            if a == b and len(by_type[a]) < 2:
+               continue
+            level = _conflict(a, b)
+            if level == OK:
+               continue
+            pin_a = by_type[a][0]
+            pin_b = by_type[b][1 if a == b else 0]
+            messages.append(ErcMessage(ERCE_PIN_TO_PIN_ERROR if level == ERR else ERCE_PIN_TO_PIN_WARNING,
+                                       level == ERR, pin_a.sheet, pin_a.position,
+                                       'Conflict problem between pins. Severity: '+('ERROR' if level == ERR
+                                                                                    else 'WARNING'),
+                                       '{} connected to {} (net {}).'.format(pin_a.describe(), pin_b.describe(),
+                                                                              net.name)))
+    present = set(by_type)
+    if 'W' in present and not present & POWER_DRIVERS:
+       pin = by_type['W'][0]
+       messages.append(ErcMessage(ERCE_PIN_NOT_DRIVEN, True, pin.sheet, pin.position,
+                                  'Pin connected to some others pins but no pin to drive it',
+                                  '{} is not driven (net {}).'.format(pin.describe(), net.name)))
+    if 'I' in present and not present & DRIVERS:
+       pin = by_type['I'][0]
+       messages.append(ErcMessage(ERCE_PIN_NOT_DRIVEN, True, pin.sheet, pin.position,
+                                  'Pin connected to some others pins but no pin to drive it',
+                                  '{} is not driven (net {}).'.format(pin.describe(), net.name)))
+
+
+def check(sch_file):
+    """Runs the checks, returns a list of ErcMessage.
+       Raises ValueError (SchError) if the files are malformed."""
+    start = time.time()
+    design = Design(sch_file)
+    messages = []
+    for net in design.nets:
+        _check_net(net, messages)
+    for text, sheet, position in design.unmatched:
+        messages.append(ErcMessage(ERCE_HIERACHICAL_LABEL, True, sheet, position, 'Mismatch between hierarchical '
+                                   'labels and pins sheets', text))
+    logger.debug('ERC pre-check took {:.3f} s'.format(time.time() - start))
+    return messages
+
+
+def count(messages, warnings_as_errors=False):
+    """Returns the number of errors and warnings"""
+    errors = sum(1 for m in messages if m.error)
+    warnings = len(messages) - errors
+    if warnings_as_errors:
+       return errors + warnings, 0
+    return errors, warnings
+
+
+def write_report(messages, erc_file):
+    """Writes the messages using the format of the eeschema .erc file"""
+    errors, warnings = count(messages)
+    with open(erc_file, 'w') as f:
+         f.write('ERC report ({}, Encoding UTF8 )\n'.format(time.strftime('%a %d %b %Y %H:%M:%S')))
+         f.write('Fast ERC pre-check\n')
+         sheets = []
+         for m in messages:
+             if m.sheet not in sheets:
+                sheets.append(m.sheet)
+         for sheet in sheets:
+             f.write('\n***** Sheet {}\n'.format(sheet.name_path))
+             for m in messages:
+                 if m.sheet is sheet:
+                    f.write('ErrType({}): {}\n'.format(m.code, m.message))
+                    f.write('    @ ({:.4f} ", {:.4f} "): {}\n'.format(m.position[0]/1000.0, m.position[1]/1000.0,
+                                                                     m.detail))
+         f.write('\n ** ERC messages: {}  Errors {}  Warnings {}\n'.format(len(messages), errors, warnings))
@@ -1,8 +1,13 @@
 #!/usr/bin/env python
 
+import ctypes
+import ctypes.util
 import errno
 import os
 import logging
+import select
+import struct
+import sys
 import time
 # python3-psutil
 import psutil
@@ -10,6 +15,9 @@ import psutil
 from kicad_auto import log
 logger = log.get_logger(__name__)
 
+# Default time to wait for a file, in seconds
+wait_timeout = 5
+
 def mkdir_p(path):
     try:
         os.makedirs(path)
@@ -19,27 +27,132 @@ def mkdir_p(path):
         else:
             raise
 
-def wait_for_file_created_by_process(pid, file, timeout=5):
-    process = psutil.Process(pid)
 
+class Inotify(object):
+    """Minimal inotify(7) interface, only what we need to watch a directory"""
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_NONBLOCK = os.O_NONBLOCK
+    IN_CLOEXEC = os.O_CLOEXEC
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self):
+        self.fd = _libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+           e = ctypes.get_errno()
+           raise OSError(e, os.strerror(e))
+
+    def add_watch(self, path, mask):
+        wd = _libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+           e = ctypes.get_errno()
+           raise OSError(e, os.strerror(e), path)
+        return wd
+
+    def read(self, timeout):
+        """Returns the names from the events, waiting up to `timeout` seconds"""
+        r, w, e = select.select([self.fd], [], [], max(timeout, 0))
+        if not r:
+           return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        names = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, size = self.EVENT_HEADER.unpack_from(data, pos)
+            pos += self.EVENT_HEADER.size
+            names.append(os.fsdecode(data[pos:pos+size].rstrip(b'\0')))
+            pos += size
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def _get_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+_libc = _get_libc() if sys.platform.startswith('linux') else None
+
+
+def set_wait_timeout(timeout):
+    """Changes the default timeout for wait_for_file_created_by_process"""
+    global wait_timeout
+    wait_timeout = timeout
+
+
+def _is_open_by(process, file):
+    return any(f.path == file for f in process.open_files())
+
+
+def _done(process, file):
+    if not os.path.isfile(file):
+       logger.debug('Waiting for process to create file')
+       return False
+    if _is_open_by(process, file):
+       logger.debug('Waiting for process to close file')
+       return False
+    return True
+
+
+def _wait_inotify(process, file, timeout):
+    dir_name, name = os.path.split(file)
+    end = time.time() + timeout
+    with Inotify() as inotify:
+         inotify.add_watch(dir_name or '.', Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO)
+         # The file could be finished before we started watching
+         if _done(process, file):
+            return True
+         while True:
+             left = end - time.time()
+             if left <= 0:
+                # The file could be closed by another descriptor, without
+                # an event for us
+                return _done(process, file)
+             # Only look at the process when our file was written or moved
+             if name in inotify.read(left) and _done(process, file):
+                return True
+
+
+def _wait_polling(process, file, timeout):
     DELAY = 0.2
-    logger.debug('Waiting for file %s', file)
     for i in range(int(timeout/DELAY)):
-        open_files = process.open_files()
-        logger.debug(open_files)
-        if os.path.isfile(file):
-            file_open = False
-            for open_file in open_files:
-                if open_file.path == file:
-                    file_open = True
-            
-            if file_open:
-                logger.debug('Waiting for process to close file')
-            else:
-                return
-        else:
-            logger.debug('Waiting for process to create file')
+        if _done(process, file):
+           return True
         time.sleep(DELAY)
+    return False
 
-    raise RuntimeError('Timed out waiting for creation of %s' % file)
 
+def wait_for_file_created_by_process(pid, file, timeout=None):
+    """Waits until the process creates the file and closes it.
+       Uses inotify when available, polling otherwise."""
+    if timeout is None:
+       timeout = wait_timeout
+    process = psutil.Process(pid)
+    logger.debug('Waiting for file %s', file)
+    done = False
+    if _libc is not None:
+       try:
+           done = _wait_inotify(process, file, timeout)
+       except OSError as e:
+           # i.e. out of watches
+           logger.debug('No inotify: '+str(e))
+           done = _wait_polling(process, file, timeout)
+    else:
+       done = _wait_polling(process, file, timeout)
+    if not done:
+       raise RuntimeError('Timed out waiting for creation of %s' % file)
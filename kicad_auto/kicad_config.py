@@ -0,0 +1,70 @@
+"""KiCad configuration
+
+Each job uses its own throwaway KiCad configuration directory, so the
+user configuration is never touched and many jobs can run at once.
+"""
+import atexit
+import os
+import shutil
+import tempfile
+
+from kicad_auto import log
+logger = log.get_logger(__name__)
+
+# Where KiCad installs the default library tables
+SYSTEM_TEMPLATE_DIR = '/usr/share/kicad/template'
+# User config dir, solved by init_config_dir()
+real_config_dir = None
+
+
+def user_config_dir():
+    """The KiCad configuration dir the user really has"""
+    if os.environ.get('KICAD_CONFIG_HOME'):
+       return os.environ['KICAD_CONFIG_HOME']
+    xdg = os.environ.get('XDG_CONFIG_HOME') or os.path.join(os.environ['HOME'], '.config')
+    return os.path.join(xdg, 'kicad')
+
+
+def init_config_dir():
+    """Creates a temporary KiCad configuration dir, use config_env() to run
+       KiCad with it. Returns the name of the dir, removed when the program
+       exits."""
+    global real_config_dir
+    if real_config_dir is None:
+       real_config_dir = user_config_dir()
+    root = tempfile.mkdtemp(prefix='kicad_auto_cfg_')
+    atexit.register(shutil.rmtree, root, True)
+    cfg_dir = os.path.join(root, 'kicad')
+    os.mkdir(cfg_dir)
+    logger.debug('KiCad config dir: '+cfg_dir)
+    return cfg_dir
+
+
+def config_env(cfg_dir):
+    """Environment for a KiCad process using the config dir.
+       Our environment isn't changed, so other jobs can use their own dir."""
+    env = dict(os.environ)
+    # KiCad 5 looks for KICAD_CONFIG_HOME and then XDG_CONFIG_HOME/kicad
+    env['XDG_CONFIG_HOME'] = os.path.dirname(cfg_dir)
+    env['KICAD_CONFIG_HOME'] = cfg_dir
+    return env
+
+
+def lib_table_file(name):
+    """The library table (i.e. sym-lib-table) KiCad would use, or None.
+       The system one is used if the user doesn't have one."""
+    for src_dir in (real_config_dir or user_config_dir(), SYSTEM_TEMPLATE_DIR):
+        lib_table = os.path.join(src_dir, name)
+        if os.path.isfile(lib_table):
+           return lib_table
+    return None
+
+
+def copy_lib_table(cfg_dir, name):
+    """Copies the user library table (i.e. sym-lib-table) to the config dir"""
+    lib_table = lib_table_file(name)
+    if lib_table is None:
+       logger.warning('Missing default '+name+', KiCad will most probably fail')
+       return
+    logger.debug('Using '+lib_table)
+    shutil.copy2(lib_table, os.path.join(cfg_dir, name))
@@ -0,0 +1,194 @@
+"""KiCad PCB files
+
+Helpers to get information from .kicad_pcb files without loading them in
+pcbnew. They use the streaming S-expression reader, so only the needed
+part of the file is read.
+"""
+import math
+
+from kicad_auto import sexp
+
+GR_SHAPES = ('gr_line', 'gr_arc', 'gr_circle', 'gr_poly', 'gr_curve')
+FP_SHAPES = ('fp_line', 'fp_arc', 'fp_circle', 'fp_poly', 'fp_curve')
+EDGE_SECTIONS = GR_SHAPES + ('module',)
+# Maximum angle for the segments approximating the arcs (degrees)
+ARC_STEP = 10
+
+
+def load_layers(pcb_file):
+    """Returns two dicts: layer name -> id and id -> name.
+       Raises ValueError (SexpError) if the file is malformed."""
+    sections = sexp.load_sections(pcb_file, ['layers'])
+    if 'layers' not in sections:
+       raise sexp.SexpError(pcb_file+' has no layers table')
+    ids = {}
+    names = {}
+    # (layers (0 F.Cu signal) (31 B.Cu signal) (32 B.Adhes user) ...)
+    for layer in sections['layers'][1:]:
+        if isinstance(layer, list) and len(layer) >= 2 and layer[0].isdigit():
+           id = int(layer[0])
+           ids[layer[1]] = id
+           names[id] = layer[1]
+    return ids, names
+
+
+def find(section, name):
+    """The first `(name ...)` sub-list, None if missing"""
+    for item in section:
+        if isinstance(item, list) and item and item[0] == name:
+           return item
+    return None
+
+
+def get_number(section, name, index=1):
+    """Float value of the `(name ...)` sub-list, None if missing"""
+    item = find(section, name)
+    if item is None or len(item) <= index:
+       return None
+    return float(item[index])
+
+
+def get_point(section, name):
+    return get_number(section, name, 1), get_number(section, name, 2)
+
+
+def get_layer(section):
+    item = find(section, 'layer')
+    return item[1] if item is not None and len(item) >= 2 else None
+
+
+def module_transform(module):
+    """Returns a function converting footprint coordinates to board
+       coordinates, using the `(at X Y [ROT])` of the module"""
+    at = find(module, 'at')
+    mx = float(at[1]) if at else 0
+    my = float(at[2]) if at else 0
+    rot = math.radians(float(at[3])) if at and len(at) > 3 else 0
+    c = math.cos(rot)
+    s = math.sin(rot)
+    # KiCad rotates clockwise on screen (Y down)
+    return lambda x, y: (mx + x*c + y*s, my - x*s + y*c)
+
+
+def _arc_angles(center, start, angle):
+    cx, cy = center
+    radius = math.hypot(start[0] - cx, start[1] - cy)
+    a0 = math.degrees(math.atan2(start[1] - cy, start[0] - cx))
+    return radius, a0, a0 + angle
+
+
+def _on_circle(center, radius, angle):
+    return (center[0] + radius*math.cos(math.radians(angle)), center[1] + radius*math.sin(math.radians(angle)))
+
+
+def _arc_points(center, start, angle):
+    """Start, end and the axis extremes swept by an arc (angle in degrees)"""
+    radius, a0, a1 = _arc_angles(center, start, angle)
+    lo, hi = min(a0, a1), max(a0, a1)
+    points = [start, _on_circle(center, radius, a1)]
+    axis = math.ceil(lo/90.0)*90
+    while axis <= hi:
+        points.append(_on_circle(center, radius, axis))
+        axis += 90
+    return points
+
+
+def _arc_polyline(center, start, angle):
+    """Approximates an arc using segments of ARC_STEP degrees or less"""
+    radius, a0, a1 = _arc_angles(center, start, angle)
+    steps = max(1, int(math.ceil(abs(angle)/ARC_STEP)))
+    return [start] + [_on_circle(center, radius, a0 + (a1 - a0)*n/steps) for n in range(1, steps + 1)]
+
+
+def _poly_points(section):
+    pts = find(section, 'pts')
+    if pts is None:
+       return []
+    return [(float(p[1]), float(p[2])) for p in pts[1:] if isinstance(p, list) and p[0] == 'xy']
+
+
+def _shape_points(section, prefix):
+    """Points defining the extent of a graphic item (gr_* or fp_*)"""
+    kind = section[0][len(prefix):]
+    if kind == 'line':
+       return [get_point(section, 'start'), get_point(section, 'end')]
+    if kind == 'arc':
+       # (gr_arc (start CENTER) (end START) (angle DEG))
+       return _arc_points(get_point(section, 'start'), get_point(section, 'end'), get_number(section, 'angle') or 0)
+    if kind == 'circle':
+       cx, cy = get_point(section, 'center')
+       ex, ey = get_point(section, 'end')
+       r = math.hypot(ex - cx, ey - cy)
+       return [(cx - r, cy - r), (cx + r, cy + r)]
+    if kind in ('poly', 'curve'):
+       # Bezier control points contain the curve
+       return _poly_points(section)
+    return []
+
+
+def _shape_polyline(section, prefix):
+    """The outline of a graphic item as a list of points"""
+    kind = section[0][len(prefix):]
+    if kind == 'line':
+       return [get_point(section, 'start'), get_point(section, 'end')]
+    if kind == 'arc':
+       return _arc_polyline(get_point(section, 'start'), get_point(section, 'end'), get_number(section, 'angle') or 0)
+    if kind == 'circle':
+       center = get_point(section, 'center')
+       return _arc_polyline(center, get_point(section, 'end'), 360)
+    if kind == 'poly':
+       points = _poly_points(section)
+       return points + points[:1]
+    if kind == 'curve':
+       # The control polygon, close enough for the board edges
+       return _poly_points(section)
+    return []
+
+
+def _edge_shapes(sections):
+    """Yields (shape, prefix, transform) for the Edge.Cuts drawings,
+       including the ones in the footprints"""
+    for section in sections:
+        if section[0] == 'module':
+           # (module NAME ... (at X Y [ROT]) ... (fp_line ...))
+           transform = None
+           for item in section:
+               if isinstance(item, list) and item and item[0] in FP_SHAPES and get_layer(item) == 'Edge.Cuts':
+                  transform = transform or module_transform(section)
+                  yield item, 'fp_', transform
+        elif section[0] in GR_SHAPES and get_layer(section) == 'Edge.Cuts':
+           yield section, 'gr_', None
+
+
+def _to_board(points, transform):
+    return [transform(x, y) for x, y in points] if transform else points
+
+
+def edge_segments(sections):
+    """Returns the Edge.Cuts drawings of the sections as a list of
+       ((x0, y0), (x1, y1)) segments, arcs and circles are approximated"""
+    segments = []
+    for shape, prefix, transform in _edge_shapes(sections):
+        points = _to_board(_shape_polyline(shape, prefix), transform)
+        segments.extend(zip(points, points[1:]))
+    return segments
+
+
+def board_edges(pcb_file):
+    """Returns the points of the Edge.Cuts drawings, including the ones in
+       the footprints, in board coordinates (mm)."""
+    points = []
+    for shape, prefix, transform in _edge_shapes(sexp.iter_sections(pcb_file, EDGE_SECTIONS)):
+        points.extend(_to_board(_shape_points(shape, prefix), transform))
+    return points
+
+
+def board_center(pcb_file):
+    """Center of the board outline (Edge.Cuts) as (x, y) in mm.
+       Raises ValueError (SexpError) if the board has no outline."""
+    points = board_edges(pcb_file)
+    if not points:
+       raise sexp.SexpError(pcb_file+' has no board outline (Edge.Cuts)')
+    xs = [p[0] for p in points]
+    ys = [p[1] for p in points]
+    return (min(xs) + max(xs))/2.0, (min(ys) + max(ys))/2.0
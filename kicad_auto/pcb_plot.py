@@ -0,0 +1,106 @@
+"""PCB plotting
+
+Plots gerbers (zipped) or a PDF with the selected layers and the drill
+map, using the pcbnew Python module. The PDF has a bookmark for each layer.
+The gerbers are deflated, optionally with a manifest of SHA-256 checksums.
+The layers can be plotted by a pool of worker processes. The workers are
+forked after loading the board, so they share it (copy-on-write) and
+each one uses its own copy of the plot controller.
+"""
+import multiprocessing
+import os
+import pcbnew
+import shutil
+
+from kicad_auto.pcb_util import Layer
+from kicad_auto.pdf_util import PdfStreamWriter
+from kicad_auto.zip_util import (ZipStreamWriter, DEFAULT_LEVEL)
+from kicad_auto import log
+logger = log.get_logger(__name__)
+
+# Board used by the workers, inherited from the parent when forking
+_worker_pcb = None
+
+
+def _run_task(pcb, task):
+    """Plots a layer, the drill file or the drill map. Returns the file name."""
+    kind, arg = task
+    if kind == 'layer':
+       layer_id, plot_format = arg
+       layer = Layer(pcb, layer_id)
+       logger.debug('plotting layer {} ({})'.format(layer.get_name(), layer_id))
+       return layer.plot(plot_format)
+    if kind == 'drill':
+       return pcb.plot_drill()
+    return pcb.plot_drill_map()
+
+
+def _worker_task(task):
+    return _run_task(_worker_pcb, task)
+
+
+def _iter_tasks(pcb, tasks, jobs):
+    """Runs the tasks, using `jobs` processes. Yields the results in the
+       same order as the tasks, as soon as they are available."""
+    global _worker_pcb
+    jobs = min(jobs, len(tasks))
+    if jobs <= 1:
+       for task in tasks:
+           yield _run_task(pcb, task)
+       return
+    logger.debug('Plotting using {} processes'.format(jobs))
+    _worker_pcb = pcb
+    pool = multiprocessing.get_context('fork').Pool(jobs)
+    try:
+        for result in pool.imap(_worker_task, tasks, chunksize=1):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+        _worker_pcb = None
+
+
+def plot(pcb, file_format, layers, plot_directory, jobs=1, zip_level=DEFAULT_LEVEL, manifest=False):
+
+    temp_dir = os.path.join(plot_directory, 'temp')
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    try:
+        os.makedirs(temp_dir)
+        plot_to_directory(pcb, file_format, layers, plot_directory, temp_dir, jobs, zip_level, manifest)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def plot_to_directory(pcb, file_format, layers, plot_directory, temp_dir, jobs=1, zip_level=DEFAULT_LEVEL,
+                      manifest=False):
+    pcb.set_plot_directory(temp_dir)
+
+    logger.debug(file_format)
+
+    if file_format == 'zip_gerbers':
+        # In theory not needed since gerber does not support dril marks, but added just to be sure
+        pcb.plot_options.SetDrillMarksType(pcbnew.PCB_PLOT_PARAMS.NO_DRILL_SHAPE)
+
+        # The drill file is generated along with the layers
+        tasks = [('layer', (layer.layer_id, pcbnew.PLOT_FORMAT_GERBER)) for layer in layers]
+        tasks.append(('drill', None))
+
+        # Each file is compressed as soon as it is plotted
+        zip_file_name = os.path.join(plot_directory, '{}_gerbers.zip'.format(pcb.name))
+        with ZipStreamWriter(zip_file_name, zip_level, manifest) as z:
+             for f in _iter_tasks(pcb, tasks, jobs):
+                 if os.path.isfile(f): # No drill file is generated if no holes exist
+                    z.add(f, os.path.relpath(f, plot_directory))
+
+    elif file_format == 'pdf':
+        pcb.plot_options.SetDrillMarksType(pcbnew.PCB_PLOT_PARAMS.FULL_DRILL_SHAPE)
+        tasks = [('layer', (layer.layer_id, pcbnew.PLOT_FORMAT_PDF)) for layer in layers]
+        tasks.append(('drill_map', None))
+        titles = [layer.get_name() for layer in layers] + ['Drill map']
+
+        # Each plot is copied to the output when ready, in the layers order
+        with PdfStreamWriter(plot_directory+'/{}.pdf'.format(pcb.name)) as writer:
+             for title, output_filename in zip(titles, _iter_tasks(pcb, tasks, jobs)):
+                 logger.debug(output_filename)
+                 if os.path.isfile(output_filename): # No drill map file is generated if no holes exist
+                    writer.append(output_filename, title)
@@ -0,0 +1,336 @@
+"""Pcbnew UI sequences
+
+Sequences of UI actions shared by the pcbnew tools.
+They assume pcbnew is already running in the virtual X server.
+"""
+import gettext
+import os
+import re
+
+from kicad_auto import file_util
+# Re-exported for the scripts
+from kicad_auto.kicad_pcb import load_layers
+from kicad_auto.ui_automation import (
+    xdotool,
+    wait_not_focused,
+    wait_for_window,
+    clipboard_store
+)
+
+from kicad_auto import log
+logger = log.get_logger(__name__)
+
+# Maximum number of layers supported by KiCad 5
+MAX_LAYERS=50
+# Copper layers use the ids 0 (F.Cu) to 31 (B.Cu)
+COPPER_LAYERS=32
+# Order of the technical layers in the Print dialog (LSET::TechAndUserUIOrder):
+# F.Adhes, B.Adhes, F.Paste, B.Paste, F.SilkS, B.SilkS, F.Mask, B.Mask, Dwgs.User,
+# Cmts.User, Eco1.User, Eco2.User, Edge.Cuts, Margin, F.CrtYd, B.CrtYd, F.Fab, B.Fab
+TECH_UI_ORDER=(33, 32, 35, 34, 37, 36, 39, 38, 40, 41, 42, 43, 44, 45, 47, 46, 49, 48)
+
+
+def parse_drc(drc_file):
+    from re import search as regex_search
+
+    with open(drc_file, 'r') as f:
+        lines = f.read().splitlines()
+
+    drc_errors = None
+    unconnected_pads = None
+
+    for line in lines:
+        if drc_errors != None and unconnected_pads != None:
+            break;
+        m = regex_search(
+            '^\*\* Found ([0-9]+) DRC errors \*\*$', line)
+        if m != None:
+            drc_errors = m.group(1);
+            continue
+        m = regex_search(
+            '^\*\* Found ([0-9]+) unconnected pads \*\*$', line)
+        if m != None:
+            unconnected_pads = m.group(1);
+            continue
+
+    return {
+        'drc_errors': int(drc_errors),
+        'unconnected_pads': int(unconnected_pads)
+    }
+
+
+def get_used_layers(layers, layer_ids):
+    """Returns a list with 1 for each requested layer.
+       layer_ids is the name -> id dict from load_layers.
+       Raises ValueError for unknown layers."""
+    used_layers=[0]*MAX_LAYERS
+    for layer in layers:
+        # Support for kiplot inner layers
+        if layer.startswith("Inner"):
+           m = re.match(r"^Inner\.([0-9]+)$", layer)
+           if not m:
+              raise ValueError('Malformed inner layer name: '+layer+', use Inner.N')
+           used_layers[int(m.group(1))]=1
+        elif layer in layer_ids:
+           used_layers[layer_ids[layer]]=1
+        else:
+           raise ValueError('Unknown layer '+layer)
+    return used_layers
+
+
+def print_dialog_lists(layer_ids):
+    """The layer ids of the copper and technical lists of the Print dialog,
+       in the same order. layer_ids is the name -> id dict from load_layers,
+       only the enabled layers are in the PCB."""
+    enabled = set(layer_ids.values())
+    copper = sorted(id for id in enabled if id < COPPER_LAYERS)
+    tech = [id for id in TECH_UI_ORDER if id in enabled]
+    return copper, tech
+
+
+def _check_keys(items, used_layers):
+    """Keys to check the used layers in the focused list (all unchecked)"""
+    keys = ['Home']
+    pos = 0
+    for n, id in enumerate(items):
+        if used_layers[id]:
+           keys.extend(['Down']*(n-pos))
+           keys.append('space')
+           pos = n
+    return keys
+
+
+def select_print_layers(used_layers, lists):
+    """Selects the layers in the Print dialog, lists is the result of
+       print_dialog_lists. pcbnew reads the config only when it starts, so
+       this is needed to print other layers in the same session.
+       The focus must be in the first option (output mode), is left there."""
+    copper, tech = lists
+    logger.info('Selecting the layers to print')
+    # The layers box is the last in the focus chain:
+    # copper list, technical list, Select all, Deselect all
+    xdotool(['key', 'shift+Tab', 'space'])
+    xdotool(['key', 'shift+Tab', 'shift+Tab'] + _check_keys(tech, used_layers))
+    xdotool(['key', 'shift+Tab'] + _check_keys(copper, used_layers))
+    # Back to the output mode
+    xdotool(['key', 'Tab', 'Tab', 'Tab', 'Tab'])
+
+
+def parse_print_job(spec):
+    """Parses a print job in the OUTPUT=LAYER[,LAYER...] format"""
+    output, sep, layers = spec.partition('=')
+    if not sep or not output or not layers:
+       raise ValueError('Malformed print job `'+spec+'`, use OUTPUT=LAYER[,LAYER...]')
+    return output, layers.split(',')
+
+
+def gtk_dialog_names():
+    """Get local versions for the GTK window names.
+       Uses our locale, only the KiCad process is forced to english."""
+    gettext.textdomain('gtk30')
+    select_a_filename=gettext.gettext('Select a filename')
+    print_dlg_name=gettext.gettext('Print')
+    logger.debug('Select a filename -> '+select_a_filename)
+    logger.debug('Print -> '+print_dlg_name)
+    return select_a_filename, print_dlg_name
+
+
+def create_config(config_file, drc=False, used_layers=None):
+    """Creates a pcbnew configuration suitable for the DRC and/or printing"""
+    text_file = open(config_file,"w")
+    text_file.write('canvas_type=2\n')
+    text_file.write('RefillZonesBeforeDrc=1\n')
+    text_file.write('PcbFrameFirstRunShown=1\n')
+    if drc:
+       text_file.write('DrcTrackToZoneTest=1\n')
+    if used_layers:
+       # Color
+       text_file.write('PrintMonochrome=0\n')
+       # Include frame
+       text_file.write('PrintPageFrame=1\n')
+       # Real drill marks
+       text_file.write('PrintPadsDrillOpt=2\n')
+       # Only one file
+       text_file.write('PrintSinglePage=1\n')
+       # List all posible layers, indicating which ones are requested
+       for x in range(0,MAX_LAYERS):
+           text_file.write('PlotLayer_%d=%d\n' % (x,used_layers[x]))
+    text_file.close()
+
+
+def dismiss_already_running():
+    # The "Confirmation" modal pops up if pcbnew is already running
+    try:
+        nf_title = 'Confirmation'
+        wait_for_window(nf_title, nf_title, 1)
+
+        logger.info('Dismiss pcbnew already running')
+        xdotool(['search', '--onlyvisible', '--name', nf_title, 'windowfocus'])
+        xdotool(['key', 'Return'])
+    except RuntimeError:
+        pass
+
+
+def dismiss_warning():
+    try:
+        nf_title = 'Warning'
+        wait_for_window(nf_title, nf_title, 1)
+
+        logger.error('Dismiss pcbnew warning, will fail')
+        xdotool(['search', '--onlyvisible', '--name', nf_title, 'windowfocus'])
+        xdotool(['key', 'Return'])
+    except RuntimeError:
+        pass
+
+
+def dismiss_pcbNew_Error():
+    try:
+        nf_title = 'pcbnew Error'
+        wait_for_window(nf_title, nf_title, 3)
+
+        logger.error('Dismiss pcbnew error')
+        xdotool(['search', '--onlyvisible', '--name', nf_title, 'windowfocus'])
+        logger.error('Found, sending Return')
+        xdotool(['key', 'Return'])
+    except RuntimeError:
+        pass
+
+
+def wait_pcbnew_start():
+    failed_focuse = False
+    try:
+       wait_for_window('Main pcbnew window', 'Pcbnew', 25)
+    except RuntimeError:
+       failed_focuse = True
+       pass
+    if failed_focuse:
+       dismiss_already_running()
+       dismiss_warning()
+       wait_for_window('Main pcbnew window', 'Pcbnew', 5)
+
+
+def run_drc_commands(drc_output_file):
+    """Runs the DRC, the DRC dialog is left open"""
+    clipboard_store(drc_output_file)
+
+    logger.info('Open Inspect->DRC')
+    xdotool(['key', 'alt+i', 'd'])
+
+    wait_for_window('DRC modal window', 'DRC Control')
+    # Note: Refill zones on DRC gets saved in ~/.config/kicad/pcbnew as RefillZonesBeforeDrc
+    # The space here is to enable the report of all errors for tracks
+    logger.info('Enable reporting all errors for tracks')
+    xdotool(['key','Tab','Tab','Tab','Tab','space','Tab','Tab','Tab','Tab'])
+    logger.info('Pasting output dir')
+    xdotool(['key', 'ctrl+v', 'Return'])
+
+    wait_for_window('Report completed dialog', 'Disk File Report Completed')
+    xdotool(['key', 'Return'])
+
+
+def close_drc():
+    xdotool(['key', 'Escape'])
+    wait_for_window('Main pcbnew window', 'Pcbnew')
+
+
+def save_pcb(pcb_file, pid):
+    logger.info('Saving PCB')
+    os.rename(pcb_file, pcb_file + '-bak')
+    xdotool(['key', 'ctrl+s'])
+    file_util.wait_for_file_created_by_process(pid, os.path.realpath(pcb_file))
+
+
+def print_layers_commands(print_output_file, pid, select_a_filename, print_dlg_name, used_layers=None,
+                          lists=None):
+    """Prints the used_layers (see select_print_layers), or the ones selected
+       in the config if None. Returns to the main window."""
+    clipboard_store(print_output_file)
+
+    logger.info('Open File->Print')
+    xdotool(['key', 'alt+f', 'p'])
+
+    id=wait_for_window('Print dialog', 'Print')
+    if used_layers:
+       select_print_layers(used_layers, lists)
+    # The color option is selected (not with a WM)
+    xdotool(['key', 'Tab',  'Tab',  'Tab',  'Tab',  'Tab',  'Tab',  'Tab',  'Tab', 'Return'])
+
+    id2 = wait_for_window('Printer dialog', '^(Print|%s)$' % print_dlg_name, skip_id=id[0])
+    # List of printers
+    xdotool(['key', 'Tab',
+            # Go up to the top
+            'Home',
+            # Output file name
+            'Tab',
+            # Open dialog
+            'Return'])
+    id_sel_f = wait_for_window('Select a filename', '(Select a filename|%s)' % select_a_filename, 2)
+    logger.info('Pasting output dir')
+    xdotool(['key',
+            # Select all
+            'ctrl+a',
+            # Paste
+            'ctrl+v',
+            # Select this name
+            'Return'])
+    # Back to print
+    wait_not_focused(id_sel_f[0])
+    wait_for_window('Printer dialog', '^(Print|%s)$' % print_dlg_name, skip_id=id[0])
+    xdotool(['key',
+            # Format options
+            'Tab',
+            # Be sure we are at left (PDF)
+            'Left','Left','Left',
+            # Print it
+            'Return'])
+
+    file_util.wait_for_file_created_by_process(pid, print_output_file)
+
+    wait_not_focused(id2[1])
+    id=wait_for_window('Print dialog', 'Print')
+    # Close button
+    xdotool(['key', 'Tab',  'Tab',  'Tab',  'Tab',  'Tab',  'Tab',  'Tab',  'Tab', 'Tab', 'Tab', 'Return'])
+
+    wait_not_focused(id2[0])
+    wait_for_window('Main pcbnew window', 'Pcbnew')
+
+
+def export_step_commands(step_file):
+    """Exports a STEP model using the board center as origin"""
+    clipboard_store(step_file)
+
+    window = wait_for_window('pcbnew', 'Pcbnew', 10, False)
+    # Needed to rebuild the menu, making sure it is actually built
+    xdotool(['windowsize', '--sync', window[0], '750', '600'])
+    wait_for_window('Main pcbnew window', 'Pcbnew')
+
+    logger.info('Open File->Export->Step')
+    xdotool(['key',
+        'alt+f',
+        'Down', 'Down', 'Down', 'Down', 'Down', 'Down', 'Down', 'Down', 'Down',
+        'Right',
+        'Down', 'Down', 'Down', 'Down',
+        'Return'
+    ])
+
+    wait_for_window('Export STEP modal window', 'Export STEP')
+    logger.info('Pasting output file')
+    xdotool(['key', 'ctrl+v'])
+
+    xdotool(['key',
+        'Tab',
+        'Tab',
+        'Down', 'Down', 'Down', 'Down', # Board center origin
+        'Tab','Tab','Tab','Tab','Tab','Tab','Tab','Tab','Tab','Tab',
+        'Return'
+    ])
+
+    try:
+        wait_for_window('STEP Export override dialog', 'STEP Export')
+        xdotool(['key', 'Return'])
+    except RuntimeError:
+        logger.debug('No override dialog')
+
+    logger.info('Close Export STEP modal window')
+    xdotool(['key', 'Tab','Tab','Tab','Tab','Tab', 'Return'])
+    wait_for_window('Main pcbnew window', 'Pcbnew')
@@ -0,0 +1,202 @@
+"""PDF utilities
+
+Uses PyPDF2, only imported when needed.
+PdfStreamWriter merges PDFs without keeping the result in memory.
+"""
+import hashlib
+import os
+
+from kicad_auto import log
+logger = log.get_logger(__name__)
+
+
+def replace_pages(pdf_file, new_pages, output_file):
+    """Copies pdf_file to output_file replacing some pages.
+       new_pages is a dict with the index of the page (from 0) and the name
+       of a PDF containing the new page."""
+    from PyPDF2 import PdfFileReader, PdfFileWriter
+
+    files = []
+    try:
+        f = open(pdf_file, 'rb')
+        files.append(f)
+        reader = PdfFileReader(f)
+        writer = PdfFileWriter()
+        for n in range(reader.getNumPages()):
+            if n in new_pages:
+               logger.debug('Replacing page %d with %s', n+1, new_pages[n])
+               f = open(new_pages[n], 'rb')
+               files.append(f)
+               writer.addPage(PdfFileReader(f).getPage(0))
+            else:
+               writer.addPage(reader.getPage(n))
+        tmp = output_file+'.tmp'
+        with open(tmp, 'wb') as f:
+             writer.write(f)
+        os.replace(tmp, output_file)
+    finally:
+        for f in files:
+            f.close()
+
+
+class PdfStreamWriter(object):
+    """Writes a PDF with the pages of other PDFs, added one file at a time.
+       The objects are written as soon as they are copied, so only the PDF
+       being added is kept in memory. Identical objects (i.e. the fonts used
+       by all the layers) are stored only once.
+       Each added file can get a bookmark pointing to its first page."""
+    # Reserved object ids, written by close()
+    CATALOG = 1
+    PAGES = 2
+    OUTLINES = 3
+
+    def __init__(self, file_name):
+        self.f = open(file_name, 'wb')
+        self.f.write(b'%PDF-1.5\n%\xe2\xe3\xcf\xd3\n')
+        self.offsets = {}
+        self.next_id = self.OUTLINES+1
+        self.pages = []
+        # (title, id of the page)
+        self.bookmarks = []
+        # Hash of the serialized object -> id
+        self.written = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+           self.close()
+        else:
+           self.f.close()
+
+    def _new_id(self):
+        id = self.next_id
+        self.next_id += 1
+        return id
+
+    def _write(self, id, data):
+        self.offsets[id] = self.f.tell()
+        self.f.write(b'%d 0 obj\n' % id)
+        self.f.write(data)
+        self.f.write(b'\nendobj\n')
+
+    @staticmethod
+    def _serialize(obj):
+        from io import BytesIO
+        buf = BytesIO()
+        obj.writeToStream(buf, None)
+        return buf.getvalue()
+
+    def _convert(self, reader, obj, copied, visiting, skip=()):
+        """Copy of obj with the references solved to our ids"""
+        from PyPDF2 import generic
+        if isinstance(obj, generic.IndirectObject):
+           return generic.IndirectObject(self._copy(reader, obj, copied, visiting), 0, None)
+        if isinstance(obj, generic.DictionaryObject):
+           if isinstance(obj, generic.StreamObject):
+              new = generic.EncodedStreamObject() if '/Filter' in obj else generic.DecodedStreamObject()
+              new._data = obj._data
+              skip = skip + ('/Length',)
+           else:
+              new = generic.DictionaryObject()
+           # Sorted, so equal objects are serialized in the same way
+           for k in sorted(obj.keys()):
+               if k not in skip:
+                  new[generic.NameObject(k)] = self._convert(reader, obj.raw_get(k), copied, visiting)
+           return new
+        if isinstance(obj, generic.ArrayObject):
+           return generic.ArrayObject([self._convert(reader, o, copied, visiting) for o in obj])
+        return obj
+
+    def _copy(self, reader, ref, copied, visiting):
+        """Copies an indirect object (and the ones it uses), returns its id"""
+        key = (ref.idnum, ref.generation)
+        id = copied.get(key)
+        if id is not None:
+           return id
+        if key in visiting:
+           # A loop, we need an id before knowing the content
+           if visiting[key] is None:
+              visiting[key] = self._new_id()
+           return visiting[key]
+        visiting[key] = None
+        data = self._serialize(self._convert(reader, reader.getObject(ref), copied, visiting))
+        id = visiting.pop(key)
+        if id is None:
+           digest = hashlib.sha256(data).digest()
+           id = self.written.get(digest)
+           if id is None:
+              id = self._new_id()
+              self.written[digest] = id
+              self._write(id, data)
+        else:
+           self._write(id, data)
+        copied[key] = id
+        return id
+
+    def append(self, pdf_file, title=None):
+        """Adds all the pages of pdf_file"""
+        from PyPDF2 import PdfFileReader, generic
+        with open(pdf_file, 'rb') as f:
+             reader = PdfFileReader(f, strict=False)
+             # Ids of the objects already copied from this file
+             copied = {}
+             first = None
+             for n in range(reader.getNumPages()):
+                 page = reader.getPage(n)
+                 id = self._new_id()
+                 # Annotations can point to the page
+                 copied[(page.indirectRef.idnum, page.indirectRef.generation)] = id
+                 # The inherited attributes are already in the page
+                 new = self._convert(reader, page, copied, {}, skip=('/Parent',))
+                 new[generic.NameObject('/Parent')] = generic.IndirectObject(self.PAGES, 0, None)
+                 self._write(id, self._serialize(new))
+                 self.pages.append(id)
+                 if first is None:
+                    first = id
+                 # Don't keep the parsed objects
+                 reader.resolvedObjects.clear()
+        if title is not None and first is not None:
+           self.bookmarks.append((title, first))
+        logger.debug('Added %s to the PDF, %d objects', pdf_file, self.next_id-1)
+
+    def close(self):
+        """Writes the page tree, bookmarks and cross-reference table"""
+        from PyPDF2 import generic
+        N = generic.NameObject
+
+        def ref(id):
+            return generic.IndirectObject(id, 0, None)
+
+        pages = generic.DictionaryObject({N('/Type'): N('/Pages'), N('/Count'): generic.NumberObject(len(self.pages)),
+                                          N('/Kids'): generic.ArrayObject([ref(id) for id in self.pages])})
+        self._write(self.PAGES, self._serialize(pages))
+        catalog = generic.DictionaryObject({N('/Type'): N('/Catalog'), N('/Pages'): ref(self.PAGES)})
+        outlines = generic.DictionaryObject({N('/Type'): N('/Outlines'),
+                                             N('/Count'): generic.NumberObject(len(self.bookmarks))})
+        if self.bookmarks:
+           ids = [self._new_id() for b in self.bookmarks]
+           for n, (title, page) in enumerate(self.bookmarks):
+               item = generic.DictionaryObject({N('/Title'): generic.createStringObject(title),
+                                                N('/Parent'): ref(self.OUTLINES),
+                                                N('/Dest'): generic.ArrayObject([ref(page), N('/Fit')])})
+               if n:
+                  item[N('/Prev')] = ref(ids[n-1])
+               if n < len(ids)-1:
+                  item[N('/Next')] = ref(ids[n+1])
+               self._write(ids[n], self._serialize(item))
+           outlines[N('/First')] = ref(ids[0])
+           outlines[N('/Last')] = ref(ids[-1])
+           catalog[N('/PageMode')] = N('/UseOutlines')
+        catalog[N('/Outlines')] = ref(self.OUTLINES)
+        self._write(self.OUTLINES, self._serialize(outlines))
+        self._write(self.CATALOG, self._serialize(catalog))
+
+        xref = self.f.tell()
+        size = self.next_id
+        self.f.write(b'xref\n0 %d\n0000000000 65535 f \n' % size)
+        for id in range(1, size):
+            self.f.write(b'%010d 00000 n \n' % self.offsets[id])
+        self.f.write(b'trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (size, self.CATALOG, xref))
+        self.f.close()
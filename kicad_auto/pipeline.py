@@ -0,0 +1,283 @@
+"""Pipeline runner
+
+Runs the tools described in a JSON job description, i.e.:
+
+{
+  "output_dir": "generated",
+  "jobs": {
+    "schematic": {
+      "tool": "eeschema_do",
+      "command": "batch",
+      "inputs": ["board.sch"],
+      "outputs": ["board.pdf", "board.erc", "board.net", "board.csv"],
+      "options": {"commands": ["export", "run_erc", "netlist", "bom_xml"], "all_pages": true}
+    },
+    "drc": {
+      "tool": "pcbnew_run_drc",
+      "inputs": ["board.kicad_pcb"],
+      "outputs": ["drc_result.rpt"]
+    }
+  }
+}
+
+The first input is the file passed to the tool. Inputs are relative to
+the job description, outputs are relative to the output directory.
+A job depends on the jobs that generate its inputs, or the ones listed in
+its "after" list.
+Independent jobs run in parallel, each GUI job using its own display from
+a pool of virtual X servers.
+Jobs whose inputs and options didn't change since their last successful
+run, and whose outputs are present, are skipped.
+"""
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+
+from concurrent.futures import (ThreadPoolExecutor, FIRST_COMPLETED, wait)
+
+from kicad_auto import cache
+from kicad_auto.display_pool import (DisplayPool, lease_env)
+
+from kicad_auto import log
+logger = log.get_logger(__name__)
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+src_dir = os.path.join(repo_root, 'src')
+gerbers_dir = os.path.join(src_dir, 'gerbers')
+
+STATE_FILE = '.kicad_pipeline.json'
+# Options passed before the tool sub-command
+GLOBAL_OPTIONS = ('record', 'rec_width', 'rec_height', 'wait_timeout', 'cache_dir', 'cache_size', 'verbose')
+
+
+class Tool(object):
+    def __init__(self, command, gui=True, positional=None, module=False, args=None):
+        self.command = command
+        # Needs a display
+        self.gui = gui
+        # Options passed as positional arguments after the output dir
+        self.positional = positional or []
+        # Python module from the src/gerbers tree
+        self.module = module
+        # Options always passed to the tool
+        self.args = args or []
+
+
+TOOLS = {
+    'eeschema_do': Tool('eeschema_do', positional=['commands']),
+    'pcbnew_run_drc': Tool('pcbnew_run_drc'),
+    'pcbnew_print_layers': Tool('pcbnew_print_layers', positional=['layers']),
+    'pcbnew_do': Tool('pcbnew_do'),
+    'plot': Tool('pcbnew_automation.plot', gui=False, positional=['layers'], module=True),
+    # The GUI mode starts its own virtual X server, outside the display pool
+    'export_step': Tool('pcbnew_automation.export_step', gui=False, module=True, args=['--headless']),
+}
+
+
+class Job(object):
+    def __init__(self, name, data, base_dir, output_dir):
+        self.name = name
+        try:
+            self.tool = TOOLS[data['tool']]
+        except KeyError:
+            raise ValueError('Job `{}`: unknown tool `{}`'.format(name, data.get('tool')))
+        self.subcommand = data.get('command')
+        self.inputs = [os.path.normpath(os.path.join(base_dir, f)) for f in data.get('inputs', [])]
+        if not self.inputs:
+           raise ValueError('Job `{}`: no inputs'.format(name))
+        self.outputs = [os.path.normpath(os.path.join(output_dir, f)) for f in data.get('outputs', [])]
+        self.options = data.get('options', {})
+        self.after = data.get('after', [])
+        self.output_dir = output_dir
+        self.base_dir = base_dir
+        self.deps = set()
+
+    def command(self):
+        if self.tool.module:
+           cmd = [sys.executable, '-m', self.tool.command]
+        else:
+           local = os.path.join(src_dir, self.tool.command)
+           cmd = [local if os.path.isfile(local) else self.tool.command]
+        options = dict(self.options)
+        positional = [options.pop(k) for k in self.tool.positional if k in options]
+        cmd.extend(options_to_args({k: v for k, v in options.items() if k in GLOBAL_OPTIONS}))
+        # The tools run from the job description dir
+        files = [os.path.relpath(self.inputs[0], self.base_dir), os.path.relpath(self.output_dir, self.base_dir)]
+        if self.subcommand:
+           # argparse needs the sub-command (and its options) before the files
+           cmd.append(self.subcommand)
+        else:
+           cmd.extend(files)
+        for p in positional:
+            cmd.extend(p if isinstance(p, list) else [p])
+        cmd.extend(options_to_args({k: v for k, v in options.items() if k not in GLOBAL_OPTIONS}))
+        cmd.extend(self.tool.args)
+        if self.subcommand:
+           cmd.extend(files)
+        return cmd
+
+    def input_files(self):
+        """The inputs, plus the sheets and libraries used by the schematics"""
+        files = []
+        for f in self.inputs:
+            found = cache.schematic_inputs(f) if f.endswith('.sch') else [f]
+            for i in found:
+                # The global library table can be missing (None)
+                if i and os.path.abspath(i) not in files:
+                   files.append(os.path.abspath(i))
+        return files
+
+    def signature(self):
+        """Hash of the command and the content of the inputs (all the sheets
+           for a schematic)"""
+        h = hashlib.sha256()
+        h.update(json.dumps(self.command()).encode())
+        for f in self.input_files():
+            h.update(f.encode())
+            if not os.path.isfile(f):
+               # i.e. no global sym-lib-table
+               h.update(b'-')
+               continue
+            with open(f, 'rb') as fi:
+                 for block in iter(lambda: fi.read(1 << 20), b''):
+                     h.update(block)
+        return h.hexdigest()
+
+
+def options_to_args(options):
+    args = []
+    for k, v in sorted(options.items()):
+        flag = '--'+k
+        if v is None or v is False:
+           continue
+        if v is True:
+           args.append(flag)
+        elif k == 'verbose':
+           args.extend([flag]*int(v))
+        elif isinstance(v, list):
+           # Repeated option
+           for e in v:
+               args.extend([flag, str(e)])
+        else:
+           args.extend([flag, str(v)])
+    return args
+
+
+class Pipeline(object):
+    def __init__(self, job_file, displays=2, force=False):
+        with open(job_file) as f:
+             data = json.load(f)
+        base_dir = os.path.dirname(os.path.abspath(job_file))
+        self.output_dir = os.path.normpath(os.path.join(base_dir, data.get('output_dir', 'generated')))
+        self.displays = data.get('displays', displays)
+        self.force = force
+        self.jobs = {}
+        for name, job in data['jobs'].items():
+            self.jobs[name] = Job(name, job, base_dir, self.output_dir)
+        self._solve_deps()
+        self.state_file = os.path.join(self.output_dir, STATE_FILE)
+        self.state = {}
+        if os.path.isfile(self.state_file):
+           with open(self.state_file) as f:
+                self.state = json.load(f)
+        self.state_lock = threading.Lock()
+
+    def _solve_deps(self):
+        producers = {}
+        for job in self.jobs.values():
+            for f in job.outputs:
+                producers[f] = job.name
+        for job in self.jobs.values():
+            for f in job.inputs:
+                if f in producers and producers[f] != job.name:
+                   job.deps.add(producers[f])
+            for name in job.after:
+                if name not in self.jobs:
+                   raise ValueError('Job `{}`: unknown job `{}` in "after"'.format(job.name, name))
+                job.deps.add(name)
+        # Check for cycles
+        done = set()
+        pending = set(self.jobs)
+        while pending:
+            ready = {n for n in pending if self.jobs[n].deps <= done}
+            if not ready:
+               raise ValueError('Dependency cycle between jobs: '+', '.join(sorted(pending)))
+            done |= ready
+            pending -= ready
+
+    def _up_to_date(self, job, signature):
+        if self.force or self.state.get(job.name) != signature:
+           return False
+        return all(os.path.isfile(f) for f in job.outputs)
+
+    def _run_job(self, job, pool):
+        signature = job.signature()
+        if self._up_to_date(job, signature):
+           logger.info('%s: up to date', job.name)
+           return 0
+        cmd = job.command()
+        env = None
+        if job.tool.module:
+           env = dict(os.environ)
+           env['PYTHONPATH'] = os.pathsep.join([os.path.join(gerbers_dir, 'pcbnew_automation'), gerbers_dir])
+        if job.tool.gui:
+           with pool.lease() as display:
+                logger.info('%s: running on %s', job.name, display)
+                logger.debug(' '.join(cmd))
+                ret = subprocess.call(cmd, env=lease_env(display, env), cwd=job.base_dir)
+        else:
+           logger.info('%s: running', job.name)
+           logger.debug(' '.join(cmd))
+           ret = subprocess.call(cmd, env=env, cwd=job.base_dir)
+        if ret == 0:
+           with self.state_lock:
+                self.state[job.name] = signature
+                self._save_state()
+        else:
+           logger.error('%s: failed with exit code %d', job.name, ret)
+        return ret
+
+    def _save_state(self):
+        tmp = self.state_file+'.tmp'
+        with open(tmp, 'w') as f:
+             json.dump(self.state, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.state_file)
+
+    def run(self):
+        """Runs the jobs, returns the names of the failed jobs"""
+        os.makedirs(self.output_dir, exist_ok=True)
+        done = set()
+        failed = set()
+        pending = set(self.jobs)
+        running = {}
+        needs_display = any(j.tool.gui for j in self.jobs.values())
+        with DisplayPool(self.displays if needs_display else 0) as pool:
+             with ThreadPoolExecutor(max_workers=max(len(self.jobs), 1)) as executor:
+                  while pending or running:
+                      for name in sorted(pending):
+                          job = self.jobs[name]
+                          if job.deps & failed:
+                             logger.error('%s: skipped, depends on a failed job', name)
+                             failed.add(name)
+                             pending.discard(name)
+                          elif job.deps <= done:
+                             running[executor.submit(self._run_job, job, pool)] = name
+                             pending.discard(name)
+                      if not running:
+                         continue
+                      finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                      for future in finished:
+                          name = running.pop(future)
+                          try:
+                              ret = future.result()
+                          except (OSError, RuntimeError) as e:
+                              logger.error('%s: %s', name, str(e))
+                              ret = -1
+                          if ret:
+                             failed.add(name)
+                          else:
+                             done.add(name)
+        return sorted(failed)
@@ -0,0 +1,173 @@
+"""Schematic BoM
+
+Creates a grouped Bill of Materials from the legacy .sch hierarchy,
+without eeschema and without the XML + XSLT pass. The CSV is similar to
+the one from the bom2grouped_csv.xsl plugin:
+
+"Ref","Qnty","Value","Cmp name","Footprint","Description","Vendor"
+"C1 C2","2","100n","C","Capacitor_SMD:C_0603_1608Metric","",""
+
+The components are grouped using a hash of the group fields (by default
+the value, the part name and the footprint). Multi-unit components are
+counted once. Components with a DNP field (or a DNP value) are excluded
+unless requested, in this case they are grouped apart.
+
+The fields names are case insensitive: Reference, Value, Footprint,
+Datasheet, Part, Library or the name of any custom field.
+"""
+import csv
+import time
+
+from xml.sax.saxutils import (escape, quoteattr)
+
+from kicad_auto.sch_connectivity import (Design, natural_key)
+
+from kicad_auto import log
+logger = log.get_logger(__name__)
+
+GROUP_FIELDS = ('Value', 'Part', 'Footprint')
+# Fields used to mark components that must not be populated
+DNP_FIELDS = ('dnp', 'dnf', 'do not populate', 'do not place', 'exclude from bom')
+DNP_VALUES = ('dnp', 'dnf')
+FALSE_VALUES = ('', '0', 'no', 'false', 'n')
+CSV_COLUMNS = ('Ref', 'Qnty', 'Value', 'Cmp name', 'Footprint', 'Description', 'Vendor')
+
+
+class BomComponent(object):
+    def __init__(self, ref, comp):
+        self.ref = ref
+        lib_id = comp.lib_id
+        # Lower case field name -> value
+        self.fields = {
+            'reference': ref,
+            'value': comp.fields.get(1, ''),
+            'footprint': comp.fields.get(2, ''),
+            'datasheet': comp.fields.get(3, ''),
+            'part': lib_id.split(':')[-1],
+            'library': lib_id.split(':')[0] if ':' in lib_id else '',
+        }
+        self.add_fields(comp)
+
+    def add_fields(self, comp):
+        """Adds the custom fields, used for the other units"""
+        for name, value in comp.named_fields:
+            name = name.lower()
+            if value and not self.fields.get(name):
+               self.fields[name] = value
+
+    def get(self, name):
+        return self.fields.get(name.lower(), '')
+
+    @property
+    def dnp(self):
+        if self.get('value').lower() in DNP_VALUES:
+           return True
+        return any(self.get(name).lower() not in FALSE_VALUES for name in DNP_FIELDS)
+
+
+class BomGroup(object):
+    def __init__(self, dnp):
+        self.dnp = dnp
+        self.components = []
+
+    @property
+    def refs(self):
+        return [c.ref for c in self.components]
+
+    def get(self, name):
+        """The field of the group, different values are joined"""
+        values = []
+        for c in self.components:
+            value = c.get(name)
+            if value and value not in values:
+               values.append(value)
+        return ' '.join(values)
+
+
+def collect(design):
+    """Returns the BomComponent of the design, one for each reference"""
+    comps = {}
+    for ref, comp, sheet in design.components():
+        # Power symbols and flags
+        if ref.startswith('#'):
+           continue
+        c = comps.get(ref)
+        if c is None:
+           comps[ref] = BomComponent(ref, comp)
+        else:
+           # Another unit of a multi-unit component
+           c.add_fields(comp)
+    return comps.values()
+
+
+def group(components, group_fields=GROUP_FIELDS, include_dnp=False):
+    """Groups the components with the same group fields.
+       Returns the groups sorted by reference."""
+    groups = {}
+    for c in components:
+        dnp = c.dnp
+        if dnp and not include_dnp:
+           continue
+        key = (dnp,) + tuple(c.get(name) for name in group_fields)
+        g = groups.get(key)
+        if g is None:
+           g = groups[key] = BomGroup(dnp)
+        g.components.append(c)
+    for g in groups.values():
+        g.components.sort(key=lambda c: natural_key(c.ref))
+    return sorted(groups.values(), key=lambda g: natural_key(g.components[0].ref))
+
+
+def write_csv(groups, source, csv_file, fields=()):
+    """Writes the groups using the columns of bom2grouped_csv.xsl, plus the
+       requested fields"""
+    dnp = any(g.dnp for g in groups)
+    with open(csv_file, 'w', newline='') as f:
+         w = csv.writer(f, quoting=csv.QUOTE_ALL, lineterminator='\n')
+         w.writerow(['Source:', source])
+         w.writerow(['Date:', time.strftime('%a %d %b %Y %H:%M:%S')])
+         w.writerow(['Tool:', 'kicad_auto BoM'])
+         w.writerow(['Component Count:', sum(len(g.components) for g in groups)])
+         w.writerow(list(CSV_COLUMNS) + list(fields) + (['DNP'] if dnp else []))
+         for g in groups:
+             row = [' '.join(g.refs), len(g.components), g.get('Value'), g.get('Part'), g.get('Footprint'),
+                    g.get('Description'), g.get('Vendor')]
+             row.extend(g.get(name) for name in fields)
+             if dnp:
+                row.append('DNP' if g.dnp else '')
+             w.writerow(row)
+
+
+def write_xml(groups, source, xml_file, fields=()):
+    """Writes the groups as XML, one <group> for each line of the BoM"""
+    with open(xml_file, 'w') as f:
+         f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+         f.write('<bom source={} date={} count="{}">\n'.format(quoteattr(source),
+                 quoteattr(time.strftime('%a %d %b %Y %H:%M:%S')), sum(len(g.components) for g in groups)))
+         for g in groups:
+             f.write('  <group qty="{}"{}>\n'.format(len(g.components), ' dnp="yes"' if g.dnp else ''))
+             f.write('    <refs>{}</refs>\n'.format(escape(' '.join(g.refs))))
+             names = []
+             for name in ('Value', 'Part', 'Footprint', 'Datasheet', 'Description', 'Vendor') + tuple(fields):
+                 if name.lower() in names:
+                    continue
+                 names.append(name.lower())
+                 value = g.get(name)
+                 if value:
+                    f.write('    <field name={}>{}</field>\n'.format(quoteattr(name), escape(value)))
+             f.write('  </group>\n')
+         f.write('</bom>\n')
+
+
+def bom(sch_file, output_file, file_format='csv', group_fields=GROUP_FIELDS, fields=(), include_dnp=False):
+    """Creates the BoM for the schematic, returns the groups.
+       Raises ValueError (SchError) if the files are malformed."""
+    start = time.time()
+    design = Design(sch_file)
+    groups = group(collect(design), group_fields, include_dnp)
+    if file_format == 'xml':
+       write_xml(groups, design.root_sch, output_file, fields)
+    else:
+       write_csv(groups, design.root_sch, output_file, fields)
+    logger.debug('BoM generated in {:.3f} s'.format(time.time() - start))
+    return groups
@@ -0,0 +1,376 @@
+"""Schematic connectivity
+
+Solves the nets of a legacy (KiCad 5) hierarchical schematic using the
+data from sch_file. The connectivity of each .sch file is computed only
+once, using a union-find over the connection points:
+- The ends of a wire are connected
+- A point over a wire (end of another wire, junction, label, pin, sheet
+  pin or no-connect flag) is connected to the wire
+The sheet instances are then joined:
+- Local labels with the same text in the same sheet instance
+- Global labels and invisible power input pins with the same name
+- Hierarchical labels with the sheet pins of the parent sheet
+So the time grows linearly with the size of the design.
+
+Buses aren't followed, their members are connected by the labels.
+"""
+import os
+import re
+
+from kicad_auto import sch_file
+from kicad_auto.sch_file import (LOCAL, GLOBAL, HIERARCHICAL)
+
+from kicad_auto import log
+logger = log.get_logger(__name__)
+
+# Priority of the net names, lower is better
+NAME_GLOBAL = 0
+NAME_POWER = 1
+NAME_LOCAL = 2
+NAME_HIERARCHICAL = 3
+# Grid used to find the points over diagonal wires, in mils
+CELL = 1000
+
+
+class UnionFind(object):
+    def __init__(self, size=0):
+        self.parent = list(range(size))
+
+    def add(self):
+        self.parent.append(len(self.parent))
+        return len(self.parent) - 1
+
+    def find(self, a):
+        parent = self.parent
+        while parent[a] != a:
+            # Path halving
+            parent[a] = parent[parent[a]]
+            a = parent[a]
+        return a
+
+    def union(self, a, b):
+        a = self.find(a)
+        b = self.find(b)
+        if a != b:
+           if a < b:
+              a, b = b, a
+           self.parent[a] = b
+
+
+class SheetInstance(object):
+    def __init__(self, sch, path, name_path, parent=None, sub_sheet=None):
+        self.sch = sch
+        # Timestamps, i.e. /5E8B3C00/
+        self.path = path
+        # Names, i.e. /Power/
+        self.name_path = name_path
+        self.parent = parent
+        # The SubSheet of the parent that instantiates this sheet
+        self.sub_sheet = sub_sheet
+        # Index of the first local group in the design union-find
+        self.base = 0
+
+
+class NetPin(object):
+    def __init__(self, comp, lib_pin, ref, position, sheet):
+        self.comp = comp
+        self.lib_pin = lib_pin
+        self.ref = ref
+        # Position in the sheet, in mils
+        self.position = position
+        self.sheet = sheet
+
+    @property
+    def number(self):
+        return self.lib_pin.number
+
+    @property
+    def type(self):
+        return self.lib_pin.type
+
+    def describe(self):
+        return 'Pin {} ({}) of component {}'.format(self.number, sch_file.PIN_TYPES.get(self.type, self.type),
+                                                    self.ref)
+
+
+class Net(object):
+    def __init__(self):
+        self.code = 0
+        self.name = ''
+        self.pins = []
+        # (LabelType, text, SheetInstance, x, y)
+        self.labels = []
+        # (SheetInstance, x, y)
+        self.no_connects = []
+        self.has_wires = False
+        # (priority, depth, name) of the candidate names
+        self.names = []
+
+
+class _LocalConnectivity(object):
+    """Groups of connected items of one .sch file"""
+    def __init__(self, sch, symbols):
+        uf = UnionFind()
+        points = {}
+
+        def node(p):
+            id = points.get(p)
+            if id is None:
+               id = points[p] = uf.add()
+            return id
+
+        # Wires, indexed by their coordinate to find the points over them
+        horizontal = {}
+        vertical = {}
+        # Diagonal wires, by grid cell
+        other = {}
+        for a, b in sch.wires:
+            n = node(a)
+            uf.union(n, node(b))
+            if a[1] == b[1]:
+               horizontal.setdefault(a[1], []).append((min(a[0], b[0]), max(a[0], b[0]), n))
+            elif a[0] == b[0]:
+               vertical.setdefault(a[0], []).append((min(a[1], b[1]), max(a[1], b[1]), n))
+            else:
+               for cx in range(min(a[0], b[0])//CELL, max(a[0], b[0])//CELL + 1):
+                   for cy in range(min(a[1], b[1])//CELL, max(a[1], b[1])//CELL + 1):
+                       other.setdefault((cx, cy), []).append((a, b, n))
+
+        # Pins of the components: (component, lib pin, point)
+        self.pins = []
+        self.missing = []
+        for comp in sch.components:
+            symbol = sch_file.find_symbol(symbols, comp.lib_id)
+            if symbol is None:
+               self.missing.append(comp.lib_id)
+               continue
+            for pin in symbol.unit_pins(comp.unit, comp.convert):
+                self.pins.append((comp, pin, comp.pin_position(pin)))
+        connection_points = [a for a, b in sch.wires] + [b for a, b in sch.wires] + sch.junctions + \
+                            sch.no_connects + [(l.x, l.y) for l in sch.labels] + [p for c, pin, p in self.pins] + \
+                            [(pin.x, pin.y) for sheet in sch.sheets for pin in sheet.pins]
+        for p in set(connection_points):
+            n = node(p)
+            x, y = p
+            for x0, x1, w in horizontal.get(y, ()):
+                if x0 <= x <= x1:
+                   uf.union(n, w)
+            for y0, y1, w in vertical.get(x, ()):
+                if y0 <= y <= y1:
+                   uf.union(n, w)
+            for a, b, w in other.get((x//CELL, y//CELL), ()):
+                if _on_segment(p, a, b):
+                   uf.union(n, w)
+
+        # Compact the groups
+        groups = {}
+        def group(p):
+            root = uf.find(points[p])
+            g = groups.get(root)
+            if g is None:
+               g = groups[root] = len(groups)
+            return g
+
+        self.pin_groups = [group(p) for c, pin, p in self.pins]
+        self.label_groups = [group((l.x, l.y)) for l in sch.labels]
+        self.no_connect_groups = [group(p) for p in sch.no_connects]
+        self.sheet_pin_groups = [[group((pin.x, pin.y)) for pin in sheet.pins] for sheet in sch.sheets]
+        self.wire_groups = set(group(a) for a, b in sch.wires)
+        self.size = len(groups)
+
+
+def _on_segment(p, a, b):
+    cross = (b[0] - a[0])*(p[1] - a[1]) - (b[1] - a[1])*(p[0] - a[0])
+    if cross:
+       return False
+    return min(a[0], b[0]) <= p[0] <= max(a[0], b[0]) and min(a[1], b[1]) <= p[1] <= max(a[1], b[1])
+
+
+def _local(sch, symbols):
+    """Cached connectivity for the file, the symbols are from the -cache.lib"""
+    cache = getattr(sch, 'local_connectivity', None)
+    if cache is None or cache[0] is not symbols:
+       cache = sch.local_connectivity = (symbols, _LocalConnectivity(sch, symbols))
+    return cache[1]
+
+
+def natural_key(text):
+    return [int(c) if c.isdigit() else c for c in re.split(r'(\d+)', text)]
+
+
+class Design(object):
+    """The sheets and nets of a hierarchical schematic.
+       The symbols and the nets are solved the first time they are used."""
+    def __init__(self, root_sch, lib_file=None):
+        root_sch = os.path.abspath(root_sch)
+        self.root_sch = root_sch
+        self.lib_file = lib_file or sch_file.cache_lib_name(root_sch)
+        self.sheets = []
+        self._load_sheets(root_sch, '/', '/', None, None, [root_sch])
+        self.missing = set()
+        self._symbols = None
+        self._nets = None
+
+    @property
+    def symbols(self):
+        if self._symbols is None:
+           if os.path.isfile(self.lib_file):
+              self._symbols = sch_file.load_lib(self.lib_file)
+           else:
+              logger.warning('Missing symbols cache '+self.lib_file)
+              self._symbols = {}
+        return self._symbols
+
+    @property
+    def nets(self):
+        if self._nets is None:
+           self._nets = self._solve()
+        return self._nets
+
+    @property
+    def bus_sheets(self):
+        """Sheet instances using buses, not followed"""
+        return [s for s in self.sheets if s.sch.buses]
+
+    @property
+    def unmatched(self):
+        """(message, SheetInstance, position) for the hierarchical labels and
+           sheet pins that aren't connected"""
+        self.nets
+        return self._unmatched
+
+    def _load_sheets(self, file_name, path, name_path, parent, sub_sheet, parents):
+        instance = SheetInstance(sch_file.load_sch(file_name), path, name_path, parent, sub_sheet)
+        self.sheets.append(instance)
+        dir_name = os.path.dirname(file_name)
+        for sheet in instance.sch.sheets:
+            sub_file = os.path.normpath(os.path.join(dir_name, sheet.file_name))
+            if sub_file in parents:
+               raise sch_file.SchError('Recursive sheet '+sub_file)
+            if not os.path.isfile(sub_file):
+               logger.warning('Missing sheet '+sub_file)
+               continue
+            self._load_sheets(sub_file, path+sheet.timestamp+'/', name_path+sheet.name+'/', instance, sheet,
+                              parents+[sub_file])
+
+    def _solve(self):
+        uf = UnionFind()
+        global_names = {}
+        for instance in self.sheets:
+            local = _local(instance.sch, self.symbols)
+            self.missing.update(local.missing)
+            instance.local = local
+            instance.base = len(uf.parent)
+            uf.parent.extend(range(instance.base, instance.base + local.size))
+            local_names = {}
+            for label, g in zip(instance.sch.labels, local.label_groups):
+                if label.type == LOCAL:
+                   names = local_names
+                elif label.type == GLOBAL:
+                   names = global_names
+                else:
+                   continue
+                n = instance.base + g
+                if label.text in names:
+                   uf.union(n, names[label.text])
+                else:
+                   names[label.text] = n
+            for (comp, pin, p), g in zip(local.pins, local.pin_groups):
+                if pin.is_global_power():
+                   n = instance.base + g
+                   if pin.name in global_names:
+                      uf.union(n, global_names[pin.name])
+                   else:
+                      global_names[pin.name] = n
+        # Hierarchical labels to the sheet pins of the parent
+        self._unmatched = []
+        for instance in self.sheets:
+            parent = instance.parent
+            if parent is None:
+               continue
+            index = parent.sch.sheets.index(instance.sub_sheet)
+            pins = {}
+            for pin, g in zip(instance.sub_sheet.pins, parent.local.sheet_pin_groups[index]):
+                pins[pin.name] = (pin, parent.base + g)
+            used = set()
+            for label, g in zip(instance.sch.labels, instance.local.label_groups):
+                if label.type != HIERARCHICAL:
+                   continue
+                if label.text in pins:
+                   uf.union(instance.base + g, pins[label.text][1])
+                   used.add(label.text)
+                else:
+                   self._unmatched.append(('Hierarchical label {} has no sheet pin in the parent sheet'.
+                                          format(label.text), instance, (label.x, label.y)))
+            for name, (pin, g) in pins.items():
+                if name not in used:
+                   self._unmatched.append(('Sheet pin {} has no hierarchical label in the sheet {}'.
+                                          format(name, instance.name_path), parent, (pin.x, pin.y)))
+        for instance in self.sheets:
+            if instance.parent is None:
+               for label, g in zip(instance.sch.labels, instance.local.label_groups):
+                   if label.type == HIERARCHICAL:
+                      self._unmatched.append(('Hierarchical label {} in the root sheet'.format(label.text), instance,
+                                             (label.x, label.y)))
+        if self.missing:
+           logger.warning('Missing symbols in the cache: '+', '.join(sorted(self.missing)))
+        return self._collect(uf)
+
+    def _collect(self, uf):
+        nets = {}
+
+        def net(instance, g):
+            root = uf.find(instance.base + g)
+            n = nets.get(root)
+            if n is None:
+               n = nets[root] = Net()
+            return n
+
+        for instance in self.sheets:
+            local = instance.local
+            for (comp, pin, p), g in zip(local.pins, local.pin_groups):
+                ref = comp.instance(instance.path)[0]
+                n = net(instance, g)
+                n.pins.append(NetPin(comp, pin, ref, p, instance))
+                if pin.is_global_power():
+                   n.names.append((NAME_POWER, 0, pin.name))
+            for label, g in zip(instance.sch.labels, local.label_groups):
+                n = net(instance, g)
+                n.labels.append((label.type, label.text, instance, label.x, label.y))
+                depth = instance.name_path.count('/')
+                if label.type == GLOBAL:
+                   n.names.append((NAME_GLOBAL, 0, label.text))
+                elif label.type == LOCAL:
+                   n.names.append((NAME_LOCAL, depth, instance.name_path+label.text))
+                else:
+                   n.names.append((NAME_HIERARCHICAL, depth, instance.name_path+label.text))
+            for p, g in zip(instance.sch.no_connects, local.no_connect_groups):
+                net(instance, g).no_connects.append((instance, p[0], p[1]))
+            for g in local.wire_groups:
+                net(instance, g).has_wires = True
+        result = []
+        for n in nets.values():
+            if not n.pins and not n.labels:
+               continue
+            if n.names:
+               n.name = min(n.names)[2]
+            else:
+               # Net-(R1-Pad2), using the first pin
+               pin = min(n.pins, key=lambda p: (natural_key(p.ref), natural_key(p.number)))
+               n.name = 'Net-({}-Pad{})'.format(pin.ref, pin.number)
+            n.pins.sort(key=lambda p: (natural_key(p.ref), natural_key(p.number)))
+            result.append(n)
+        result.sort(key=lambda n: natural_key(n.name))
+        for code, n in enumerate(result, 1):
+            n.code = code
+        return result
+
+    def symbol(self, lib_id):
+        """The LibSymbol for a lib_id, None if not in the cache"""
+        return sch_file.find_symbol(self.symbols, lib_id)
+
+    def components(self):
+        """Yields (ref, Component, SheetInstance) for all the instances"""
+        for instance in self.sheets:
+            for comp in instance.sch.components:
+                yield comp.instance(instance.path)[0], comp, instance
@@ -0,0 +1,316 @@
+"""Legacy schematic files
+
+Reads the electrical information of legacy (KiCad 5) .sch files and of
+the -cache.lib of the project, without eeschema. Only what is needed to
+solve the connectivity is kept: components, pins, wires, junctions,
+labels, no-connect flags and sub-sheets. The coordinates are in mils, the
+schematic Y axis goes down and the library Y axis goes up.
+
+Sheet:
+
+$Comp
+L Device:R R1
+U 1 1 5E8B3C1A
+P 4000 3000
+AR Path="/5E8B3C00/5E8B3C1A" Ref="R3"  Part="1"
+F 0 "R1" H 4070 3046 50  0000 L CNN
+F 1 "10k" H 4070 2955 50  0000 L CNN
+	1    4000 3000
+	1    0    0    -1
+$EndComp
+Wire Wire Line
+	4000 2850 4000 2700
+Connection ~ 4000 2700
+NoConn ~ 4500 3000
+Text Label 4100 2700 0    50   ~ 0
+VCC
+
+Library:
+
+DEF Device_R R 0 0 N Y 1 F N
+X ~ 1 0 150 50 D 50 50 1 1 P
+ENDDEF
+"""
+import os
+import re
+
+from kicad_auto import log
+logger = log.get_logger(__name__)
+
+# Label types
+LOCAL = 'Label'
+GLOBAL = 'GLabel'
+HIERARCHICAL = 'HLabel'
+# Pin electrical types, as used in the library
+PIN_TYPES = {
+    'I': 'Input',
+    'O': 'Output',
+    'B': 'BiDi',
+    'T': '3state',
+    'P': 'Passive',
+    'U': 'Unspecified',
+    'W': 'Power input',
+    'w': 'Power output',
+    'C': 'Open collector',
+    'E': 'Open emitter',
+    'N': 'Not connected',
+}
+POWER_IN = 'W'
+FIELD = re.compile(r'"((?:[^"\\]|\\.)*)"|(\S+)')
+ESCAPE = re.compile(r'\\(.)')
+# Default orientation matrix
+IDENTITY = (1, 0, 0, -1)
+# Parsed files: real path -> (stamp, object)
+_loaded = {}
+
+
+class SchError(ValueError):
+    pass
+
+
+class LibPin(object):
+    def __init__(self, name, number, x, y, unit, convert, type, shape):
+        self.name = name
+        self.number = number
+        self.x = x
+        self.y = y
+        # 0 means all the units/body styles
+        self.unit = unit
+        self.convert = convert
+        self.type = type
+        self.visible = 'N' not in shape
+
+    def is_global_power(self):
+        """Invisible power inputs connect to the net of the same name"""
+        return self.type == POWER_IN and not self.visible
+
+
+class LibSymbol(object):
+    def __init__(self, name, reference, power):
+        self.name = name
+        self.reference = reference
+        self.power = power
+        self.pins = []
+        self.fields = {}
+
+    def unit_pins(self, unit, convert):
+        return [p for p in self.pins if p.unit in (0, unit) and p.convert in (0, convert)]
+
+
+class Component(object):
+    def __init__(self):
+        self.lib_id = ''
+        self.ref = ''
+        self.unit = 1
+        self.convert = 1
+        self.timestamp = ''
+        self.x = 0
+        self.y = 0
+        self.transform = IDENTITY
+        # Field number -> text, custom fields also in named_fields
+        self.fields = {}
+        self.named_fields = []
+        # Instance path -> (ref, unit), for reused sheets
+        self.instances = {}
+
+    def pin_position(self, pin):
+        x1, y1, x2, y2 = self.transform
+        return self.x + x1*pin.x + y1*pin.y, self.y + x2*pin.x + y2*pin.y
+
+    def instance(self, path):
+        """Reference and unit for the component in the sheet instance path
+           (i.e. /5E8B3C00/), the timestamp of the component is added"""
+        return self.instances.get(path + self.timestamp, (self.ref, self.unit))
+
+
+class Label(object):
+    def __init__(self, type, x, y, text, shape=None):
+        self.type = type
+        self.x = x
+        self.y = y
+        self.text = text
+        # Input, Output, etc. for global and hierarchical labels
+        self.shape = shape
+
+
+class SheetPin(object):
+    def __init__(self, name, shape, x, y):
+        self.name = name
+        self.shape = shape
+        self.x = x
+        self.y = y
+
+
+class SubSheet(object):
+    def __init__(self):
+        self.timestamp = ''
+        self.name = ''
+        self.file_name = ''
+        self.pins = []
+
+
+class SchFile(object):
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.components = []
+        # ((x0, y0), (x1, y1))
+        self.wires = []
+        self.junctions = []
+        self.no_connects = []
+        self.labels = []
+        self.sheets = []
+        # Bus wires and bus entries, not used for the connectivity
+        self.buses = 0
+
+
+def _fields(line):
+    """Splits a line, quoted strings can contain spaces and \\" """
+    return [ESCAPE.sub(r'\1', m.group(1)) if m.group(1) is not None else m.group(2) for m in FIELD.finditer(line)]
+
+
+def _read_comp(f):
+    comp = Component()
+    numbers = []
+    for line in f:
+        if line.startswith('$EndComp'):
+           break
+        if line.startswith('L '):
+           args = line.split()
+           comp.lib_id = args[1]
+           comp.ref = args[2] if len(args) > 2 else ''
+        elif line.startswith('U '):
+           args = line.split()
+           comp.unit = int(args[1])
+           comp.convert = int(args[2])
+           comp.timestamp = args[3] if len(args) > 3 else ''
+        elif line.startswith('P '):
+           args = line.split()
+           comp.x = int(args[1])
+           comp.y = int(args[2])
+        elif line.startswith('AR '):
+           m = re.search(r'Path="([^"]*)"\s+Ref="([^"]*)"\s+Part="([^"]*)"', line)
+           if m:
+              comp.instances[m.group(1)] = (m.group(2), int(m.group(3)) if m.group(3).isdigit() else comp.unit)
+        elif line.startswith('F '):
+           args = _fields(line)
+           n = int(args[1])
+           comp.fields[n] = args[2]
+           if n > 3 and len(args) > 10:
+              comp.named_fields.append((args[10], args[2]))
+        elif line.startswith('\t') or line.startswith(' '):
+           numbers.append(line.split())
+    # The last one is the orientation matrix
+    if numbers and len(numbers[-1]) == 4:
+       comp.transform = tuple(int(v) for v in numbers[-1])
+    return comp
+
+
+def _read_sheet(f):
+    sheet = SubSheet()
+    for line in f:
+        if line.startswith('$EndSheet'):
+           break
+        if line.startswith('U '):
+           sheet.timestamp = line.split()[1]
+        elif line.startswith('F'):
+           args = _fields(line)
+           if args[0] == 'F0':
+              sheet.name = args[1]
+           elif args[0] == 'F1':
+              sheet.file_name = args[1]
+           elif len(args) >= 6:
+              # F2 "NAME" I L X Y SIZE
+              sheet.pins.append(SheetPin(args[1], args[2], int(args[4]), int(args[5])))
+    return sheet
+
+
+def _parse_sch(file_name):
+    sch = SchFile(file_name)
+    with open(file_name, 'rt', errors='replace') as f:
+         first = f.readline()
+         if not first.startswith('EESchema Schematic File'):
+            raise SchError(file_name+' is not a legacy KiCad schematic')
+         for line in f:
+             if line.startswith('$Comp'):
+                sch.components.append(_read_comp(f))
+             elif line.startswith('$Sheet'):
+                sch.sheets.append(_read_sheet(f))
+             elif line.startswith('Wire Wire Line'):
+                c = [int(v) for v in f.readline().split()]
+                sch.wires.append(((c[0], c[1]), (c[2], c[3])))
+             elif line.startswith('Wire Bus Line') or line.startswith('Entry '):
+                sch.buses += 1
+             elif line.startswith('Connection '):
+                args = line.split()
+                sch.junctions.append((int(args[2]), int(args[3])))
+             elif line.startswith('NoConn '):
+                args = line.split()
+                sch.no_connects.append((int(args[2]), int(args[3])))
+             elif line.startswith('Text '):
+                args = line.split()
+                text = f.readline().rstrip('\n')
+                if args[1] in (LOCAL, GLOBAL, HIERARCHICAL):
+                   sch.labels.append(Label(args[1], int(args[2]), int(args[3]), text,
+                                           args[6] if args[1] != LOCAL and len(args) > 6 else None))
+    return sch
+
+
+def _parse_lib(file_name):
+    symbols = {}
+    sym = None
+    with open(file_name, 'rt', errors='replace') as f:
+         for line in f:
+             if line.startswith('DEF '):
+                args = line.split()
+                name = args[1].lstrip('~')
+                sym = LibSymbol(name, args[2], len(args) > 9 and args[9] == 'P')
+                symbols[name] = sym
+             elif sym is None:
+                continue
+             elif line.startswith('X '):
+                args = line.split()
+                if len(args) < 12:
+                   continue
+                sym.pins.append(LibPin(args[1], args[2], int(args[3]), int(args[4]), int(args[9]), int(args[10]),
+                                       args[11], args[12] if len(args) > 12 else ''))
+             elif line.startswith('ALIAS '):
+                for alias in line.split()[1:]:
+                    symbols[alias] = sym
+             elif line.startswith('F'):
+                args = _fields(line)
+                if args[0][1:].isdigit():
+                   sym.fields[int(args[0][1:])] = args[1]
+             elif line.startswith('ENDDEF'):
+                sym = None
+    return symbols
+
+
+def _load(file_name, parser):
+    real = os.path.realpath(file_name)
+    st = os.stat(real)
+    stamp = (st.st_mtime_ns, st.st_size)
+    cached = _loaded.get(real)
+    if cached and cached[0] == stamp:
+       return cached[1]
+    obj = parser(real)
+    _loaded[real] = (stamp, obj)
+    return obj
+
+
+def load_sch(file_name):
+    """Parses a .sch file, the result is cached until the file changes"""
+    return _load(file_name, _parse_sch)
+
+
+def load_lib(file_name):
+    """Parses a .lib file, returns a dict name -> LibSymbol"""
+    return _load(file_name, _parse_lib)
+
+
+def cache_lib_name(root_sch):
+    return os.path.splitext(root_sch)[0]+'-cache.lib'
+
+
+def find_symbol(symbols, lib_id):
+    """The -cache.lib uses LIB_NAME instead of LIB:NAME"""
+    return symbols.get(lib_id.replace(':', '_')) or symbols.get(lib_id.split(':')[-1])
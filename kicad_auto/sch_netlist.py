@@ -0,0 +1,205 @@
+"""Schematic netlist
+
+Writes the KiCad netlist (.net, S-expression format version D) of a
+legacy hierarchical schematic, using the nets solved by
+sch_connectivity, so eeschema isn't needed.
+
+Two netlists can be compared using compare(), it checks the connectivity
+(the pins of each net) and the components, the net codes and the names
+of the unnamed nets aren't compared.
+"""
+import os
+import re
+import time
+
+from kicad_auto import sexp
+from kicad_auto.sch_connectivity import (Design, natural_key)
+
+from kicad_auto import log
+logger = log.get_logger(__name__)
+
+# Pin types, as used in the netlist
+PIN_TYPES = {
+    'I': 'input',
+    'O': 'output',
+    'B': 'BiDi',
+    'T': '3state',
+    'P': 'passive',
+    'U': 'unspc',
+    'W': 'power_in',
+    'w': 'power_out',
+    'C': 'openCol',
+    'E': 'openEm',
+    'N': 'NotConnected',
+}
+NEEDS_QUOTES = re.compile(r'[\s()"\\]')
+
+
+def quote(text):
+    """Quotes the string if needed, like KiCad does"""
+    if text and not NEEDS_QUOTES.search(text):
+       return text
+    return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _lib_part(lib_id):
+    """(library nickname, part name)"""
+    if ':' in lib_id:
+       return lib_id.split(':', 1)
+    return '', lib_id
+
+
+def _is_virtual(ref):
+    """Power symbols and flags aren't in the netlist"""
+    return ref.startswith('#')
+
+
+def _components(design, out):
+    out.append('  (components')
+    seen = set()
+    comps = []
+    for ref, comp, sheet in design.components():
+        if _is_virtual(ref) or ref in seen:
+           # Multi-unit components are listed once
+           continue
+        seen.add(ref)
+        comps.append((ref, comp, sheet))
+    comps.sort(key=lambda c: natural_key(c[0]))
+    for ref, comp, sheet in comps:
+        out.append('    (comp (ref {})'.format(quote(ref)))
+        out.append('      (value {})'.format(quote(comp.fields.get(1, ''))))
+        if comp.fields.get(2):
+           out.append('      (footprint {})'.format(quote(comp.fields[2])))
+        if comp.fields.get(3):
+           out.append('      (datasheet {})'.format(quote(comp.fields[3])))
+        fields = [(name, value) for name, value in comp.named_fields if value]
+        if fields:
+           out.append('      (fields')
+           for name, value in fields:
+               out.append('        (field (name {}) {})'.format(quote(name), quote(value)))
+           out[-1] += ')'
+        lib, part = _lib_part(comp.lib_id)
+        out.append('      (libsource (lib {}) (part {}) (description ""))'.format(quote(lib), quote(part)))
+        out.append('      (sheetpath (names {}) (tstamps {}))'.format(quote(sheet.name_path), quote(sheet.path)))
+        out.append('      (tstamp {}))'.format(quote(comp.timestamp)))
+    out[-1] += ')'
+
+
+def _libparts(design, out):
+    out.append('  (libparts')
+    lib_ids = sorted(set(comp.lib_id for ref, comp, sheet in design.components() if not _is_virtual(ref)))
+    for lib_id in lib_ids:
+        symbol = design.symbol(lib_id)
+        if symbol is None:
+           continue
+        lib, part = _lib_part(lib_id)
+        out.append('    (libpart (lib {}) (part {})'.format(quote(lib), quote(part)))
+        out.append('      (fields')
+        out.append('        (field (name Reference) {})'.format(quote(symbol.reference)))
+        out.append('        (field (name Value) {}))'.format(quote(part)))
+        pins = {}
+        for pin in symbol.pins:
+            pins.setdefault(pin.number, pin)
+        out.append('      (pins')
+        for number in sorted(pins, key=natural_key):
+            pin = pins[number]
+            out.append('        (pin (num {}) (name {}) (type {}))'.format(quote(number), quote(pin.name),
+                                                                          PIN_TYPES.get(pin.type, 'unspc')))
+        out[-1] += '))'
+    out[-1] += ')'
+
+
+def _nets(design, out):
+    out.append('  (nets')
+    code = 0
+    for net in design.nets:
+        pins = [p for p in net.pins if not _is_virtual(p.ref)]
+        if not pins:
+           continue
+        code += 1
+        out.append('    (net (code {}) (name {})'.format(code, quote(net.name)))
+        seen = set()
+        for pin in pins:
+            if (pin.ref, pin.number) in seen:
+               continue
+            seen.add((pin.ref, pin.number))
+            function = ' (pinfunction {})'.format(quote(pin.lib_pin.name)) if pin.lib_pin.name != '~' else ''
+            out.append('      (node (ref {}) (pin {}){})'.format(quote(pin.ref), quote(pin.number), function))
+        out[-1] += ')'
+    out[-1] += ')'
+
+
+def write_netlist(design, net_file):
+    """Writes the netlist of a Design"""
+    out = ['(export (version D)', '  (design']
+    out.append('    (source {})'.format(quote(design.root_sch)))
+    out.append('    (date {})'.format(quote(time.strftime('%a %d %b %Y %H:%M:%S'))))
+    out.append('    (tool "kicad_auto netlister")')
+    for n, sheet in enumerate(design.sheets, 1):
+        out.append('    (sheet (number {}) (name {}) (tstamps {})'.format(n, quote(sheet.name_path), quote(sheet.path)))
+        out.append('      (title_block')
+        out.append('        (source {})))'.format(quote(os.path.basename(sheet.sch.file_name))))
+    out[-1] += ')'
+    _components(design, out)
+    _libparts(design, out)
+    _nets(design, out)
+    out[-1] += ')'
+    with open(net_file, 'w') as f:
+         f.write('\n'.join(out)+'\n')
+
+
+def netlist(sch_file, net_file):
+    """Creates the netlist for the schematic, returns the Design.
+       Raises ValueError (SchError) if the files are malformed."""
+    start = time.time()
+    design = Design(sch_file)
+    bus_sheets = design.bus_sheets
+    if bus_sheets:
+       logger.warning('Buses aren\'t followed, the netlist can differ from the eeschema one. Sheets with buses: '+
+                      ', '.join(s.name_path for s in bus_sheets))
+    write_netlist(design, net_file)
+    logger.debug('Netlist generated in {:.3f} s'.format(time.time() - start))
+    return design
+
+
+def load_nets(net_file):
+    """Reads a .net file, returns the components (dict ref -> value) and
+       the nets (dict name -> set of (ref, pin))"""
+    sections = sexp.load_sections(net_file, ['components', 'nets'])
+    comps = {}
+    for comp in sections.get('components', ['components'])[1:]:
+        values = {item[0]: item[1] for item in comp[1:] if isinstance(item, list) and len(item) > 1}
+        comps[values.get('ref')] = values.get('value')
+    nets = {}
+    for net in sections.get('nets', ['nets'])[1:]:
+        values = {item[0]: item for item in net[1:] if isinstance(item, list) and len(item) > 1}
+        nodes = set()
+        for item in net[1:]:
+            if isinstance(item, list) and item[0] == 'node':
+               node = {v[0]: v[1] for v in item[1:] if isinstance(v, list) and len(v) > 1}
+               nodes.add((node.get('ref'), node.get('pin')))
+        nets[values['name'][1] if 'name' in values else ''] = nodes
+    return comps, nets
+
+
+def compare(net_file_a, net_file_b):
+    """Compares two netlists, returns a list with the differences"""
+    comps_a, nets_a = load_nets(net_file_a)
+    comps_b, nets_b = load_nets(net_file_b)
+    diffs = []
+    for ref in sorted(set(comps_a) | set(comps_b), key=lambda r: natural_key(r or '')):
+        if comps_a.get(ref) != comps_b.get(ref):
+           diffs.append('Component {}: {} vs {}'.format(ref, comps_a.get(ref), comps_b.get(ref)))
+    # Compare the connectivity, the names of the unnamed nets depend on the tool
+    groups_a = {frozenset(nodes): name for name, nodes in nets_a.items()}
+    groups_b = {frozenset(nodes): name for name, nodes in nets_b.items()}
+    for nodes in set(groups_a) - set(groups_b):
+        diffs.append('Net {} only in {}: {}'.format(groups_a[nodes], net_file_a, sorted(nodes)))
+    for nodes in set(groups_b) - set(groups_a):
+        diffs.append('Net {} only in {}: {}'.format(groups_b[nodes], net_file_b, sorted(nodes)))
+    for nodes in set(groups_a) & set(groups_b):
+        a = groups_a[nodes]
+        b = groups_b[nodes]
+        if a != b and not (a.startswith('Net-(') and b.startswith('Net-(')):
+           diffs.append('Net {} is named {} in {}'.format(a, b, net_file_b))
+    return diffs
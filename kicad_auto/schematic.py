@@ -0,0 +1,102 @@
+"""Schematic hierarchy
+
+Reads the sheet hierarchy from legacy (KiCad 5) .sch files, using the
+$Sheet blocks of each file:
+
+$Sheet
+S 4100 2000 1300 900
+U 5E8B3C1A
+F0 "Power" 50
+F1 "power.sch" 50
+$EndSheet
+
+The pages are listed in the order eeschema numbers them: depth first, in
+the order the sheets appear in the file.
+"""
+import hashlib
+import os
+import re
+
+from kicad_auto import log
+logger = log.get_logger(__name__)
+
+# eeschema uses the page number when the name gets longer than this
+MAX_PLOT_NAME = 50
+
+
+class Sheet(object):
+    def __init__(self, path, file_name, number):
+        # Human readable path, i.e. /Power/
+        self.path = path
+        self.file_name = file_name
+        # Page number, starting from 1
+        self.number = number
+
+    def plot_name(self, root_name):
+        """Name eeschema uses when plotting this page alone, without extension"""
+        if len(root_name) + len(self.path) < MAX_PLOT_NAME:
+           return (root_name + self.path).replace('/', '-')[:-1]
+        return root_name + '-' + str(self.number)
+
+
+def _read_sheets(sch_file):
+    """Returns the (name, file) of the sheets used in a .sch"""
+    sheets = []
+    in_sheet = False
+    name = file_name = None
+    with open(sch_file, 'rt', errors='replace') as f:
+         for line in f:
+             if line.startswith('$Sheet'):
+                in_sheet = True
+                name = file_name = None
+             elif line.startswith('$EndSheet'):
+                in_sheet = False
+                if file_name:
+                   sheets.append((name or '', file_name))
+             elif in_sheet:
+                m = re.match(r'F([01]) "(.*)" ', line)
+                if m:
+                   if m.group(1) == '0':
+                      name = m.group(2)
+                   else:
+                      file_name = m.group(2)
+    return sheets
+
+
+def load_hierarchy(root_sch):
+    """Returns the list of pages (Sheet objects) of the schematic"""
+    pages = []
+
+    def add(sch_file, path, parents):
+        pages.append(Sheet(path, sch_file, len(pages)+1))
+        if not os.path.isfile(sch_file):
+           logger.warning('Missing sheet '+sch_file)
+           return
+        dir_name = os.path.dirname(sch_file)
+        for name, file_name in _read_sheets(sch_file):
+            sub_file = os.path.normpath(os.path.join(dir_name, file_name))
+            if sub_file in parents:
+               raise ValueError('Recursive sheet '+sub_file)
+            add(sub_file, path + name + '/', parents + [sub_file])
+
+    root = os.path.abspath(root_sch)
+    add(root, '/', [root])
+    return pages
+
+
+def sheet_files(root_sch):
+    """All the .sch files used by the schematic, without repetitions"""
+    files = []
+    for sheet in load_hierarchy(root_sch):
+        if sheet.file_name not in files:
+           files.append(sheet.file_name)
+    return files
+
+
+def hash_file(file_name):
+    h = hashlib.sha256()
+    if os.path.isfile(file_name):
+       with open(file_name, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+    return h.hexdigest()
@@ -0,0 +1,130 @@
+"""S-expression reader
+
+Streaming reader for the KiCad S-expression files (i.e. .kicad_pcb).
+The file is memory mapped and tokenized on demand, so we can stop as soon
+as we have the sections we need, without reading the rest of the file.
+Lists are returned as Python lists, atoms as strings.
+"""
+import mmap
+import re
+
+# Optional spaces followed by: ( | ) | "string" | atom
+TOKEN = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"]+))')
+TRAILING_SPACE = re.compile(rb'\s*')
+ESCAPE = re.compile(r'\\(.)')
+OPEN = object()
+CLOSE = object()
+
+
+class SexpError(ValueError):
+    pass
+
+
+def tokens(data, pos=0):
+    """Yields OPEN, CLOSE or the atoms (str) found in data (bytes like)"""
+    end = len(data)
+    match = TOKEN.match
+    while pos < end:
+        m = match(data, pos)
+        if m is None:
+           if TRAILING_SPACE.match(data, pos).end() == end:
+              return
+           raise SexpError('Syntax error at byte %d' % pos)
+        pos = m.end()
+        if m.group(1):
+           yield OPEN
+        elif m.group(2):
+           yield CLOSE
+        elif m.group(4) is not None:
+           yield m.group(4).decode('utf-8', 'replace')
+        else:
+           yield ESCAPE.sub(r'\1', m.group(3).decode('utf-8', 'replace'))
+
+
+def read_list(tks):
+    """Reads a list, the opening parenthesis was already consumed"""
+    stack = [[]]
+    for t in tks:
+        if t is OPEN:
+           stack.append([])
+        elif t is CLOSE:
+           done = stack.pop()
+           if not stack:
+              return done
+           stack[-1].append(done)
+        else:
+           stack[-1].append(t)
+    raise SexpError('Unexpected end of file')
+
+
+def skip_list(tks):
+    """Skips a list, the opening parenthesis was already consumed"""
+    depth = 1
+    for t in tks:
+        if t is OPEN:
+           depth += 1
+        elif t is CLOSE:
+           depth -= 1
+           if not depth:
+              return
+    raise SexpError('Unexpected end of file')
+
+
+def iter_sections(file_name, names):
+    """Yields all the top level sections whose name is in names, i.e. all the
+       `gr_line` of a .kicad_pcb, in file order. The rest are skipped
+       without building them."""
+    names = set(names)
+    with open(file_name, 'rb') as f:
+         try:
+             data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+         except ValueError:
+             # Empty file
+             raise SexpError(file_name+' is empty')
+         try:
+             tks = tokens(data)
+             if next(tks, None) is not OPEN:
+                raise SexpError(file_name+' is not an S-expression file')
+             # The name of the file type
+             next(tks, None)
+             for t in tks:
+                 if t is CLOSE:
+                    break
+                 if t is not OPEN:
+                    continue
+                 name = next(tks, None)
+                 if name is None:
+                    raise SexpError('Unexpected end of file')
+                 if name is OPEN:
+                    # A list starting with a list
+                    skip_list(tks)
+                    skip_list(tks)
+                 elif name is CLOSE:
+                    continue
+                 elif name in names:
+                    yield [name] + read_list(tks)
+                 else:
+                    skip_list(tks)
+         finally:
+             # Release the generator before the map
+             tks = None
+             data.close()
+
+
+def load_sections(file_name, names):
+    """Reads the first top level section for each name, i.e. `layers` from
+       `(kicad_pcb (version 20171130) (layers ...) ...)`.
+       Returns a dict with the sections found, stops reading when all are
+       found."""
+    names = set(names)
+    found = {}
+    sections = iter_sections(file_name, names)
+    try:
+        for section in sections:
+            if section[0] not in found:
+               found[section[0]] = section
+               if len(found) == len(names):
+                  break
+    finally:
+        sections.close()
+    return found
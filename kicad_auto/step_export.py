@@ -0,0 +1,65 @@
+"""Headless STEP export
+
+Exports the 3D model of a PCB using kicad2step, the converter used by the
+File->Export->STEP dialog of pcbnew. No X server is needed, so several
+exports can run in parallel.
+
+The board center origin is computed from the Edge.Cuts drawings, like
+the dialog does.
+"""
+import os
+import shutil
+import subprocess
+
+from kicad_auto.kicad_pcb import board_center
+
+from kicad_auto import log
+logger = log.get_logger(__name__)
+
+KICAD2STEP = 'kicad2step'
+# Return error codes
+STEP_EXPORT_FAILED = 5
+NO_KICAD2STEP = 6
+# Supported origins
+ORIGINS = ('board_center', 'drill', 'grid')
+
+
+def kicad2step_command(pcb_file, step_file, origin='board_center', overwrite=True, no_virtual=False):
+    """Returns the kicad2step command line.
+       Raises ValueError (SexpError) if the board center can't be computed."""
+    cmd = [shutil.which(KICAD2STEP) or KICAD2STEP]
+    if origin == 'board_center':
+       x, y = board_center(pcb_file)
+       cmd.append('--user-origin=%.6fx%.6fmm' % (x, y))
+    elif origin == 'drill':
+       cmd.append('--drill-origin')
+    elif origin == 'grid':
+       cmd.append('--grid-origin')
+    else:
+       raise ValueError('Unknown STEP origin `{}`'.format(origin))
+    if overwrite:
+       cmd.append('-f')
+    if no_virtual:
+       cmd.append('--no-virtual')
+    cmd.extend(['-o', step_file, pcb_file])
+    return cmd
+
+
+def export_step(pcb_file, step_file, origin='board_center', overwrite=True, no_virtual=False):
+    """Exports the STEP model, returns 0 on success or an error code.
+       Raises ValueError if the origin can't be computed."""
+    if not overwrite and os.path.exists(step_file):
+       logger.error(step_file+' already exists')
+       return STEP_EXPORT_FAILED
+    if shutil.which(KICAD2STEP) is None:
+       logger.error('No `{}` command found'.format(KICAD2STEP))
+       return NO_KICAD2STEP
+    cmd = kicad2step_command(pcb_file, step_file, origin, overwrite, no_virtual)
+    logger.debug('Running: '+str(cmd))
+    res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+    output = res.stdout.decode('utf-8', 'replace')
+    if res.returncode or not os.path.isfile(step_file):
+       logger.error('{} failed ({}):\n{}'.format(KICAD2STEP, res.returncode, output))
+       return STEP_EXPORT_FAILED
+    logger.debug(output)
+    return 0
@@ -0,0 +1,181 @@
+"""STEP files
+
+Changes the metadata in the header of a STEP file (ISO 10303-21):
+
+HEADER;
+FILE_DESCRIPTION(('KiCad electronic assembly'),'2;1');
+FILE_NAME('board.step','2020-01-01T00:00:00',('An Author'),('A Company'),
+  'Open CASCADE STEP processor 7.3','Open CASCADE STEP translator 7.3 1','Unknown');
+FILE_SCHEMA(('AUTOMOTIVE_DESIGN { 1 0 10303 214 1 1 1 1 }'));
+ENDSEC;
+
+Only the header is read. When the new header fits in the space of the old
+one it is patched in place, padded with spaces. Otherwise the file is
+copied, using copy_file_range when available, so the data doesn't go
+through Python.
+"""
+import os
+import re
+import shutil
+
+from kicad_auto import log
+logger = log.get_logger(__name__)
+
+# The header is at the beginning, we give up if we don't find it here
+MAX_HEADER = 1 << 20
+TOKEN = re.compile(r"\s*(?:/\*.*?\*/\s*)*('(?:[^']|'')*'|[(),;=]|[^\s(),;='/]+)", re.S)
+# Index of the FILE_NAME fields
+FILE_NAME_AUTHOR = 2
+FILE_NAME_ORGANIZATION = 3
+FILE_NAME_ORIGINATING_SYSTEM = 5
+
+
+class StepError(ValueError):
+    pass
+
+
+def encode_string(value):
+    """Quoted STEP string, non-ASCII chars use the \\X2\\ encoding"""
+    out = []
+    for c in value:
+        if c == "'":
+           out.append("''")
+        elif c == '\\':
+           out.append('\\\\')
+        elif ord(c) < 32 or ord(c) > 126:
+           out.append('\\X2\\%04X\\X0\\' % ord(c) if ord(c) < 0x10000 else
+                      '\\X4\\%08X\\X0\\' % ord(c))
+        else:
+           out.append(c)
+    return "'" + ''.join(out) + "'"
+
+
+def _params(tks):
+    """Reads a parameter list, the opening parenthesis was already consumed.
+       The values are the source text, lists are Python lists."""
+    values = []
+    for t in tks:
+        if t == ')':
+           return values
+        if t == '(':
+           values.append(_params(tks))
+        elif t != ',':
+           values.append(t)
+    raise StepError('Unexpected end of header')
+
+
+def _format(values):
+    return '(' + ','.join(_format(v) if isinstance(v, list) else v for v in values) + ')'
+
+
+def _tokens(text, pos, positions):
+    """Yields the tokens, stores the end of each one in positions[0]"""
+    match = TOKEN.match
+    while True:
+        m = match(text, pos)
+        if m is None:
+           return
+        pos = m.end()
+        positions[0] = pos
+        yield m.group(1)
+
+
+def read_header(data):
+    """Parses the HEADER section of data (str).
+       Returns (start, end, entities), where start and end are the limits of
+       the entities and entities a list of (name, parameters)."""
+    m = re.search(r'HEADER\s*;', data)
+    if m is None:
+       raise StepError('No HEADER section')
+    pos = [m.end()]
+    start = m.end()
+    entities = []
+    tks = _tokens(data, start, pos)
+    while True:
+        end = pos[0]
+        name = next(tks, None)
+        if name is None:
+           raise StepError('Unexpected end of header')
+        if name == 'ENDSEC':
+           return start, end, entities
+        if next(tks, None) != '(':
+           raise StepError('Malformed header entity '+name)
+        entities.append((name, _params(tks)))
+        if next(tks, None) != ';':
+           raise StepError('Malformed header entity '+name)
+
+
+def _set(params, index, value, as_list=False):
+    if value is None:
+       return
+    if index >= len(params):
+       raise StepError('Missing header field')
+    params[index] = [encode_string(value)] if as_list else encode_string(value)
+
+
+def _copy_rest(src, dst, offset):
+    """Copies src from offset to the end of dst, avoiding user space copies"""
+    size = os.fstat(src.fileno()).st_size - offset
+    src.seek(offset)
+    dst.flush()
+    copy = getattr(os, 'copy_file_range', None)
+    try:
+        while size > 0:
+            if copy:
+               n = copy(src.fileno(), dst.fileno(), size, offset)
+            else:
+               n = os.sendfile(dst.fileno(), src.fileno(), offset, size)
+            if not n:
+               break
+            offset += n
+            size -= n
+        if size <= 0:
+           return
+    except OSError as e:
+        # i.e. not supported by the file system
+        logger.debug('Zero-copy failed: '+str(e))
+    dst.seek(0, os.SEEK_END)
+    src.seek(offset)
+    shutil.copyfileobj(src, dst)
+
+
+def patch_header(step_file, description=None, author=None, organization=None, originating_system=None):
+    """Changes the header fields that aren't None.
+       Returns True if the file was patched in place."""
+    with open(step_file, 'rb') as f:
+         head = f.read(MAX_HEADER)
+    # Part 21 files are ASCII, latin-1 keeps the offsets
+    text = head.decode('latin-1')
+    start, end, entities = read_header(text)
+    new = []
+    for name, params in entities:
+        if name == 'FILE_DESCRIPTION':
+           _set(params, 0, description, as_list=True)
+        elif name == 'FILE_NAME':
+           _set(params, FILE_NAME_AUTHOR, author, as_list=True)
+           _set(params, FILE_NAME_ORGANIZATION, organization, as_list=True)
+           _set(params, FILE_NAME_ORIGINATING_SYSTEM, originating_system)
+        new.append('\n' + name + _format(params) + ';')
+    header = ''.join(new) + '\n'
+    old_len = end - start
+    if len(header) <= old_len:
+       # Spaces are allowed between the tokens
+       header = header + ' '*(old_len - len(header))
+       with open(step_file, 'r+b') as f:
+            f.seek(start)
+            f.write(header.encode('latin-1'))
+       logger.debug('STEP header patched in place')
+       return True
+    tmp = step_file + '.tmp'
+    try:
+        with open(step_file, 'rb') as src, open(tmp, 'wb') as dst:
+             dst.write(head[:start])
+             dst.write(header.encode('latin-1'))
+             _copy_rest(src, dst, end)
+        os.replace(tmp, step_file)
+    except BaseException:
+        if os.path.exists(tmp):
+           os.remove(tmp)
+        raise
+    logger.debug('STEP header rewritten')
+    return False
@@ -22,17 +22,16 @@
 
 import logging
 import os
+import select
 import subprocess
 import sys
 import tempfile
 import time
-import shutil
 
 from contextlib import contextmanager
 
-# python3-xvfbwrapper
-from xvfbwrapper import Xvfb
 from kicad_auto import file_util
+from kicad_auto import x11
 
 from kicad_auto import log
 logger = log.get_logger(__name__)
@@ -52,34 +51,69 @@ class PopenContext(subprocess.Popen):
         # Wait for the process to terminate, to avoid zombies.
         self.wait()
 
-def wait_xserver():
-    timeout = 10
-    DELAY = 0.5
-    logger.debug('Waiting for virtual X server ...')
-    if shutil.which('setxkbmap'):
-       cmd = ['setxkbmap', '-query']
-    elif shutil.which('setxkbmap'):
-       cmd = ['xset', 'q']
+# Set when the job runs in a display leased from a pool (see display_pool)
+LEASE_ENV = 'KICAD_AUTO_DISPLAY'
+
+def start_xvfb(width, height, colordepth, timeout=10):
+    """Starts a virtual X server, returns the process and the display name.
+       Xvfb reports the display number using -displayfd once it accepts
+       connections, so no polling is needed."""
+    r, w = os.pipe()
+    with open(os.devnull, 'w') as fnull:
+         proc = subprocess.Popen(['Xvfb', '-displayfd', str(w), '-nolisten', 'tcp',
+                                  '-screen', '0', '%dx%dx%d' % (width, height, colordepth)],
+                                 pass_fds=(w,), stdout=fnull, stderr=subprocess.STDOUT)
+    os.close(w)
+    data = b''
+    try:
+        end = time.time() + timeout
+        while not data.endswith(b'\n'):
+            left = end - time.time()
+            if left <= 0 or not select.select([r], [], [], left)[0]:
+               raise RuntimeError('Timed out waiting for virtual X server')
+            chunk = os.read(r, 16)
+            if not chunk:
+               raise RuntimeError('Virtual X server failed to start')
+            data += chunk
+    except RuntimeError:
+        proc.kill()
+        proc.wait()
+        raise
+    finally:
+        os.close(r)
+    display = ':' + data.decode().strip()
+    logger.debug('Virtual X server %s ready (pid %d)', display, proc.pid)
+    return proc, display
+
+@contextmanager
+def xvfb(width, height, colordepth):
+    """Runs a virtual X server and points DISPLAY to it.
+       A display leased from a pool is used instead if available."""
+    old_display = os.environ.get('DISPLAY')
+    proc = None
+    if os.environ.get(LEASE_ENV):
+       display = os.environ[LEASE_ENV]
+       logger.debug('Using leased display '+display)
     else:
-       cmd = ['ls']
-       logger.warning('No setxkbmap nor xset available, unable to verify if X is running')
-    for i in range(int(timeout/DELAY)):
-        with open(os.devnull, 'w') as fnull:
-             logger.debug('Checking using '+str(cmd))
-             ret = subprocess.call(cmd,stdout=fnull,stderr=subprocess.STDOUT,close_fds=True)
-             #ret = subprocess.call(['xset', 'q'])
-        if not ret:
-           return
-        logger.debug('   Retry')
-        time.sleep(DELAY)
-    raise RuntimeError('Timed out waiting for virtual X server')
+       proc, display = start_xvfb(width, height, colordepth)
+    os.environ['DISPLAY'] = display
+    try:
+        yield display
+    finally:
+        x11.close()
+        if old_display is None:
+           del os.environ['DISPLAY']
+        else:
+           os.environ['DISPLAY'] = old_display
+        if proc:
+           proc.terminate()
+           proc.wait()
 
 @contextmanager
 def recorded_xvfb(video_dir, video_name, **xvfb_args):
     if video_dir:
        video_filename = os.path.join(video_dir, video_name)
-       with Xvfb(**xvfb_args):
-           wait_xserver()
+       with xvfb(**xvfb_args):
            fnull = open(os.devnull, 'w')
            logger.debug('Recording session to %s', video_filename)
            with PopenContext([
@@ -95,19 +129,58 @@ def recorded_xvfb(video_dir, video_name, **xvfb_args):
                yield
                screencast_proc.terminate()
     else:
-       with Xvfb(**xvfb_args):
-           wait_xserver()
+       with xvfb(**xvfb_args):
            yield
 
 
+def xdotool_inprocess(command):
+    """Runs the most common xdotool commands using the X connection we
+       already have. Returns None if the command isn't supported."""
+    cmd = command[0]
+    if cmd == 'key' and not any(k.startswith('--') for k in command[1:]):
+       try:
+           x11.send_keys(command[1:])
+       except x11.UnsupportedKey as e:
+           logger.debug('Key `%s` not in the keyboard map, using xdotool', str(e))
+           return None
+       return b''
+    if cmd == 'windowfocus' and len(command) == 3 and command[1] == '--sync':
+       x11.focus_window(command[2])
+       wait_focused(command[2])
+       return b''
+    if cmd == 'windowfocus' and len(command) == 2:
+       x11.focus_window(command[1])
+       return b''
+    if cmd == 'getwindowfocus' and len(command) == 1:
+       return x11.get_focus()+b'\n'
+    if cmd == 'search' and command[1:3] == ['--onlyvisible', '--name'] and len(command) in (4, 5):
+       ids = x11.search_windows(command[3])
+       if not ids:
+          raise subprocess.CalledProcessError(1, ['xdotool'] + command)
+       if len(command) == 4:
+          return b''.join(id+b'\n' for id in ids)
+       if command[4] == 'windowfocus':
+          # Chained commands use the first window found
+          x11.focus_window(ids[0])
+          return b''
+    return None
+
 def xdotool(command):
+    if x11.has_xtest():
+       ret = xdotool_inprocess(command)
+       if ret is not None:
+          return ret
     return subprocess.check_output(['xdotool'] + command)
 
 def clipboard_store(string):
+    logger.debug('Clipboard store "'+string+'"')
+    if x11.available():
+       # We own the clipboard, no need to fork
+       x11.get_clipboard().store(string)
+       return
     # I don't know how to use Popen/run to make it run with pipes without
     # either blocking or losing the messages.
     # Using files works really well.
-    logger.debug('Clipboard store "'+string+'"')
     # Write the text to a file
     fd_in, temp_in = tempfile.mkstemp(text=True)
     os.write(fd_in, string.encode())
@@ -124,54 +197,84 @@ def clipboard_store(string):
     os.remove(temp_out)
     ret_text = ret_text.decode()
     if ret_text:
-       logger.error('Failed to store string in clipboard')
-       logger.error(ret_text)
-       raise
+       raise RuntimeError('Failed to store string in clipboard: '+ret_text)
     if ret_code:
-       logger.error('Failed to store string in clipboard')
-       logger.error('xclip returned %d' % ret_code)
-       raise
+       raise RuntimeError('Failed to store string in clipboard, xclip returned %d' % ret_code)
 
 def clipboard_retrieve():
-    p = subprocess.Popen(['xclip', '-o', '-selection', 'clipboard'], stdout=subprocess.PIPE)
-    output = '';
-    for line in p.stdout:
-        output += line.decode()
+    if x11.available():
+       output = x11.get_clipboard().retrieve()
+    else:
+       p = subprocess.Popen(['xclip', '-o', '-selection', 'clipboard'], stdout=subprocess.PIPE)
+       output = '';
+       for line in p.stdout:
+           output += line.decode()
+       p.wait()
     logger.debug('Clipboard retrieve "'+output+'"')
     return output;
 
 
+def search_windows(window_regex):
+    """Ids of the visible windows matching the regex, like `xdotool search`"""
+    if x11.available():
+       return x11.search_windows(window_regex)
+    try:
+        return xdotool(['search', '--onlyvisible', '--name', window_regex]).splitlines()
+    except subprocess.CalledProcessError:
+        return []
+
+def get_focused_window():
+    if x11.available():
+       return x11.get_focus()
+    return xdotool(['getwindowfocus']).rstrip()
+
+def wait_x_change(end, delay):
+    """Waits for a change in the X server, or `delay` seconds if we can't
+       get X events. Returns False if `end` time was reached."""
+    left = end - time.time()
+    if left <= 0:
+       return False
+    if x11.available():
+       x11.wait_event(left)
+    else:
+       time.sleep(min(delay, left))
+    return True
+
 def wait_focused(id, timeout=10):
     DELAY = 0.5
     logger.debug('Waiting for %s window to get focus...', id)
-    for i in range(int(timeout/DELAY)):
-        cur_id = xdotool(['getwindowfocus']).rstrip()
+    end = time.time() + timeout
+    while True:
+        cur_id = get_focused_window()
         logger.debug('Currently focused id: %s', cur_id)
         if cur_id==id:
            return
-        time.sleep(DELAY)
+        if not wait_x_change(end, DELAY):
+           break
     raise RuntimeError('Timed out waiting for %s window to get focus' % id)
 
 def wait_not_focused(id, timeout=10):
     DELAY = 0.5
     logger.debug('Waiting for %s window to lose focus...', id)
-    for i in range(int(timeout/DELAY)):
-        cur_id = xdotool(['getwindowfocus']).rstrip()
+    end = time.time() + timeout
+    while True:
+        cur_id = get_focused_window()
         logger.debug('Currently focused id: %s', cur_id)
         if cur_id!=id:
            return
-        time.sleep(DELAY)
+        if not wait_x_change(end, DELAY):
+           break
     raise RuntimeError('Timed out waiting for %s window to lose focus' % id)
 
 def wait_for_window(name, window_regex, timeout=10, focus=True, skip_id=0):
     DELAY = 0.5
     logger.info('Waiting for "%s" ...', name)
     if skip_id: logger.debug('Will skip %s', skip_id)
-    xdotool_command = ['search', '--onlyvisible', '--name', window_regex]
 
-    for i in range(int(timeout/DELAY)):
-        try:
-            window_id = xdotool(xdotool_command).splitlines()
+    end = time.time() + timeout
+    while True:
+        window_id = search_windows(window_regex)
+        if window_id:
             logger.debug('Found %s window (%d)', name, len(window_id))
             if len(window_id)==1:
                id = window_id[0]
@@ -186,7 +289,6 @@ def wait_for_window(name, window_regex, timeout=10, focus=True, skip_id=0):
                return window_id
             else:
                logger.debug('Skipped')
-        except subprocess.CalledProcessError:
-            pass
-        time.sleep(DELAY)
+        if not wait_x_change(end, DELAY):
+           break
     raise RuntimeError('Timed out waiting for %s window' % name)
@@ -0,0 +1,410 @@
+"""X11 helpers
+
+In-process access to the X server using python-xlib, used to avoid
+forking xdotool for each query and keystroke.
+Keystrokes are injected using the XTEST extension.
+python-xlib is optional: when it isn't installed, or the display can't be
+opened, available() returns False and the callers use xdotool.
+Window ids are returned as bytes with the decimal id, like xdotool does.
+"""
+import os
+import re
+import select
+import threading
+import time
+
+try:
+    from Xlib import X
+    from Xlib import XK
+    from Xlib import Xatom
+    from Xlib import display as xdisplay
+    from Xlib import error as xerror
+    from Xlib.ext import xtest
+    from Xlib.protocol import event as xevent
+    has_xlib = True
+except ImportError:
+    has_xlib = False
+
+from kicad_auto import log
+logger = log.get_logger(__name__)
+
+# Same aliases xdotool uses for the modifiers
+MODIFIERS = {'ctrl': 'Control_L', 'alt': 'Alt_L', 'shift': 'Shift_L', 'super': 'Super_L', 'meta': 'Meta_L'}
+# Like xdotool's default --delay
+KEY_DELAY = 0.012
+
+# Connection to the current DISPLAY, shared by all the helpers
+_display = None
+_display_name = None
+_watcher = None
+_clipboard = None
+
+
+def get_display():
+    global _display, _display_name, _watcher
+    name = os.environ.get('DISPLAY')
+    if _display is None or name != _display_name:
+       if _display is not None:
+          _display.close()
+          _display = None
+       _watcher = None
+       _display = xdisplay.Display(name)
+       _display_name = name
+    return _display
+
+
+def close():
+    """Closes the connection, i.e. before stopping the X server"""
+    global _display, _watcher, _clipboard
+    if _clipboard is not None:
+       _clipboard.close()
+       _clipboard = None
+    if _display is not None:
+       try:
+           _display.close()
+       except xerror.ConnectionClosedError:
+           pass
+    _display = None
+    _watcher = None
+
+
+def available():
+    if not has_xlib or not os.environ.get('DISPLAY'):
+       return False
+    try:
+        get_display()
+    except (xerror.DisplayError, xerror.ConnectionClosedError, OSError) as e:
+        logger.debug('No in-process X connection: '+str(e))
+        return False
+    return True
+
+
+def has_xtest():
+    return available() and get_display().has_extension('XTEST')
+
+
+class UnsupportedKey(ValueError):
+    pass
+
+
+def _keycodes(name):
+    """Keycodes to press for a key (i.e. Return, ctrl+v), modifiers first"""
+    d = get_display()
+    codes = []
+    keys = name.split('+')
+    for k in keys[:-1]:
+        keysym = XK.string_to_keysym(MODIFIERS.get(k.lower(), k))
+        code = d.keysym_to_keycode(keysym)
+        if not keysym or not code:
+           raise UnsupportedKey(name)
+        codes.append(code)
+    key = keys[-1]
+    keysym = XK.string_to_keysym(key)
+    if not keysym and len(key) == 1:
+       # Latin-1 chars use its code as keysym
+       keysym = ord(key)
+    # Keycodes bound to the keysym, index 1 means shifted
+    bound = list(d.keysym_to_keycodes(keysym)) if keysym else []
+    if not bound or bound[0][1] > 1:
+       # Not in the keyboard map, xdotool can remap a keycode for it
+       raise UnsupportedKey(name)
+    code, index = bound[0]
+    if index == 1:
+       codes.append(d.keysym_to_keycode(XK.string_to_keysym('Shift_L')))
+    codes.append(code)
+    return codes
+
+
+def send_keys(keys, delay=KEY_DELAY):
+    """Sends key strokes using XTEST, using the xdotool syntax (i.e. alt+f).
+       Raises UnsupportedKey, before sending anything, if a key isn't in
+       the keyboard map."""
+    d = get_display()
+    strokes = [_keycodes(k) for k in keys]
+    for codes in strokes:
+        for code in codes:
+            xtest.fake_input(d, X.KeyPress, code)
+        for code in reversed(codes):
+            xtest.fake_input(d, X.KeyRelease, code)
+        d.sync()
+        time.sleep(delay)
+
+
+def focus_window(id):
+    """Gives the input focus to the window (id as returned by search_windows)"""
+    d = get_display()
+    win = d.create_resource_object('window', int(id))
+    win.set_input_focus(X.RevertToParent, X.CurrentTime)
+    d.sync()
+
+
+def window_id(win):
+    return str(win.id).encode()
+
+
+def window_name(win):
+    d = get_display()
+    prop = win.get_full_property(d.intern_atom('_NET_WM_NAME'), d.intern_atom('UTF8_STRING'))
+    if prop:
+       name = prop.value
+    else:
+       name = win.get_wm_name()
+    if isinstance(name, bytes):
+       name = name.decode('utf-8', 'replace')
+    return name or ''
+
+
+def search_windows(window_regex):
+    """Visible windows whose name matches the regex, in the same order as
+       `xdotool search --onlyvisible --name`: all the children of a window
+       are checked before looking inside each one of them"""
+    regex = re.compile(window_regex, re.IGNORECASE)
+    found = []
+
+    def walk(win):
+        try:
+            children = win.query_tree().children
+        except xerror.BadWindow:
+            return
+        for child in children:
+            try:
+                if child.get_attributes().map_state == X.IsViewable and regex.search(window_name(child)):
+                   found.append(window_id(child))
+            except (xerror.BadWindow, xerror.BadMatch):
+                # Destroyed while we were looking at it
+                continue
+        for child in children:
+            walk(child)
+
+    walk(get_display().screen().root)
+    return found
+
+
+def get_focus():
+    """Id of the window with the input focus. Like `xdotool getwindowfocus`
+       goes up to the first window with WM_CLASS, the focus can be in a
+       child of the top level window (i.e. a GTK focus proxy)"""
+    d = get_display()
+    focus = d.get_input_focus().focus
+    # PointerRoot and None are reported as integers
+    if isinstance(focus, int):
+       return str(focus).encode()
+    root = d.screen().root
+    win = focus
+    try:
+        while win and win.id and win.id != root.id:
+            if win.get_wm_class() is not None:
+               return window_id(win)
+            win = win.query_tree().parent
+    except xerror.BadWindow:
+        # Destroyed while we were looking at it
+        pass
+    return window_id(focus)
+
+
+def display_is_clean(name):
+    """Checks the display has no clients (apart from us) nor top level
+       windows. Uses its own connection. Returns None if it can't be
+       checked (no python-xlib, X-Resource extension missing, etc.)"""
+    if not has_xlib:
+       return None
+    try:
+        d = xdisplay.Display(name)
+    except (xerror.DisplayError, xerror.ConnectionClosedError, OSError) as e:
+        logger.debug('Unable to check display {}: {}'.format(name, e))
+        return None
+    try:
+        windows = d.screen().root.query_tree().children
+        if windows:
+           logger.debug('Display {} has {} top level windows'.format(name, len(windows)))
+           return False
+        if not d.has_extension('X-Resource'):
+           return None
+        # Our own connection is one of the clients
+        clients = len(d.res_query_clients().clients) - 1
+        if clients:
+           logger.debug('Display {} has {} clients'.format(name, clients))
+        return clients == 0
+    except (xerror.XError, xerror.ConnectionClosedError) as e:
+        logger.debug('Unable to check display {}: {}'.format(name, e))
+        return None
+    finally:
+        d.close()
+
+
+class WindowWatcher(object):
+    """Wakes up the waiters when a window is created, mapped, renamed or
+       gets/loses the focus"""
+    EVENT_MASK = X.PropertyChangeMask | X.FocusChangeMask | X.StructureNotifyMask if has_xlib else 0
+
+    def __init__(self, display):
+        self.display = display
+        self.catch = xerror.CatchError(xerror.BadWindow)
+        root = display.screen().root
+        root.change_attributes(event_mask=X.SubstructureNotifyMask | X.PropertyChangeMask)
+        for win in root.query_tree().children:
+            self._watch(win)
+        display.sync()
+
+    def _watch(self, win):
+        # The window could be gone, ignore the error
+        win.change_attributes(event_mask=self.EVENT_MASK, onerror=self.catch)
+
+    def _process_events(self):
+        got = False
+        while self.display.pending_events():
+            ev = self.display.next_event()
+            got = True
+            if ev.type == X.CreateNotify or ev.type == X.MapNotify:
+               self._watch(ev.window)
+        return got
+
+    def wait(self, timeout):
+        """Waits until an X event arrives or the timeout expires"""
+        self.display.flush()
+        if self._process_events():
+           return
+        end = time.time() + timeout
+        while True:
+            left = end - time.time()
+            if left <= 0:
+               return
+            r, w, e = select.select([self.display.fileno()], [], [], left)
+            if not r:
+               return
+            if self._process_events():
+               return
+
+
+def wait_event(timeout):
+    """Sleeps until something changes in the X server, up to `timeout` seconds"""
+    global _watcher
+    d = get_display()
+    if _watcher is None or _watcher.display is not d:
+       _watcher = WindowWatcher(d)
+       # Changes before we started watching aren't reported, check again
+       return
+    _watcher.wait(timeout)
+
+
+class Clipboard(object):
+    """Owns the CLIPBOARD selection and serves its content from a thread,
+       like xclip does from a forked process.
+       Uses its own connection, the events are read by the thread."""
+    PROPERTY = 'KICAD_AUTO_CLIPBOARD'
+
+    def __init__(self, name):
+        self.name = name
+        self.display = xdisplay.Display(name)
+        self.window = self.display.screen().root.create_window(0, 0, 1, 1, 0, X.CopyFromParent)
+        self.atoms = {n: self.display.intern_atom(n) for n in
+                      ('CLIPBOARD', 'TARGETS', 'UTF8_STRING', 'STRING', 'TEXT', self.PROPERTY)}
+        self.catch = xerror.CatchError(xerror.BadWindow, xerror.BadAtom)
+        self.value = ''
+        self.retrieved = None
+        self.retrieved_event = threading.Event()
+        self.running = True
+        # Serializes the use of the connection
+        self.lock = threading.Lock()
+        self.wake_r, self.wake_w = os.pipe()
+        self.thread = threading.Thread(target=self._serve, name='clipboard', daemon=True)
+        self.thread.start()
+
+    def _wake(self):
+        os.write(self.wake_w, b'.')
+
+    def _owner(self):
+        owner = self.display.get_selection_owner(self.atoms['CLIPBOARD'])
+        return owner if isinstance(owner, int) else owner.id
+
+    def store(self, value):
+        with self.lock:
+            self.value = value
+            self.window.set_selection_owner(self.atoms['CLIPBOARD'], X.CurrentTime)
+            owner = self._owner()
+        # Events could be read by our requests
+        self._wake()
+        if owner != self.window.id:
+           raise RuntimeError('Failed to get the clipboard ownership')
+
+    def retrieve(self, timeout=2):
+        with self.lock:
+            if self._owner() == self.window.id:
+               return self.value
+            self.retrieved_event.clear()
+            self.window.convert_selection(self.atoms['CLIPBOARD'], self.atoms['UTF8_STRING'],
+                                          self.atoms[self.PROPERTY], X.CurrentTime)
+            self.display.flush()
+        self._wake()
+        if not self.retrieved_event.wait(timeout):
+           raise RuntimeError('Timed out waiting for the clipboard content')
+        return self.retrieved
+
+    def _answer(self, ev):
+        a = self.atoms
+        # Obsolete clients don't specify a property
+        prop = ev.property or ev.target
+        if ev.target == a['TARGETS']:
+           ev.requestor.change_property(prop, Xatom.ATOM, 32, [a['TARGETS'], a['UTF8_STRING'], a['STRING'], a['TEXT']],
+                                        onerror=self.catch)
+        elif ev.target == a['UTF8_STRING']:
+           ev.requestor.change_property(prop, a['UTF8_STRING'], 8, self.value.encode(), onerror=self.catch)
+        elif ev.target in (a['STRING'], a['TEXT']):
+           ev.requestor.change_property(prop, a['STRING'], 8, self.value.encode('latin-1', 'replace'),
+                                        onerror=self.catch)
+        else:
+           prop = X.NONE
+        notify = xevent.SelectionNotify(time=ev.time, requestor=ev.requestor, selection=ev.selection,
+                                        target=ev.target, property=prop)
+        ev.requestor.send_event(notify, onerror=self.catch)
+
+    def _got_selection(self, ev):
+        value = ''
+        if ev.property != X.NONE:
+           prop = self.window.get_full_property(ev.property, X.AnyPropertyType)
+           if prop:
+              value = prop.value.decode('utf-8', 'replace') if isinstance(prop.value, bytes) else str(prop.value)
+        self.retrieved = value
+        self.retrieved_event.set()
+
+    def _serve(self):
+        fd = self.display.fileno()
+        while self.running:
+            r, w, e = select.select([fd, self.wake_r], [], [])
+            if self.wake_r in r:
+               os.read(self.wake_r, 1024)
+            try:
+                with self.lock:
+                    while self.display.pending_events():
+                        ev = self.display.next_event()
+                        if ev.type == X.SelectionRequest:
+                           self._answer(ev)
+                        elif ev.type == X.SelectionNotify:
+                           self._got_selection(ev)
+                        elif ev.type == X.SelectionClear:
+                           logger.debug('Lost the clipboard ownership')
+                    self.display.flush()
+            except xerror.ConnectionClosedError:
+                return
+
+    def close(self):
+        self.running = False
+        self._wake()
+        self.thread.join()
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+        try:
+            self.display.close()
+        except xerror.ConnectionClosedError:
+            pass
+
+
+def get_clipboard():
+    """The clipboard service for the current DISPLAY"""
+    global _clipboard
+    name = os.environ.get('DISPLAY')
+    if _clipboard is None or _clipboard.name != name:
+       if _clipboard is not None:
+          _clipboard.close()
+       _clipboard = Clipboard(name)
+    return _clipboard
@@ -0,0 +1,118 @@
+"""Zip writer
+
+Writes a zip file compressing the entries in a pool of threads, zlib
+releases the GIL so the files are deflated in parallel. The entries are
+written in the same order they were added, as soon as they are ready, and
+the central directory is written by close().
+Doesn't support ZIP64, the files must be smaller than 4 GB.
+"""
+import hashlib
+import os
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from kicad_auto import log
+logger = log.get_logger(__name__)
+
+DEFAULT_LEVEL = 6
+# Name of the checksums file, in `sha256sum` format
+MANIFEST = 'SHA256SUMS'
+STORED = 0
+DEFLATED = 8
+# Flag for UTF-8 names
+UTF8 = 0x800
+MAX_SIZE = 0xFFFFFFFF
+
+
+def _dos_time(timestamp):
+    t = time.localtime(timestamp)
+    if t.tm_year < 1980:
+       return 0, (1 << 5) | 1
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+
+def _compress(data, level, checksum):
+    """Runs in the pool: returns (method, compressed data, crc, sha256)"""
+    crc = zlib.crc32(data)
+    sha = hashlib.sha256(data).hexdigest() if checksum else None
+    if level == 0:
+       return STORED, data, crc, sha
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return DEFLATED, c.compress(data) + c.flush(), crc, sha
+
+
+class ZipStreamWriter(object):
+    def __init__(self, file_name, level=DEFAULT_LEVEL, manifest=False, threads=None):
+        self.f = open(file_name, 'wb')
+        self.level = level
+        self.manifest = manifest
+        self.pool = ThreadPoolExecutor(threads or os.cpu_count() or 1)
+        # Submitted and not yet written: (name, size, mtime, future)
+        self.pending = []
+        # Written: (name, header fields, offset)
+        self.entries = []
+        self.checksums = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+           self.close()
+        else:
+           self.pool.shutdown(wait=True)
+           self.f.close()
+
+    def add(self, file_name, arcname):
+        """Adds a file, compressed in the background"""
+        with open(file_name, 'rb') as f:
+             data = f.read()
+        self._submit(arcname, data, os.path.getmtime(file_name))
+
+    def _submit(self, arcname, data, mtime):
+        if len(data) >= MAX_SIZE:
+           raise ValueError(arcname+' is too big for a zip file')
+        future = self.pool.submit(_compress, data, self.level, self.manifest)
+        self.pending.append((arcname, len(data), mtime, future))
+        self._write_ready()
+
+    def _write_ready(self, wait=False):
+        """Writes the entries already compressed, keeping the order"""
+        while self.pending and (wait or self.pending[0][3].done()):
+            arcname, size, mtime, future = self.pending.pop(0)
+            method, data, crc, sha = future.result()
+            if sha is not None:
+               self.checksums.append('{}  {}\n'.format(sha, arcname))
+            name = arcname.encode('utf-8')
+            flags = 0 if all(c < 128 for c in name) else UTF8
+            dtime, ddate = _dos_time(mtime)
+            fields = (20, flags, method, dtime, ddate, crc, len(data), size)
+            offset = self.f.tell()
+            self.f.write(struct.pack('<IHHHHHIIIHH', 0x04034b50, *fields, len(name), 0))
+            self.f.write(name)
+            self.f.write(data)
+            self.entries.append((name, fields, offset))
+
+    def close(self):
+        """Writes the pending entries, the manifest and the central directory"""
+        self._write_ready(wait=True)
+        if self.manifest:
+           # The manifest doesn't list itself
+           self.manifest = False
+           self._submit(MANIFEST, ''.join(self.checksums).encode(), time.time())
+           self._write_ready(wait=True)
+        self.pool.shutdown(wait=True)
+        start = self.f.tell()
+        for name, fields, offset in self.entries:
+            # Made by UNIX, mode rw-r--r--
+            self.f.write(struct.pack('<IH', 0x02014b50, (3 << 8) | 20))
+            self.f.write(struct.pack('<HHHHHIIIHHHHHII', *fields, len(name), 0, 0, 0, 0, 0o100644 << 16, offset))
+            self.f.write(name)
+        end = self.f.tell()
+        self.f.write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, len(self.entries), len(self.entries),
+                                 end - start, start, 0))
+        self.f.close()
+        logger.debug('Zip file with %d entries', len(self.entries))
@@ -15,6 +15,8 @@ setup(
     scripts=[
         'src/eeschema_do',
         'src/pcbnew_print_layers',
+        'src/pcbnew_do',
+        'src/kicad_pipeline',
         'src/pcbnew_run_drc'
     ],
     classifiers = [
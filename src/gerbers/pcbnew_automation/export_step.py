@@ -23,14 +23,20 @@ import sys
 import os
 import logging
 import argparse
+import time
 from xvfbwrapper import Xvfb
 
 pcbnew_dir = os.path.dirname(os.path.abspath(__file__))
 repo_root = os.path.dirname(pcbnew_dir)
 
 sys.path.append(repo_root)
+# For the 'kicad_auto' module, used for the output cache
+sys.path.append(os.path.dirname(os.path.dirname(repo_root)))
 
 from util import file_util
+from kicad_auto import cache
+from kicad_auto import step_file as step_header
+from kicad_auto import step_export
 from util.ui_automation import (
     PopenContext,
     xdotool,
@@ -42,6 +48,28 @@ from util.ui_automation import (
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# Return error codes (the export ones are in step_export)
+STEP_HEADER_FAILED = 7
+
+
+def get_step_file(pcb_file, output_dir):
+    board = ''.join(map(str, pcb_file.split('.')[0:-1]))
+    return os.path.join(os.path.abspath(output_dir), board + ".step")
+
+
+def run_export_step_headless(pcb_file, output_dir):
+    """Exports using kicad2step, no X server needed.
+       Returns the STEP file and the exit code."""
+    file_util.mkdir_p(output_dir)
+    step_file = get_step_file(pcb_file, output_dir)
+    file_util.mkdir_p(os.path.dirname(step_file))
+    try:
+        ret = step_export.export_step(pcb_file, step_file, origin='board_center', overwrite=True)
+    except ValueError as e:
+        logger.error(str(e))
+        ret = step_export.STEP_EXPORT_FAILED
+    return step_file, ret
+
 
 def run_export_step(pcb_file, output_dir, record=True):
 
@@ -49,8 +77,10 @@ def run_export_step(pcb_file, output_dir, record=True):
 
     recording_file = os.path.join(output_dir, 'run_export_step.ogv')
     
-    board = ''.join(map(str, pcb_file.split('.')[0:-1]))
-    step_file = os.path.join(os.path.abspath(output_dir), board + ".step")
+    step_file = get_step_file(pcb_file, output_dir)
+    # A file from a previous run would hide a failed export
+    if os.path.exists(step_file):
+        os.remove(step_file)
 
     xvfb_kwargs = {
 	    'width': 800,
@@ -61,7 +91,7 @@ def run_export_step(pcb_file, output_dir, record=True):
     with recorded_xvfb(recording_file, **xvfb_kwargs) if record else Xvfb(**xvfb_kwargs):
         with PopenContext(['pcbnew', pcb_file], close_fds=True) as pcbnew_proc:
 
-            print(step_file)
+            logger.debug('STEP file: '+step_file)
             clipboard_store(step_file.encode())
 
             window = wait_for_window('pcbnew', 'Pcbnew', 10, False)
@@ -100,8 +130,8 @@ def run_export_step(pcb_file, output_dir, record=True):
             try:
                 wait_for_window('STEP Export override dialog', 'STEP Export')
                 xdotool(['key', 'Return'])
-            except:
-                print("Timeout")
+            except RuntimeError:
+                logger.debug('No override dialog')
 
             logger.info('Close Export STEP modal window')
             xdotool(['key', 'Tab','Tab','Tab','Tab','Tab', 'Return'])
@@ -120,6 +150,56 @@ if __name__ == '__main__':
         action='store_true'
     )
 
+    parser.add_argument('--headless', help='Export using kicad2step, without running pcbnew',
+        action='store_true'
+    )
+
+    parser.add_argument('--description', help='Description stored in the STEP header')
+    parser.add_argument('--author', help='Author stored in the STEP header')
+    parser.add_argument('--organization', help='Organization stored in the STEP header')
+    parser.add_argument('--originating_system', help='Originating system stored in the STEP header')
+
+    parser.add_argument('--cache_dir', help='Reuse the outputs of previous runs stored in this dir',
+        default=os.environ.get(cache.CACHE_ENV)
+    )
+    parser.add_argument('--cache_size', help='Maximum size of the cache, in MB [%(default)s]',
+        type=int,
+        default=cache.DEFAULT_SIZE
+    )
+
     args = parser.parse_args()
 
-    export_result = run_export_step(args.kicad_pcb_file, args.output_dir, args.record)
+    # Reuse the outputs of a previous run
+    out_cache = cache.from_args(args)
+    if out_cache:
+        cache_key = out_cache.key('export_step', cache.pcb_inputs(args.kicad_pcb_file),
+                                  {'name': os.path.splitext(args.kicad_pcb_file)[0], 'description': args.description,
+                                   'author': args.author, 'organization': args.organization,
+                                   'originating_system': args.originating_system, 'headless': args.headless})
+        if out_cache.restore(cache_key, args.output_dir) is not None:
+            sys.exit(0)
+        start = time.time()
+
+    if args.headless:
+        export_result, ret = run_export_step_headless(args.kicad_pcb_file, args.output_dir)
+        if ret:
+            sys.exit(ret)
+    else:
+        export_result = run_export_step(args.kicad_pcb_file, args.output_dir, args.record)
+        if not os.path.isfile(export_result):
+            logger.error('STEP export failed, no '+export_result)
+            sys.exit(step_export.STEP_EXPORT_FAILED)
+
+    # Only the header is rewritten, the file can be huge
+    if args.description or args.author or args.organization or args.originating_system:
+        logger.info('Patching the STEP header')
+        try:
+            step_header.patch_header(export_result, args.description, args.author, args.organization,
+                                     args.originating_system)
+        except step_header.StepError as e:
+            logger.error('Unable to patch the STEP header: '+str(e))
+            sys.exit(STEP_HEADER_FAILED)
+
+    if out_cache:
+        out_cache.store(cache_key, args.output_dir, [os.path.relpath(export_result, os.path.abspath(args.output_dir))],
+                        start, 0)
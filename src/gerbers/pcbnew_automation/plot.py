@@ -18,75 +18,19 @@
 import argparse
 import logging
 import os
-import pcbnew
-import shutil
-import zipfile
-from PyPDF2 import PdfFileMerger, PdfFileReader
-from collections import namedtuple
+import sys
+import time
 
-import pcb_util
+# Look for the 'kicad_auto' module
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))))
+from kicad_auto import cache
+from kicad_auto import pcb_util
+from kicad_auto.pcb_plot import plot
+from kicad_auto.zip_util import (DEFAULT_LEVEL, MANIFEST)
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-def plot(pcb, file_format, layers, plot_directory):
-
-    temp_dir = os.path.join(plot_directory, 'temp')
-    shutil.rmtree(temp_dir, ignore_errors=True)
-    try:
-        os.makedirs(temp_dir)
-        plot_to_directory(pcb, file_format, layers, plot_directory, temp_dir)
-    finally:
-        shutil.rmtree(temp_dir, ignore_errors=True)
-
-def plot_to_directory(pcb, file_format, layers, plot_directory, temp_dir):
-    output_files = []
-
-    pcb.set_plot_directory(temp_dir)
-
-    logger.debug(file_format)
-
-    if file_format == 'zip_gerbers':
-        # In theory not needed since gerber does not support dril marks, but added just to be sure
-        pcb.plot_options.SetDrillMarksType(pcbnew.PCB_PLOT_PARAMS.NO_DRILL_SHAPE)
-
-        for layer in layers:
-            logger.debug('plotting layer {} ({}) to Gerber'.format(layer.get_name(), layer.layer_id))
-            output_filename = layer.plot(pcbnew.PLOT_FORMAT_GERBER)
-            output_files.append(output_filename)
-
-        drill_file = pcb.plot_drill()
-        if os.path.isfile(drill_file): # No drill file is generated if no holes exist
-            output_files.append(drill_file)
-
-        zip_file_name = os.path.join(plot_directory, '{}_gerbers.zip'.format(pcb.name))
-        with zipfile.ZipFile(zip_file_name, 'w') as z:
-            for f in output_files:
-                z.write(f, os.path.relpath(f, plot_directory))
-
-    elif file_format == 'pdf':
-        pcb.plot_options.SetDrillMarksType(pcbnew.PCB_PLOT_PARAMS.FULL_DRILL_SHAPE)
-        merger = PdfFileMerger()
-        for layer in layers:
-            logger.debug('plotting layer {} ({}) to PDF'.format(layer.get_name(), layer.layer_id))
-            output_filename = layer.plot(pcbnew.PLOT_FORMAT_PDF)
-            output_files.append(output_filename)
-            logger.debug(output_filename)
-
-            with open(output_filename, 'rb') as output_file:
-                pdf_file = PdfFileReader(output_file)
-                merger.append(pdf_file)
-
-        drill_map_file = pcb.plot_drill_map()
-
-        if os.path.isfile(drill_map_file): # No drill map file is generated if no holes exist
-
-            with open(drill_map_file, 'rb') as drill_file:
-                merger.append(PdfFileReader(drill_file))
-
-        merger.write(plot_directory+'/{}.pdf'.format(pcb.name))
-
-
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser('Plot a KiCad PCB layout')
@@ -104,9 +48,45 @@ if __name__ == '__main__':
         default='zip_gerbers'
     )
 
+    parser.add_argument('--jobs', '-j', help='Number of processes used to plot the layers, 0 means one '
+        'per CPU [%(default)s]',
+        type=int,
+        default=1
+    )
+
+    parser.add_argument('--zip_level', '-z', help='Compression level for the gerbers zip, 0 is no compression '
+        '[%(default)s]',
+        type=int,
+        choices=range(10),
+        default=DEFAULT_LEVEL
+    )
+
+    parser.add_argument('--manifest', '-m', help='Add the SHA-256 checksums of the gerbers to the zip ('+MANIFEST+')',
+        action='store_true'
+    )
+
+    parser.add_argument('--cache_dir', help='Reuse the outputs of previous runs stored in this dir',
+        default=os.environ.get(cache.CACHE_ENV)
+    )
+    parser.add_argument('--cache_size', help='Maximum size of the cache, in MB [%(default)s]',
+        type=int,
+        default=cache.DEFAULT_SIZE
+    )
+
     args = parser.parse_args()
+    output_dir = os.path.abspath(args.output_dir)
+
+    # Reuse the outputs of a previous run, no need to load the PCB
+    out_cache = cache.from_args(args)
+    if out_cache:
+        options = {'layers': args.layers, 'file_format': args.file_format, 'zip_level': args.zip_level,
+                   'manifest': args.manifest}
+        cache_key = out_cache.key('plot', cache.pcb_inputs(args.pcb_file), options)
+        if out_cache.restore(cache_key, output_dir) is not None:
+            sys.exit(0)
+        start = time.time()
 
-    pcb = pcb_util.PCB(args.pcb_file)
+    pcb = pcb_util.load_pcb(args.pcb_file)
 
     if len(args.layers) > 0:
         layers = []
@@ -116,4 +96,8 @@ if __name__ == '__main__':
         # TODO: figure out why this does not work
         layers = pcb.get_plot_enabled_layers()
 
-    plot(pcb, args.file_format, layers, os.path.abspath(args.output_dir))
+    plot(pcb, args.file_format, layers, output_dir, args.jobs or os.cpu_count(), args.zip_level, args.manifest)
+
+    if out_cache:
+        output_name = '{}_gerbers.zip' if args.file_format == 'zip_gerbers' else '{}.pdf'
+        out_cache.store(cache_key, output_dir, [output_name.format(pcb.name)], start, 0)
@@ -13,65 +13,511 @@
 #   limitations under the License.
 
 import logging
+import multiprocessing
+import os
 import re
-import xml
-from xml.dom import minidom
+import shutil
+import tempfile
+import xml.sax
+from xml.sax.handler import ContentHandler
+from xml.sax.saxutils import (XMLFilterBase, escape)
 
 """
 Processes SVG files generated by pcbnew to colorize and merge
+
+The files aren't loaded in memory. The operations are recorded and applied
+when writing, reading the input with SAX and passing the events through a
+chain of filters, so the memory used doesn't depend on the size of the SVG.
+SvgProcessor writes only the root element, like the minidom version did.
+The comments aren't copied.
+
+compose_layers() creates a board view from a list of layers, each one with
+its color, opacity and mirror settings, reading each SVG only once. The
+layers can be prepared by a pool of worker processes.
 """
 
 logger = logging.getLogger(__name__)
 
+# Characters escaped in the attributes and in the text
+ATTR_ESCAPE = re.compile('[&<>"\n\r\t]')
+ATTR_ENTITIES = {'"': '&quot;', '\n': '&#10;', '\r': '&#13;', '\t': '&#9;'}
+TEXT_ESCAPE = re.compile('[&<>]')
+# Strings buffered before writing them
+WRITE_BUFFER = 4096
+
+
+class StyleTransform(object):
+    """Changes some properties of a CSS style attribute.
+       The results are cached, pcbnew uses a few different styles."""
+    def __init__(self, values):
+        # Property -> function to transform its value
+        self.values = values
+        self.styles = {}
+        self.results = {k: {} for k in values}
+
+    def __call__(self, style):
+        new = self.styles.get(style)
+        if new is None:
+            props = []
+            for prop in style.split(';'):
+                k, sep, v = prop.partition(':')
+                key = k.strip()
+                if sep and key in self.values:
+                    cache = self.results[key]
+                    value = v.strip()
+                    if value not in cache:
+                        cache[value] = self.values[key](value)
+                    # Keep the spaces, only the value changes
+                    prop = k[:len(k) - len(k.lstrip())] + key + ':' + cache[value]
+                props.append(prop)
+            new = self.styles[style] = ';'.join(props)
+        return new
+
+
+class SvgWriter(ContentHandler):
+    """Writes the SAX events to a binary file as UTF-8, like XMLGenerator
+       using short empty elements. It's faster because the output is
+       buffered and the values are escaped only when needed."""
+    def __init__(self, out, declaration=True):
+        ContentHandler.__init__(self)
+        self.out = out
+        # Write the <?xml ...?> declaration
+        self.declaration = declaration
+        self.buffer = []
+        # The start tag isn't closed yet
+        self.pending = False
+
+    def _write(self, text):
+        self.buffer.append(text)
+        if len(self.buffer) > WRITE_BUFFER:
+            self._write_buffer()
+
+    def _write_buffer(self):
+        self.out.write(''.join(self.buffer).encode('utf-8'))
+        self.buffer = []
+
+    def flush(self):
+        """Writes the buffered text, closing the last start tag"""
+        if self.pending:
+            self.buffer.append('>')
+            self.pending = False
+        self._write_buffer()
+
+    def startDocument(self):
+        if self.declaration:
+            self._write('<?xml version="1.0" encoding="utf-8"?>\n')
+
+    def endDocument(self):
+        self.flush()
+
+    def startElement(self, name, attrs):
+        parts = ['>' if self.pending else '', '<', name]
+        for k, v in attrs.items():
+            if ATTR_ESCAPE.search(v):
+                v = escape(v, ATTR_ENTITIES)
+            parts.append(' {}="{}"'.format(k, v))
+        self._write(''.join(parts))
+        self.pending = True
+
+    def endElement(self, name):
+        if self.pending:
+            self._write('/>')
+            self.pending = False
+        else:
+            self._write('</{}>'.format(name))
+
+    def characters(self, content):
+        if content:
+            if TEXT_ESCAPE.search(content):
+                content = escape(content)
+            if self.pending:
+                content = '>' + content
+                self.pending = False
+            self._write(content)
+
+    def ignorableWhitespace(self, content):
+        self.characters(content)
+
+    def processingInstruction(self, target, data):
+        self._write('{}<?{} {}?>'.format('>' if self.pending else '', target, data))
+        self.pending = False
+
+
+class _EventFilter(XMLFilterBase):
+    """Base for the filters, passes the events to the next handler"""
+    def __init__(self, handler):
+        XMLFilterBase.__init__(self)
+        self.setContentHandler(handler)
+        self.depth = 0
+
+
+class ColorFilter(_EventFilter):
+    """Applies a style transform to the fill and stroke of all the groups"""
+    def __init__(self, handler, transform_function):
+        _EventFilter.__init__(self, handler)
+        self.transform = StyleTransform({'fill': transform_function, 'stroke': transform_function})
+
+    def startElement(self, name, attrs):
+        if name == 'g' and 'style' in attrs:
+            attrs = dict(attrs.items())
+            attrs['style'] = self.transform(attrs['style'])
+        XMLFilterBase.startElement(self, name, attrs)
+
+
+class ImportFilter(_EventFilter):
+    """Adds the top level groups of other SVGs before the end of the root"""
+    def __init__(self, handler, sources):
+        _EventFilter.__init__(self, handler)
+        self.sources = sources
+
+    def startElement(self, name, attrs):
+        self.depth += 1
+        XMLFilterBase.startElement(self, name, attrs)
+
+    def endElement(self, name):
+        self.depth -= 1
+        if not self.depth:
+            for source in self.sources:
+                source.stream_groups(self.getContentHandler())
+        XMLFilterBase.endElement(self, name)
+
+
+class WrapFilter(_EventFilter):
+    """Moves the top level groups to a new group, at the end of the root"""
+    def __init__(self, handler, attrs):
+        _EventFilter.__init__(self, handler)
+        self.attrs = attrs
+        self.in_wrapper = False
+        # Top level elements after the first group, replayed after it
+        self.delayed = None
+        self.recording = False
+
+    def _emit(self, event, *args):
+        if self.recording:
+            self.delayed.append((event, args))
+        else:
+            getattr(XMLFilterBase, event)(self, *args)
+
+    def startElement(self, name, attrs):
+        self.depth += 1
+        if self.depth == 2:
+            if name == 'g':
+                if not self.in_wrapper:
+                    XMLFilterBase.startElement(self, 'g', self.attrs)
+                    self.in_wrapper = True
+                    self.delayed = []
+            elif self.in_wrapper:
+                self.recording = True
+        self._emit('startElement', name, dict(attrs.items()) if self.recording else attrs)
+
+    def endElement(self, name):
+        if self.depth == 1:
+            if not self.in_wrapper:
+                XMLFilterBase.startElement(self, 'g', self.attrs)
+            XMLFilterBase.endElement(self, 'g')
+            for event, args in self.delayed or ():
+                getattr(XMLFilterBase, event)(self, *args)
+        self._emit('endElement', name)
+        if self.depth == 2:
+            self.recording = False
+        self.depth -= 1
+
+    def characters(self, content):
+        if self.depth > 1:
+            self._emit('characters', content)
+
+    def ignorableWhitespace(self, content):
+        if self.depth > 1:
+            self._emit('ignorableWhitespace', content)
+
+
+class _GroupsOnly(_EventFilter):
+    """Passes only the top level groups, used to import them"""
+    def __init__(self, handler):
+        _EventFilter.__init__(self, handler)
+        self.passing = False
+
+    def startDocument(self):
+        pass
+
+    def endDocument(self):
+        pass
+
+    def processingInstruction(self, target, data):
+        pass
+
+    def startElement(self, name, attrs):
+        self.depth += 1
+        if self.depth == 2:
+            self.passing = name == 'g'
+        if self.passing:
+            XMLFilterBase.startElement(self, name, attrs)
+
+    def endElement(self, name):
+        if self.passing:
+            XMLFilterBase.endElement(self, name)
+        if self.depth == 2:
+            self.passing = False
+        self.depth -= 1
+
+    def characters(self, content):
+        if self.passing:
+            XMLFilterBase.characters(self, content)
+
+    def ignorableWhitespace(self, content):
+        if self.passing:
+            XMLFilterBase.ignorableWhitespace(self, content)
+
+
 class SvgProcessor(object):
 
     def __init__(self, input_file):
-        self.dom = minidom.parse(input_file)
-        self.svg_node = self.dom.documentElement
+        self.input_file = input_file
+        # Operations in the order they were requested
+        self.operations = []
 
     def apply_color_transform(self, transform_function):
         # Set fill and stroke on all groups
-        for group in self.svg_node.getElementsByTagName('g'):
-            SvgProcessor._apply_transform(group, {
-                'fill': transform_function,
-                'stroke': transform_function,
-            })
+        self.operations.append(lambda handler: ColorFilter(handler, transform_function))
 
     def import_groups(self, from_svg_processor):
-        for child in from_svg_processor.svg_node.childNodes:
-            if child.nodeType != child.ELEMENT_NODE or child.tagName != 'g':
-                continue
-            group = child
-            output_node = self.dom.importNode(group, True)
-            self.svg_node.appendChild(output_node)
+        self.operations.append(lambda handler: ImportFilter(handler, [from_svg_processor]))
+
+    def wrap_with_group(self, attrs):
+        self.operations.append(lambda handler: WrapFilter(handler, attrs))
+
+    def _chain(self, handler):
+        # The first operation must be the closest to the input
+        for operation in reversed(self.operations):
+            handler = operation(handler)
+        return handler
+
+    def stream(self, handler):
+        """Sends the processed SVG to a SAX content handler"""
+        parser = xml.sax.make_parser()
+        parser.setFeature(xml.sax.handler.feature_external_ges, False)
+        parser.setContentHandler(self._chain(handler))
+        parser.parse(self.input_file)
+
+    def stream_groups(self, handler):
+        """Sends only the processed top level groups to the handler"""
+        self.stream(_GroupsOnly(handler))
 
     def write(self, filename):
         with open(filename, 'wb') as output_file:
-            self.svg_node.writexml(output_file)
+            # Only the root element, as the minidom version did: no XML
+            # declaration and no DOCTYPE
+            self.stream(SvgWriter(output_file, declaration=False))
+
+
+class SvgLayer(object):
+    """A layer for compose_layers().
+       The color (i.e. '#FF0000') replaces the fill and stroke colors,
+       mirror flips the layer horizontally (for the bottom view)."""
+    def __init__(self, svg_file, color=None, opacity=1.0, mirror=False):
+        self.svg_file = svg_file
+        self.color = color
+        self.opacity = opacity
+        self.mirror = mirror
+
+    def group_attrs(self, root):
+        """Attributes for the group of the layer, root are the attributes of its <svg>"""
+        attrs = {}
+        if self.opacity != 1.0:
+            attrs['opacity'] = '{:g}'.format(self.opacity)
+        if self.mirror:
+            transform = _mirror_transform(root)
+            if transform:
+                attrs['transform'] = transform
+            else:
+                logger.warning('No viewBox or width in {}, not mirrored'.format(self.svg_file))
+        return attrs
+
+    def color_transform(self, value):
+        return value if value == 'none' else self.color
+
+
+def _mirror_transform(root):
+    """Flips around the vertical axis at the center of the view box"""
+    box = root.get('viewBox', '').replace(',', ' ').split()
+    try:
+        if len(box) == 4:
+            x, width = float(box[0]), float(box[2])
+        else:
+            x, width = 0.0, float(root.get('width', ''))
+    except ValueError:
+        return None
+    return 'translate({:g} 0) scale(-1 1)'.format(2*x + width)
+
+
+class _LayerFilter(_EventFilter):
+    """Passes the top level groups of a layer inside a group with its
+       settings. The root attributes and the <defs> go to the sink."""
+    def __init__(self, handler, layer, sink):
+        _EventFilter.__init__(self, handler)
+        self.layer = layer
+        self.sink = sink
+        self.passing = False
+        self.wrapped = False
+        self.root = None
+        # Events of the <defs> being read
+        self.defs = None
+
+    def startDocument(self):
+        pass
+
+    def endDocument(self):
+        pass
+
+    def processingInstruction(self, target, data):
+        pass
+
+    def startElement(self, name, attrs):
+        self.depth += 1
+        if self.depth == 1:
+            self.root = dict(attrs.items())
+            self.sink.start(self.root)
+            return
+        if self.depth == 2:
+            if name == 'defs':
+                self.defs = []
+            elif name == 'g':
+                if not self.wrapped:
+                    XMLFilterBase.startElement(self, 'g', self.layer.group_attrs(self.root))
+                    self.wrapped = True
+                self.passing = True
+        if self.defs is not None:
+            self.defs.append(('startElement', name, tuple(attrs.items())))
+        elif self.passing:
+            XMLFilterBase.startElement(self, name, attrs)
+
+    def endElement(self, name):
+        if self.defs is not None:
+            self.defs.append(('endElement', name))
+            if self.depth == 2:
+                self.sink.add_defs(tuple(self.defs))
+                self.defs = None
+        elif self.passing:
+            XMLFilterBase.endElement(self, name)
+        if self.depth == 2:
+            self.passing = False
+        elif self.depth == 1 and self.wrapped:
+            XMLFilterBase.endElement(self, 'g')
+        self.depth -= 1
+
+    def characters(self, content):
+        if self.defs is not None:
+            if content.strip():
+                self.defs.append(('characters', content))
+        elif self.passing:
+            XMLFilterBase.characters(self, content)
+
+    def ignorableWhitespace(self, content):
+        if self.passing:
+            XMLFilterBase.ignorableWhitespace(self, content)
+
+
+def _stream_layer(layer, handler, sink):
+    handler = _LayerFilter(handler, layer, sink)
+    if layer.color:
+        handler = ColorFilter(handler, layer.color_transform)
+    parser = xml.sax.make_parser()
+    parser.setFeature(xml.sax.handler.feature_external_ges, False)
+    parser.setContentHandler(handler)
+    parser.parse(layer.svg_file)
+
+
+class _Composition(object):
+    """The output of compose_layers(), the root is the one of the first layer"""
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self.generator = SvgWriter(output_file)
+        self.started = False
+        self.defs = set()
+
+    def start(self, root):
+        if not self.started:
+            self.generator.startDocument()
+            self.generator.startElement('svg', root)
+            self.generator.characters('\n')
+            self.started = True
+
+    def add_defs(self, events):
+        """Writes the <defs>, unless an identical one was already written"""
+        if events in self.defs:
+            return
+        self.defs.add(events)
+        for event in events:
+            if event[0] == 'startElement':
+                self.generator.startElement(event[1], dict(event[2]))
+            elif event[0] == 'endElement':
+                self.generator.endElement(event[1])
+            else:
+                self.generator.characters(event[1])
+
+    def add_fragment(self, fragment_file):
+        """Copies a layer prepared by a worker"""
+        self.generator.flush()
+        with open(fragment_file, 'rb') as f:
+            shutil.copyfileobj(f, self.output_file)
+
+    def end(self):
+        # No layers
+        self.start({'xmlns': 'http://www.w3.org/2000/svg'})
+        self.generator.endElement('svg')
+        self.generator.endDocument()
+
+
+class _LayerInfo(object):
+    """Root attributes and <defs> of a layer prepared by a worker"""
+    def __init__(self):
+        self.root = None
+        self.defs = []
+
+    def start(self, root):
+        self.root = root
+
+    def add_defs(self, events):
+        self.defs.append(events)
+
+
+def _prepare_layer(task):
+    """Writes the group of a layer to a file, returns the file and the _LayerInfo"""
+    layer, fragment_file = task
+    info = _LayerInfo()
+    with open(fragment_file, 'wb') as f:
+        writer = SvgWriter(f)
+        _stream_layer(layer, writer, info)
+        writer.flush()
+    return fragment_file, info
 
-    def wrap_with_group(self, attrs):
-        parent = self.svg_node
-        wrapper = self.dom.createElement("g")
-        for k,v in attrs.items():
-            wrapper.setAttribute(k,v)
-
-        for child in parent.getElementsByTagName('g'):
-            parent.removeChild(child)
-            wrapper.appendChild(child)
-
-        parent.appendChild(wrapper)
-
-    @staticmethod
-    def _apply_transform(node, values):
-        original_style = node.attributes['style'].value
-        for (k,v) in values.items():
-            escaped_key = re.escape(k)
-            m = re.search(r'\b' + escaped_key + r':(?P<value>[^;]*);', original_style)
-            if m:
-                transformed_value = v(m.group('value'))
-                original_style = re.sub(
-                    r'\b' + escaped_key + r':[^;]*;',
-                    k + ':' + transformed_value + ';',
-                    original_style)
-        node.attributes['style'] = original_style
 
+def compose_layers(layers, filename, jobs=1):
+    """Writes a SVG with the groups of the layers (a list of SvgLayer), in
+       the same order, each layer in a group with its settings. The <defs>
+       found in more than one layer are written once.
+       With jobs > 1 the layers are prepared in parallel by worker processes,
+       using temporary files, and then copied in order."""
+    jobs = min(jobs, len(layers))
+    with open(filename, 'wb') as output_file:
+        out = _Composition(output_file)
+        if jobs <= 1:
+            for layer in layers:
+                _stream_layer(layer, out.generator, out)
+        else:
+            logger.debug('Composing using {} processes'.format(jobs))
+            temp_dir = tempfile.mkdtemp()
+            tasks = [(layer, os.path.join(temp_dir, '{}.svg'.format(n))) for n, layer in enumerate(layers)]
+            pool = multiprocessing.get_context('fork').Pool(jobs)
+            try:
+                for fragment_file, info in pool.imap(_prepare_layer, tasks, chunksize=1):
+                    out.start(info.root)
+                    for defs in info.defs:
+                        out.add_defs(defs)
+                    out.add_fragment(fragment_file)
+                    os.remove(fragment_file)
+            finally:
+                pool.terminate()
+                pool.join()
+                shutil.rmtree(temp_dir, ignore_errors=True)
+        out.end()
@@ -0,0 +1,30 @@
+"""Tests for the headless netlist
+
+tests/data/hier is a small hierarchical design: a connector in the root
+sheet and a RC filter sheet used twice. hier.net is the eeschema netlist.
+"""
+import os
+
+from kicad_auto import sch_netlist
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'hier')
+SCH = os.path.join(DATA, 'hier.sch')
+GUI_NET = os.path.join(DATA, 'hier.net')
+
+
+def test_netlist_matches_eeschema(tmp_path):
+    headless_net = str(tmp_path / 'hier.net')
+    sch_netlist.netlist(SCH, headless_net)
+    assert sch_netlist.compare(headless_net, GUI_NET) == []
+
+
+def test_compare_reports_differences(tmp_path):
+    headless_net = str(tmp_path / 'hier.net')
+    sch_netlist.netlist(SCH, headless_net)
+    with open(GUI_NET) as f:
+         changed = f.read().replace('(node (ref J1) (pin 1))', '(node (ref J1) (pin 3))')
+    changed_net = str(tmp_path / 'changed.net')
+    with open(changed_net, 'w') as f:
+         f.write(changed)
+    diffs = sch_netlist.compare(headless_net, changed_net)
+    assert any(d.startswith('Net +5V only in '+headless_net) for d in diffs)